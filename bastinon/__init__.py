@@ -1,5 +1,11 @@
 from .base.firewall_base import FirewallBase
 from .iptables import Iptables
+from .ipset import Ipset
+from .nftables import Nftables
 from .firewalld import Firewalld
+from .expiry_scheduler import ExpiryScheduler
+from .prometheus_exporter import PrometheusExporter
+from .rule_usage import RuleUsage, RuleCounters
 
-__all__ = ['FirewallBase', 'Iptables', 'Firewalld']
+__all__ = ['FirewallBase', 'Iptables', 'Ipset', 'Nftables', 'Firewalld', 'ExpiryScheduler', 'PrometheusExporter',
+           'RuleUsage', 'RuleCounters']
@@ -1,3 +1,4 @@
 from .firewall_base import FirewallBase
+from .enforcement_plan import EnforcementPlan, PlannedChange
 
-__all__ = ['FirewallBase']
+__all__ = ['FirewallBase', 'EnforcementPlan', 'PlannedChange']
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import json
+from typing import List, Union, Optional
+from ..rules import Rule, UserRule, AggregatedRule
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PlannedChange:
+    """
+    Single change of an enforcement plan.
+    """
+    DELETE = r"delete"
+    APPEND = r"append"
+    REPLACE = r"replace"
+    # Chain, set or table operation not affecting a single rule
+    CHAIN = r"chain"
+    # Command of a firewall not telling its changes apart
+    OTHER = r"other"
+    ACTIONS = [DELETE, APPEND, REPLACE, CHAIN, OTHER]
+
+    def __init__(self, action: str, ip_version: Optional[int], command: str, service_code: str = None,
+                 source: str = None, comment: str = None, owners: List[str] = None,
+                 replaced_source: str = None, replaced_comment: str = None):
+        """
+        Construct a planned change
+        :param action: One of ACTIONS
+        :param ip_version: IP-version, 4 or 6, None if change isn't specific to an address family
+        :param command: Command making the change, as it would be run
+        :param service_code: (optional) Service of the rule
+        :param source: (optional) Source address or network of the rule
+        :param comment: (optional) Comment of the rule
+        :param owners: (optional) Users owning the rule. Empty for shared rules and rules no user has.
+        :param replaced_source: (optional) Replace: source of the replaced rule
+        :param replaced_comment: (optional) Replace: comment of the replaced rule
+        """
+        if action not in self.ACTIONS:
+            raise ValueError("Action '{}' not allowed! Known are: {}".format(action, ', '.join(self.ACTIONS)))
+        self.action = action
+        self.ip_version = ip_version
+        self.command = command
+        self.service_code = service_code
+        self.source = source
+        self.comment = comment
+        self.owners = owners if owners else []
+        self.replaced_source = replaced_source
+        self.replaced_comment = replaced_comment
+
+    @staticmethod
+    def for_rule(action: str, ip_version: int, command: str, rule: Rule,
+                 replaced_rule: Rule = None) -> 'PlannedChange':
+        """
+        Construct a planned change of a rule
+        :param action: One of ACTIONS
+        :param ip_version: IP-version, 4 or 6
+        :param command: Command making the change
+        :param rule: Rule being changed. Owners of an aggregated rule are the owners of its members.
+        :param replaced_rule: (optional) Replace: rule being replaced
+        :return: planned change
+        """
+        return PlannedChange(action, ip_version, command,
+                             service_code=rule.service.code if rule.service else None,
+                             source=rule.source, comment=rule.comment,
+                             owners=PlannedChange.rule_owners(rule),
+                             replaced_source=replaced_rule.source if replaced_rule else None,
+                             replaced_comment=replaced_rule.comment if replaced_rule else None)
+
+    @staticmethod
+    def rule_owners(rule: Rule) -> List[str]:
+        if isinstance(rule, AggregatedRule):
+            return sorted(set(owner for member in rule.members for owner in PlannedChange.rule_owners(member)))
+        if isinstance(rule, UserRule):
+            return [rule.owner]
+
+        return []
+
+    def to_dict(self) -> dict:
+        change_out = {
+            "action": self.action,
+            "family": "ipv{}".format(self.ip_version) if self.ip_version else None,
+            "service": self.service_code,
+            "source": self.source,
+            "comment": self.comment,
+            "owners": self.owners,
+            "command": self.command,
+        }
+        if self.action == self.REPLACE:
+            change_out["replaced"] = {"source": self.replaced_source, "comment": self.replaced_comment}
+
+        return change_out
+
+    def __str__(self) -> str:
+        return self.command
+
+
+class EnforcementPlan:
+    """
+    Changes needed to make rules effective and estimated cost of applying them.
+    Cost is counted in kernel operations, ie. rule, set or chain changes, and in processes run to read
+    and apply the changes.
+    """
+
+    def __init__(self, firewall: str, forced: bool = False):
+        """
+        Initialize empty plan
+        :param firewall: Name of the firewall
+        :param forced: Plan is for a forced update
+        """
+        self.firewall = firewall
+        self.forced = forced
+        self.changes = []
+        self.kernel_operations = 0
+        self.processes = 0
+
+    @property
+    def changes_needed(self) -> bool:
+        return bool(self.changes)
+
+    def add(self, change: PlannedChange) -> None:
+        self.changes.append(change)
+
+    def commands(self) -> List[str]:
+        """
+        Commands in order of execution
+        :return: list of strings
+        """
+        return [change.command for change in self.changes]
+
+    def count(self, action: str = None, ip_version: Union[int, None] = None) -> int:
+        """
+        Number of changes
+        :param action: (optional) Count only changes of an action
+        :param ip_version: (optional) Count only changes of an address family
+        :return: int
+        """
+        return len([change for change in self.changes
+                    if (action is None or change.action == action) and
+                    (ip_version is None or change.ip_version == ip_version)])
+
+    def to_dict(self) -> dict:
+        summary = {}
+        for change in self.changes:
+            family = "ipv{}".format(change.ip_version) if change.ip_version else "any"
+            family_summary = summary.setdefault(family, {})
+            family_summary[change.action] = family_summary.get(change.action, 0) + 1
+
+        return {
+            "firewall": self.firewall,
+            "forced": self.forced,
+            "changes_needed": self.changes_needed,
+            "cost": {
+                "kernel_operations": self.kernel_operations,
+                "processes": self.processes,
+            },
+            "summary": summary,
+            "changes": [change.to_dict() for change in self.changes],
+        }
+
+    def to_json(self, indent: int = None) -> str:
+        return json.dumps(self.to_dict(), indent=indent)
@@ -17,10 +17,15 @@
 #
 # Copyright (c) Jari Turkia
 
+import os
+import threading
 from abc import ABC, abstractmethod
 from typing import Tuple, List, Union, Dict
 from datetime import datetime
 from ..rules import UserRule, Service
+from ..executors import CommandExecutor, SubprocessExecutor
+from ..stats import stats
+from .enforcement_plan import EnforcementPlan, PlannedChange
 import logging
 
 log = logging.getLogger(__name__)
@@ -28,8 +33,16 @@ log = logging.getLogger(__name__)
 
 class FirewallBase(ABC):
 
-    def __init__(self, services: Dict[str, Service]):
+    def __init__(self, services: Dict[str, Service], executor: CommandExecutor = None):
+        """
+        Initialize firewall
+        :param services: List of defined services
+        :param executor: (optional) Runner of firewall commands, default: run commands as child processes
+        """
         self.services = services
+        self.executor = executor if executor else SubprocessExecutor()
+        # Changes made from a worker thread need to be serialized with the ones made by the service
+        self.lock = threading.RLock()
 
     @abstractmethod
     def query(self, rules: List[UserRule]) -> List[Tuple[UserRule, bool]]:
@@ -73,6 +86,23 @@ class FirewallBase(ABC):
         """
         pass
 
+    def plan(self, rules: List[UserRule], force=False) -> EnforcementPlan:
+        """
+        Plan what needs to be done to make rules effective.
+        Default implementation lists the commands of simulate() with a process per command,
+        firewalls knowing their changes will override this.
+        :param rules: List of firewall rules to plan for
+        :param force: Plan for forced update ignoring any possible existing rules
+        :return: plan of changes and their cost
+        """
+        plan = EnforcementPlan(self.__class__.__name__, force)
+        for command in self.simulate(rules, force) or []:
+            plan.add(PlannedChange(PlannedChange.OTHER, None, command))
+        plan.kernel_operations = len(plan.changes)
+        plan.processes = len(plan.changes)
+
+        return plan
+
     @abstractmethod
     def needs_update(self, rules: List[UserRule]) -> bool:
         """
@@ -81,3 +111,31 @@ class FirewallBase(ABC):
         :return: bool, True = changes needed, False = all rules effective
         """
         pass
+
+    def remove_expired(self, rules: List[UserRule]) -> None:
+        """
+        Remove expired rules from firewall.
+        Default implementation will do a full update, firewalls capable of targeted deletion will override this.
+        :param rules: list of user rules, both expired and non-expired
+        :return:
+        """
+        self.set(rules)
+
+    def query_counters(self, rules: List[UserRule]) -> List[Tuple[UserRule, int, int]]:
+        """
+        Query for packet and byte counters of rules in effect.
+        Counters are the ones kept by the kernel, they will reset when a rule is re-created.
+        :param rules: Users' rules
+        :return: list of tuples, tuple: user rule object, packets, bytes. Only rules in effect are listed.
+        """
+        raise NotImplementedError("Rule counters not supported by {}!".format(self.__class__.__name__))
+
+    def _exec_command(self, command: list, stdin: bytes = None) -> Tuple[int, bytes, bytes]:
+        """
+        Run a firewall command
+        :param command: command and its arguments
+        :param stdin: (optional) input to feed into the command
+        :return: tuple: exit code, stdout, stderr
+        """
+        with stats.timer("exec.{}".format(os.path.basename(str(command[0])))):
+            return self.executor.run(command, stdin=stdin)
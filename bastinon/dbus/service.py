@@ -18,13 +18,16 @@
 # Copyright (c) Jari Turkia
 
 import os
-from typing import Union, Tuple, List
+from typing import Union, Tuple, List, Dict
 from dbus import (SessionBus, SystemBus, service, mainloop)
 from pwd import getpwuid, getpwnam
 from datetime import datetime
 from hashlib import sha256
 from ..base.firewall_base import FirewallBase
-from ..rules import RuleReader, RuleWriter, ServiceReader, UserRule, SharedRule
+from ..expiry_scheduler import ExpiryScheduler
+from ..rule_usage import RuleUsage
+from ..stats import stats
+from ..rules import RuleReader, RuleWriter, ServiceReader, UserRule, SharedRule, Rule, RuleAggregator
 import logging
 
 log = logging.getLogger(__name__)
@@ -41,7 +44,10 @@ class FirewallUpdaterService(service.Object):
     def __init__(self, use_system_bus: bool,
                  loop: mainloop.NativeMainLoop,
                  firewall: FirewallBase,
-                 firewall_rules_path: str):
+                 firewall_rules_path: str,
+                 aggregator: RuleAggregator = None,
+                 expiry_scheduler: ExpiryScheduler = None,
+                 rule_usage: RuleUsage = None):
         # Which bus to use for publishing?
         self._use_system_bus = use_system_bus
         if use_system_bus:
@@ -60,6 +66,9 @@ class FirewallUpdaterService(service.Object):
         self._loop = loop
         self._firewall = firewall
         self._firewall_rules_path = firewall_rules_path
+        self._aggregator = aggregator
+        self._expiry_scheduler = expiry_scheduler
+        self._rule_usage = rule_usage
 
         self._max_ipv4_network_size = None #14
         self._max_ipv6_network_size = None
@@ -111,6 +120,7 @@ class FirewallUpdaterService(service.Object):
         return user_id, user_login, user_full_name
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.Ping")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature=None, out_signature="s",
                     sender_keyword='sender')
@@ -147,6 +157,7 @@ class FirewallUpdaterService(service.Object):
         return greeting
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.GetServices")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature=None, out_signature="a(ss)",
                     sender_keyword='sender')
@@ -162,6 +173,7 @@ class FirewallUpdaterService(service.Object):
         return services_out
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.GetProtocols")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature=None, out_signature="as",
                     sender_keyword='sender')
@@ -174,6 +186,7 @@ class FirewallUpdaterService(service.Object):
         return reader.PROTOCOLS
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.GetRules")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature="s", out_signature="a(ssssvvb)",
                     sender_keyword='sender')
@@ -195,9 +208,13 @@ class FirewallUpdaterService(service.Object):
         else:
             user_id, user_login, user_full_name = (None, '-all-', 'All Users')
 
-        reader = RuleReader(self._firewall_rules_path)
+        reader = self._rule_reader()
         rules = reader.read_all_users(read_shared_rules=True)
-        active_rules = self._firewall.query(rules)
+        if self._aggregator:
+            # Report per rule, not per aggregate
+            active_rules = self._aggregator.expand(self._firewall.query(self._aggregator.aggregate(rules)))
+        else:
+            active_rules = self._firewall.query(rules)
 
         def _rule_tuple_helper(r: Tuple[Union[UserRule, SharedRule], bool]) -> tuple:
             # Notes:
@@ -248,6 +265,7 @@ class FirewallUpdaterService(service.Object):
         return rules_out
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.UpsertRule")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature="ssssvv", out_signature="s",
                     sender_keyword='sender')
@@ -329,10 +347,12 @@ class FirewallUpdaterService(service.Object):
         # Go write!
         writer = RuleWriter(self._firewall_rules_path)
         writer.write(user, rules)
+        self._rules_changed()
 
         return hash_to_return
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.DeleteRule")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature="ss", out_signature=None,
                     sender_keyword='sender')
@@ -374,10 +394,12 @@ class FirewallUpdaterService(service.Object):
         # Go write!
         writer = RuleWriter(self._firewall_rules_path)
         writer.write(user, rules)
+        self._rules_changed()
 
         return
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.FirewallUpdatesNeeded")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature=None, out_signature="b",
                     sender_keyword='sender')
@@ -387,8 +409,7 @@ class FirewallUpdaterService(service.Object):
         :param sender:
         :return: True = updates needed, False = all ok, no updates needed
         """
-        reader = RuleReader(self._firewall_rules_path)
-        rules = reader.read_all_users(read_shared_rules=True)
+        rules = self._read_firewall_rules()
 
         # Test the newly read rules
         updates_needed = self._firewall.needs_update(rules)
@@ -400,6 +421,7 @@ class FirewallUpdaterService(service.Object):
         return updates_needed
 
     # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.FirewallUpdate")
     @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
                     in_signature=None, out_signature=None,
                     sender_keyword='sender')
@@ -409,13 +431,92 @@ class FirewallUpdaterService(service.Object):
         :param sender:
         :return: True = updates needed, False = all ok, no updates needed
         """
-        reader = RuleReader(self._firewall_rules_path)
-        rules = reader.read_all_users(read_shared_rules=True)
+        rules = self._read_firewall_rules()
 
         # Test the newly read rules
-        self._firewall.set(rules)
+        with self._firewall.lock:
+            self._firewall.set(rules)
+        self._rules_changed()
         log.info("Firewall changes done!")
 
+    # noinspection PyPep8Naming
+    @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
+                    in_signature=None, out_signature="a{sa{sd}}",
+                    sender_keyword='sender')
+    def GetStats(self, sender=None) -> Dict[str, Dict[str, float]]:
+        """
+        Get counters and latency histograms of processing phases
+        :param sender:
+        :return: dict, key: counter or histogram name, value: dict of count and for histograms sum, max, p50, p95, p99
+        """
+        stats_out = {name: {key: float(value) for key, value in values.items()}
+                     for name, values in stats.snapshot().items()}
+        log.info("GetStats(): Returning {} statistics".format(len(stats_out)))
+
+        return stats_out
+
+    # noinspection PyPep8Naming
+    @stats.timed("FirewallUpdaterService.GetRuleUsage")
+    @service.method(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME,
+                    in_signature="si", out_signature="a(ssssvttsv)",
+                    sender_keyword='sender')
+    def GetRuleUsage(self, user: str, unused_days: int, sender=None) -> List[
+        Tuple[str, str, str, str, Union[str, bool], int, int, str, Union[str, bool]]
+    ]:
+        """
+        Get cumulative packet and byte counters of rules
+        :param user: str, optional user to limit firewall rules into
+        :param unused_days: int, list only rules not used for this many days, negative = all rules
+        :param sender:
+        :return: list of tuples, tuple: rule hash, owner, service, source, comment, packets, bytes,
+                 first seen in effect, last used. Comment and last used are False if not set.
+        """
+        if not self._rule_usage:
+            raise ValueError("Rule usage is not being collected!")
+
+        reader = self._rule_reader()
+        rules = reader.read_all_users(read_shared_rules=True)
+        if user:
+            rules = [rule for rule in rules if not isinstance(rule, UserRule) or rule.owner == user]
+
+        rules_out = []
+        for rule, counters in self._rule_usage.report(rules, unused_days if unused_days >= 0 else None):
+            rules_out.append((
+                self._rule_hash(rule),
+                rule.owner if isinstance(rule, UserRule) else "",
+                rule.service.code,
+                str(rule.source),
+                rule.comment if rule.comment else False,
+                counters.packet_count,
+                counters.byte_count,
+                counters.first_seen.isoformat(),
+                counters.last_used.isoformat() if counters.last_used else False
+            ))
+        log.info("GetRuleUsage({}, {}): Returning usage of {} rules".format(user, unused_days, len(rules_out)))
+
+        return rules_out
+
+    def _rules_changed(self) -> None:
+        """
+        Rules have changed, expiry times need to be rescheduled.
+        """
+        if self._expiry_scheduler:
+            self._expiry_scheduler.reschedule()
+
+    def _rule_reader(self) -> RuleReader:
+        return RuleReader(self._firewall_rules_path)
+
+    def _read_firewall_rules(self) -> List[Rule]:
+        """
+        Read all rules to be set into firewall, aggregated if requested.
+        """
+        reader = self._rule_reader()
+        rules = reader.read_all_users(read_shared_rules=True)
+        if self._aggregator:
+            rules = self._aggregator.aggregate(rules)
+
+        return rules
+
     @staticmethod
     def _rule_hash(r: UserRule) -> str:
         """
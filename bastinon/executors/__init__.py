@@ -0,0 +1,6 @@
+from .command_executor import CommandExecutor
+from .subprocess_executor import SubprocessExecutor
+from .memory_iptables_executor import MemoryIptablesExecutor
+from .persistent_restore_executor import PersistentRestoreExecutor
+
+__all__ = ['CommandExecutor', 'SubprocessExecutor', 'MemoryIptablesExecutor', 'PersistentRestoreExecutor']
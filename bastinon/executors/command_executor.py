@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+from abc import ABC, abstractmethod
+from typing import Tuple, Union
+
+
+class CommandExecutor(ABC):
+    """
+    Runs firewall commands on behalf of a firewall.
+    """
+
+    @abstractmethod
+    def which(self, command: str) -> Union[str, None]:
+        """
+        Find exact location of a command
+        :param command: command name, eg. iptables
+        :return: path to command, None if command isn't available
+        """
+        pass
+
+    @abstractmethod
+    def run(self, command: list, stdin: bytes = None) -> Tuple[int, bytes, bytes]:
+        """
+        Run a firewall command
+        :param command: command and its arguments
+        :param stdin: (optional) input to feed into the command
+        :return: tuple: exit code, stdout, stderr
+        """
+        pass
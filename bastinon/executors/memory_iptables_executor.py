@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import re
+import shlex
+import ipaddress
+from collections import Counter
+from typing import Tuple, List, Dict, Union
+from .command_executor import CommandExecutor
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class MemoryIptablesExecutor(CommandExecutor):
+    """
+    In-memory IPtables filter-table. Doesn't need iptables-commands, root nor kernel.
+    Understands iptables, iptables-save and iptables-restore and their IPv6 counterparts as run by Iptables.
+    Rules are numbered, inserted and deleted as iptables would do.
+    Every command and chain operation is counted. Latency is simulated, no time is actually spent.
+    """
+    COMMANDS = {
+        "iptables": (4, "iptables"),
+        "ip6tables": (6, "iptables"),
+        "iptables-save": (4, "save"),
+        "ip6tables-save": (6, "save"),
+        "iptables-restore": (4, "restore"),
+        "ip6tables-restore": (6, "restore"),
+    }
+    TABLE = r"filter"
+    BUILTIN_CHAINS = ("INPUT", "FORWARD", "OUTPUT")
+    BUILTIN_TARGETS = ("ACCEPT", "DROP", "REJECT", "RETURN", "LOG")
+    LONG_OPTIONS = {
+        "--source": "-s",
+        "--protocol": "-p",
+        "--match": "-m",
+        "--jump": "-j",
+        "--goto": "-g",
+        "--destination-port": "--dport",
+        "--destination-ports": "--dports",
+    }
+
+    def __init__(self, chains: List[str] = None, command_latency: float = 0.0, operation_latency: float = 0.0):
+        """
+        Initialize in-memory IPtables
+        :param chains: (optional) User chains to create for both IP-versions
+        :param command_latency: Simulated seconds spent on starting a command
+        :param operation_latency: Simulated seconds spent on a single chain operation
+        """
+        self.command_latency = command_latency
+        self.operation_latency = operation_latency
+        self._tables = {4: self._empty_table(), 6: self._empty_table()}
+        for chain_name in chains or []:
+            for table in self._tables.values():
+                table[chain_name] = []
+
+        self.commands = Counter()
+        self.operations = Counter()
+        self.latency = Counter()
+
+    @property
+    def simulated_time(self) -> float:
+        """
+        Simulated seconds spent on all commands
+        """
+        return sum(self.latency.values())
+
+    def reset_stats(self) -> None:
+        """
+        Zero command and operation counts and simulated latency.
+        :return:
+        """
+        self.commands = Counter()
+        self.operations = Counter()
+        self.latency = Counter()
+
+    def chain(self, ip_version: int, chain_name: str) -> List[List[str]]:
+        """
+        Get rules of a chain
+        :param ip_version: IP-version, 4 or 6
+        :param chain_name: Name of chain
+        :return: list of rules in chain order, a rule is a list of arguments after "-A <chain>"
+        """
+        table = self._tables[ip_version]
+        if chain_name not in table:
+            raise ValueError("IPv{} chain '{}' doesn't exist!".format(ip_version, chain_name))
+
+        return [list(rule) for rule in table[chain_name]]
+
+    #
+    # Command executor implementation
+    #
+
+    def which(self, command: str) -> Union[str, None]:
+        if command not in self.COMMANDS:
+            return None
+
+        return command
+
+    def run(self, command: list, stdin: bytes = None) -> Tuple[int, bytes, bytes]:
+        command_name = os.path.basename(str(command[0]))
+        if command_name not in self.COMMANDS:
+            return 127, b"", "{}: command not found".format(command_name).encode('UTF-8')
+
+        ip_version, command_type = self.COMMANDS[command_name]
+        args = [str(arg) for arg in command[1:]]
+        self.commands[command_name] += 1
+        self.latency[command_name] += self.command_latency
+        try:
+            if command_type == "save":
+                return 0, self._save(ip_version, counters="-c" in args).encode('UTF-8'), b""
+            if command_type == "restore":
+                self._restore(command_name, ip_version, args, stdin)
+            else:
+                self._operate(command_name, self._tables[ip_version], args)
+        except ValueError as exc:
+            return 1, b"", "{}: {}".format(command_name, exc).encode('UTF-8')
+
+        return 0, b"", b""
+
+    #
+    # In-memory IPtables implementation below
+    #
+
+    def _empty_table(self) -> Dict[str, List[tuple]]:
+        return {chain_name: [] for chain_name in self.BUILTIN_CHAINS}
+
+    def _save(self, ip_version: int, counters: bool = False) -> str:
+        table = self._tables[ip_version]
+        # No packets ever traverse the chains
+        prefix = ["[0:0]"] if counters else []
+        lines = ["# Generated by MemoryIptablesExecutor", "*{}".format(self.TABLE)]
+        for chain_name in table.keys():
+            policy = "ACCEPT" if chain_name in self.BUILTIN_CHAINS else "-"
+            lines.append(":{} {} [0:0]".format(chain_name, policy))
+        for chain_name, rules in table.items():
+            for rule in rules:
+                lines.append(' '.join(prefix + ["-A", chain_name] + [self._quote(arg) for arg in rule]))
+        lines.append("COMMIT")
+
+        return '\n'.join(lines) + '\n'
+
+    def _restore(self, command_name: str, ip_version: int, args: List[str], stdin: bytes) -> None:
+        """
+        Apply iptables-restore input. All of a table is committed or nothing is.
+        """
+        noflush = "--noflush" in args or "-n" in args
+        table = None
+        for line_num, line in enumerate((stdin or b"").decode('UTF-8').splitlines(), start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                if line.startswith("*"):
+                    if line[1:] != self.TABLE:
+                        raise ValueError("Table '{}' not supported".format(line[1:]))
+                    # Copy of chain lists, rules are immutable
+                    table = {chain_name: list(rules) for chain_name, rules in self._tables[ip_version].items()}
+                    if not noflush:
+                        table = self._empty_table()
+                    continue
+                if table is None:
+                    raise ValueError("No table specified")
+                if line == "COMMIT":
+                    self._tables[ip_version] = table
+                    table = None
+                    continue
+                if line.startswith(":"):
+                    chain_name = line[1:].split()[0]
+                    if chain_name not in self.BUILTIN_CHAINS:
+                        # Declaring a chain will flush it
+                        table[chain_name] = []
+                    continue
+
+                table = self._operate(command_name, table, shlex.split(line))
+            except ValueError as exc:
+                raise ValueError("line {} failed: {}".format(line_num, exc))
+
+        if table is not None:
+            raise ValueError("COMMIT expected at line {}".format(line_num + 1))
+
+    def _operate(self, command_name: str, table: Dict[str, List[tuple]], args: List[str]) -> Dict[str, List[tuple]]:
+        """
+        Run a single chain operation
+        :param table: chains of the table, is modified
+        :param args: iptables arguments
+        :return: table
+        """
+        if len(args) >= 2 and args[0] in ("-t", "--table"):
+            if args[1] != self.TABLE:
+                raise ValueError("Table '{}' not supported".format(args[1]))
+            args = args[2:]
+        if len(args) < 2:
+            raise ValueError("Bad argument '{}'".format(' '.join(args)))
+
+        operation, chain_name, params = args[0], args[1], args[2:]
+        self.operations[operation] += 1
+        self.latency[command_name] += self.operation_latency
+
+        if operation == "-N":
+            if chain_name in table:
+                raise ValueError("Chain '{}' already exists".format(chain_name))
+            table[chain_name] = []
+            return table
+
+        if chain_name not in table:
+            raise ValueError("Chain '{}' does not exist".format(chain_name))
+        rules = table[chain_name]
+
+        if operation == "-F":
+            table[chain_name] = []
+        elif operation == "-X":
+            if chain_name in self.BUILTIN_CHAINS:
+                raise ValueError("Cannot delete built-in chain '{}'".format(chain_name))
+            if rules:
+                raise ValueError("Directory not empty, chain '{}' has rules".format(chain_name))
+            if any(self._target(rule) == chain_name for other_rules in table.values() for rule in other_rules):
+                raise ValueError("Too many links, chain '{}' is being jumped into".format(chain_name))
+            del table[chain_name]
+        elif operation == "-A":
+            rules.append(self._rule(table, params))
+        elif operation == "-I":
+            if params and params[0].isdigit():
+                rule_num = self._rule_number(params[0], len(rules) + 1)
+                params = params[1:]
+            else:
+                rule_num = 1
+            rules.insert(rule_num - 1, self._rule(table, params))
+        elif operation == "-R":
+            if not params:
+                raise ValueError("-R requires a rule number")
+            rule_num = self._rule_number(params[0], len(rules))
+            rules[rule_num - 1] = self._rule(table, params[1:])
+        elif operation == "-D":
+            if len(params) == 1 and params[0].isdigit():
+                rule_num = self._rule_number(params[0], len(rules))
+            else:
+                # First matching rule is deleted
+                rule = self._normalize(params)
+                try:
+                    rule_num = rules.index(rule) + 1
+                except ValueError:
+                    raise ValueError("Bad rule (does a matching rule exist in that chain?)")
+            del rules[rule_num - 1]
+        else:
+            raise ValueError("Unknown operation '{}'".format(operation))
+
+        return table
+
+    def _rule(self, table: Dict[str, List[tuple]], params: List[str]) -> tuple:
+        rule = self._normalize(params)
+        target = self._target(rule)
+        if target and target not in self.BUILTIN_TARGETS and target not in table:
+            raise ValueError("Couldn't load target '{}'".format(target))
+
+        return rule
+
+    @staticmethod
+    def _rule_number(rule_num_in: str, max_rule_num: int) -> int:
+        rule_num = int(rule_num_in)
+        if rule_num < 1 or rule_num > max_rule_num:
+            raise ValueError("Index of rule {} is out of range".format(rule_num))
+
+        return rule_num
+
+    def _normalize(self, params: List[str]) -> tuple:
+        """
+        Normalize rule arguments the way iptables-save would output them.
+        Long options are shortened, source address is a network and comes first.
+        """
+        params = [self.LONG_OPTIONS.get(param, param) for param in params]
+        if "-s" in params:
+            idx = params.index("-s")
+            if idx + 1 >= len(params):
+                raise ValueError("Option -s requires an argument")
+            source = str(ipaddress.ip_network(params[idx + 1], strict=False))
+            params = ["-s", source] + params[:idx] + params[idx + 2:]
+
+        return tuple(params)
+
+    @staticmethod
+    def _target(rule: tuple) -> Union[str, None]:
+        for idx, param in enumerate(rule[:-1]):
+            if param in ("-j", "-g"):
+                return rule[idx + 1]
+
+        return None
+
+    @staticmethod
+    def _quote(arg: str) -> str:
+        if arg and not re.search(r'[\s"\'\\#]', arg):
+            return arg
+
+        return '"{}"'.format(arg.replace('\\', '\\\\').replace('"', '\\"'))
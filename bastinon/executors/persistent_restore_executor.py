@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import select
+import threading
+import subprocess
+from typing import Tuple, Union, Dict
+from .command_executor import CommandExecutor
+from .subprocess_executor import SubprocessExecutor
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class RestoreSession:
+    """
+    Long-lived iptables-restore process accepting one transaction after another.
+    iptables-restore commits on every COMMIT, in verbose mode it will echo comment lines back.
+    A comment sent after a transaction is acknowledgement of the transaction being committed.
+    Echoing is confirmed with a probe comment when the process is started.
+    On a failed transaction iptables-restore exits, next transaction will start a new process.
+    """
+    ACK_PREFIX = r"# bastinon-ack"
+    PROBE_TIMEOUT = 5.0
+    # Keep this much of stderr-output of a transaction
+    MAX_STDERR = 65536
+
+    def __init__(self, command: str, timeout: float):
+        self._command = command
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._process = None
+        self._buffer = b""
+        self._stderr = b""
+        self._sequence = 0
+
+    def apply(self, restore_input: bytes) -> Union[Tuple[int, bytes, bytes], None]:
+        """
+        Apply a transaction
+        :param restore_input: iptables-restore input ending with COMMIT
+        :return: tuple: exit code, stdout, stderr. None if iptables-restore won't acknowledge transactions.
+        """
+        with self._lock:
+            if not self._process or self._process.poll() is not None:
+                if not self._start():
+                    return None
+
+            self._stderr = b""
+            self._sequence += 1
+            ack = "{} {}".format(self.ACK_PREFIX, self._sequence).encode('UTF-8')
+            try:
+                self._process.stdin.write(restore_input + ack + b"\n")
+                self._process.stdin.flush()
+            except BrokenPipeError:
+                return self._failed()
+
+            output = []
+            while True:
+                line = self._read_line(self._timeout)
+                if line is None:
+                    return self._failed()
+                if line.rstrip() == ack:
+                    return 0, b"".join(output), self._stderr
+                if not line.startswith(self.ACK_PREFIX.encode('UTF-8')):
+                    output.append(line)
+
+    def close(self) -> None:
+        with self._lock:
+            self._stop()
+
+    def _start(self) -> bool:
+        """
+        Start the process and confirm it acknowledges transactions
+        :return: True if process is usable
+        """
+        self._stop()
+        log.debug("Starting persistent {}".format(self._command))
+        self._process = subprocess.Popen(
+            [self._command, "--noflush", "--verbose"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        self._buffer = b""
+        self._stderr = b""
+
+        # Probe: A comment outside of any transaction needs to be echoed back
+        probe = "{} 0".format(self.ACK_PREFIX).encode('UTF-8')
+        try:
+            self._process.stdin.write(probe + b"\n")
+            self._process.stdin.flush()
+            line = self._read_line(min(self.PROBE_TIMEOUT, self._timeout))
+        except BrokenPipeError:
+            line = None
+        if line is not None and line.rstrip() == probe:
+            return True
+
+        log.warning("Persistent {} won't echo comments, cannot detect committed transactions. "
+                    "Stderr: {}".format(self._command, self._stderr))
+        self._stop()
+
+        return False
+
+    def _stop(self) -> None:
+        if not self._process:
+            return
+        process = self._process
+        self._process = None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            process.wait(timeout=self._timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+    def _read_line(self, timeout: float) -> Union[bytes, None]:
+        """
+        Read a line of output. Stderr is read meanwhile, not to block the process on a full pipe.
+        :param timeout: Seconds to wait for output
+        :return: line, None if process exited or didn't respond in time
+        """
+        fd = self._process.stdout.fileno()
+        err_fd = self._process.stderr.fileno()
+        fds = [fd, err_fd]
+        while b"\n" not in self._buffer:
+            readable, _, _ = select.select(fds, [], [], timeout)
+            if not readable:
+                log.error("Persistent {} didn't respond in {} seconds".format(self._command, timeout))
+                self._process.kill()
+                return None
+            if err_fd in readable:
+                data = os.read(err_fd, 65536)
+                if data:
+                    self._stderr = (self._stderr + data)[-self.MAX_STDERR:]
+                else:
+                    fds = [fd]
+            if fd in readable:
+                data = os.read(fd, 65536)
+                if not data:
+                    return None
+                self._buffer += data
+
+        line, self._buffer = self._buffer.split(b"\n", 1)
+
+        return line + b"\n"
+
+    def _failed(self) -> Tuple[int, bytes, bytes]:
+        process = self._process
+        if process.poll() is None and process.stdin:
+            # Nothing more to come, let the process exit
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        err = self._stderr + process.stderr.read()
+        try:
+            process.wait(timeout=self._timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        returncode = process.returncode if process.returncode else 1
+        log.warning("Persistent {} exited with code {}, it will be restarted".format(self._command, returncode))
+        self._stop()
+
+        return returncode, b"", err
+
+
+class PersistentRestoreExecutor(CommandExecutor):
+    """
+    Keep iptables-restore and ip6tables-restore running between transactions.
+    Process is started once instead of for every change. All other commands are run as child processes.
+    Note: Line numbers in error messages of iptables-restore count all of the lines the process has received.
+    """
+    DEFAULT_TIMEOUT = 30.0
+    RESTORE_COMMANDS = ("iptables-restore", "ip6tables-restore")
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT):
+        """
+        Initialize persistent executor
+        :param timeout: Seconds to wait for a transaction to be acknowledged
+        """
+        self._timeout = timeout
+        self._executor = SubprocessExecutor()
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        # Restore commands not acknowledging transactions
+        self._unsupported = set()
+
+    def which(self, command: str) -> Union[str, None]:
+        return self._executor.which(command)
+
+    def run(self, command: list, stdin: bytes = None) -> Tuple[int, bytes, bytes]:
+        command_path = str(command[0])
+        args = [str(arg) for arg in command[1:]]
+        if os.path.basename(command_path) not in self.RESTORE_COMMANDS or args != ["--noflush"] or stdin is None:
+            return self._executor.run(command, stdin=stdin)
+
+        if command_path in self._unsupported:
+            return self._executor.run(command, stdin=stdin)
+
+        result = self._session(command_path).apply(stdin)
+        if result is None:
+            # Fall back into a process per transaction
+            log.warning("Not keeping {} running, it will be run for every transaction".format(command_path))
+            self._unsupported.add(command_path)
+            return self._executor.run(command, stdin=stdin)
+
+        return result
+
+    def close(self) -> None:
+        """
+        Stop all persistent processes.
+        :return:
+        """
+        with self._sessions_lock:
+            sessions = list(self._sessions.values())
+            self._sessions = {}
+        for session in sessions:
+            session.close()
+
+    def _session(self, command_path: str) -> RestoreSession:
+        with self._sessions_lock:
+            session = self._sessions.get(command_path)
+            if not session:
+                session = RestoreSession(command_path, self._timeout)
+                self._sessions[command_path] = session
+
+        return session
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import shutil
+import subprocess
+from typing import Tuple, Union
+from .command_executor import CommandExecutor
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SubprocessExecutor(CommandExecutor):
+    """
+    Run firewall commands as child processes.
+    """
+
+    def which(self, command: str) -> Union[str, None]:
+        return shutil.which(command)
+
+    def run(self, command: list, stdin: bytes = None) -> Tuple[int, bytes, bytes]:
+        command_str = [str(arg) for arg in command]
+        # XXX Debug noise:
+        # log.debug("Executing: '{}'".format(' '.join(command_str)))
+        p = subprocess.Popen(
+            command_str,
+            stdin=subprocess.PIPE if stdin is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        output, err = p.communicate(input=stdin)
+
+        return p.returncode, output, err
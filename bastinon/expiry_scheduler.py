@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import asyncio
+import heapq
+from datetime import datetime
+from typing import List, Union
+from .base import FirewallBase
+from .rules import RuleReader, RuleAggregator, Rule
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """
+    Remove rules from firewall as they expire.
+    Upcoming expiry times of loaded rules are kept in a min-heap. A single timer is armed for the earliest one.
+    Firewall is changed in the loop's default executor, not to block the loop while firewall commands run.
+    """
+
+    def __init__(self, firewall: FirewallBase, firewall_rules_path: str, loop: asyncio.AbstractEventLoop,
+                 aggregator: RuleAggregator = None):
+        """
+        Initialize expiry scheduler
+        :param firewall: Firewall to remove expired rules from
+        :param firewall_rules_path: User's firewall rules base directory
+        :param loop: Event loop to arm the timer into
+        :param aggregator: (optional) Rules are aggregated, expiry will need a full update
+        """
+        self._firewall = firewall
+        self._firewall_rules_path = firewall_rules_path
+        self._loop = loop
+        self._aggregator = aggregator
+
+        self._rules = []
+        self._expiries = []
+        self._timer = None
+
+    @property
+    def rules(self) -> List[Rule]:
+        """
+        Rules as loaded on last reschedule, including expired ones
+        """
+        return self._rules
+
+    @property
+    def next_expiry(self) -> Union[datetime, None]:
+        """
+        Earliest upcoming expiry in UTC, None if no rule will expire
+        """
+        return self._expiries[0] if self._expiries else None
+
+    def reschedule(self) -> None:
+        """
+        Load rules and arm the timer for the earliest upcoming expiry.
+        Call this whenever rules have changed.
+        :return:
+        """
+        reader = RuleReader(self._firewall_rules_path)
+        self._rules = reader.read_all_users(read_shared_rules=True)
+
+        now = datetime.utcnow()
+        self._expiries = [rule.expiry for rule in self._rules if rule.expiry and rule.expiry >= now]
+        heapq.heapify(self._expiries)
+        self._arm()
+
+    def cancel(self) -> None:
+        """
+        Disarm the timer.
+        :return:
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _arm(self) -> None:
+        self.cancel()
+        if not self._expiries:
+            log.debug("No upcoming rule expiries")
+            return
+
+        delay = max(0.0, (self._expiries[0] - datetime.utcnow()).total_seconds())
+        log.debug("Next rule expires at {} UTC, in {:.0f} seconds".format(self._expiries[0], delay))
+        self._timer = self._loop.call_later(delay, self._expire)
+
+    def _expire(self) -> None:
+        self._timer = None
+
+        # Rule is expired when current time is past its expiry
+        now = datetime.utcnow()
+        expired = 0
+        while self._expiries and self._expiries[0] < now:
+            heapq.heappop(self._expiries)
+            expired += 1
+
+        if not expired:
+            self._arm()
+            return
+
+        log.info("{} rules expired, removing them from firewall".format(expired))
+        rules = self._rules
+        if self._aggregator:
+            # Aggregates need to be rebuilt without the expired rules
+            rules = self._aggregator.aggregate(rules)
+        future = self._loop.run_in_executor(None, self._remove_expired, rules)
+        future.add_done_callback(self._removed)
+
+    def _remove_expired(self, rules: List[Rule]) -> None:
+        # Note: Run in a worker thread
+        with self._firewall.lock:
+            if self._aggregator:
+                self._firewall.set(rules)
+            else:
+                self._firewall.remove_expired(rules)
+
+    def _removed(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception():
+            log.error("Failed to remove expired rules from firewall: {}".format(future.exception()))
+
+        self._arm()
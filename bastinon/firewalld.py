@@ -17,19 +17,339 @@
 #
 # Copyright (c) Jari Turkia
 
-from .base import FirewallBase
+import shlex
+import ipaddress
+from typing import Tuple, Union, List, Dict
+from .base import FirewallBase, EnforcementPlan, PlannedChange
+from .rules import UserRule, Service, FirewallRule
+from .stats import stats
 import logging
 
 log = logging.getLogger(__name__)
 
+# Rich rule key: address family, source network, protocol, port
+RichRuleKey = Tuple[int, Union[ipaddress.IPv4Network, ipaddress.IPv6Network], str, object]
+
 
 class Firewalld(FirewallBase):
+    """
+    Firewalld over its D-Bus API.
+    Every allowed source and service port is a rich rule in a zone, eg.
+    rule priority="1000" family="ipv4" source address="192.0.2.0/24" port port="22" protocol="tcp" accept
+    Rich rules cannot have a comment. Rules managed by us are the ones having our priority.
+    All changes are applied as a single update of runtime zone settings and another of permanent ones.
+    """
+    BUS_NAME = r"org.fedoraproject.FirewallD1"
+    OBJECT_PATH = r"/org/fedoraproject/FirewallD1"
+    ZONE_INTERFACE = r"org.fedoraproject.FirewallD1.zone"
+    CONFIG_OBJECT_PATH = r"/org/fedoraproject/FirewallD1/config"
+    CONFIG_INTERFACE = r"org.fedoraproject.FirewallD1.config"
+    CONFIG_ZONE_INTERFACE = r"org.fedoraproject.FirewallD1.config.zone"
+    RICH_RULES_SETTING = r"rules_str"
+    FIREWALL_CMD = r"firewall-cmd"
+
+    DEFAULT_ZONE = r"public"
+    DEFAULT_PRIORITY = 1000
+    FAMILIES = {4: "ipv4", 6: "ipv6"}
+
+    def __init__(self, services: Dict[str, Service], zone: str = DEFAULT_ZONE, priority: int = DEFAULT_PRIORITY,
+                 permanent: bool = True, bus=None, dbus_types=None):
+        """
+        Initialize firewalld firewall
+        :param services: List of defined services
+        :param zone: Name of firewalld zone to manage rich rules of
+        :param priority: Rich rule priority identifying rules managed by us, must not be 0
+        :param permanent: Apply changes also into permanent configuration
+        :param bus: (optional) D-Bus connection, default: system bus
+        :param dbus_types: (optional) Module having D-Bus types Dictionary and Array, default: python-dbus
+        """
+        super().__init__(services)
+
+        if not zone:
+            raise ValueError("Need valid firewalld zone name!")
+        if not priority or priority < -32768 or priority > 32767:
+            raise ValueError("Rich rule priority {} not allowed! Must be between -32768 and 32767, "
+                             "but not 0.".format(priority))
+
+        if not bus or not dbus_types:
+            # Other firewalls won't need D-Bus
+            import dbus
+            if not bus:
+                bus = dbus.SystemBus()
+            if not dbus_types:
+                dbus_types = dbus
+
+        self._zone_name = zone
+        self.priority = priority
+        self.permanent = permanent
+        self._bus = bus
+        self._dbus_types = dbus_types
+        self._firewalld = self._bus.get_object(self.BUS_NAME, self.OBJECT_PATH)
+
+    #
+    # Abstract implementation for firewalld
+    #
+
+    def query(self, rules: List[UserRule]) -> List[Tuple[UserRule, bool]]:
+        """
+        Query for currently active firewall rules
+        :return: list of tuples, tuple: user rule object, rule in effect
+        """
+        current_rules = self._parse_rich_rules(self._read_runtime_rich_rules())
+
+        rules_out = []
+        for rule in rules:
+            if rule.has_expired():
+                rules_out.append((rule, False))
+                continue
+
+            in_effect = all(key in current_rules for key in self._rule_keys(rule))
+            rules_out.append((rule, in_effect))
+
+        return rules_out
+
+    def query_readable(self, rules: List[UserRule]) -> List[str]:
+        """
+        Query for currently active firewall rules.
+        Match the rules against all users' rules.
+        :param rules: Users' rules
+        :return: list of strings
+        """
+        rules_out = []
+        for rule in rules:
+            prefix = ""
+            if rule.has_expired():
+                # Ah. Expired already.
+                prefix = "# "
+            for key in self._rule_keys(rule):
+                rules_out.append(prefix + self._rich_rule_command("--add-rich-rule", self._rich_rule(key)))
+
+        return rules_out
+
+    @stats.timed("Firewalld.set")
+    def set(self, rules: List[UserRule], force=False) -> None:
+        """
+        Set rules to firewall
+        :param rules: List of firewall rules to set
+        :param force: Force set all rules ignoring any possible existing rules
+        :return:
+        """
+        desired_rules = self._desired_rich_rules(rules)
+
+        to_remove, to_add, rich_rules = self._plan(desired_rules, self._read_runtime_rich_rules(), force)
+        if to_remove or to_add:
+            log.debug("Applying {} runtime rich rule changes into zone {}".format(
+                len(to_remove) + len(to_add), self._zone_name
+            ))
+            self._firewalld.setZoneSettings2(self._zone_name, self._rich_rule_settings(rich_rules),
+                                             dbus_interface=self.ZONE_INTERFACE)
+        else:
+            log.info("No changes needed")
+
+        if not self.permanent:
+            return
+
+        config_zone = self._config_zone()
+        settings = config_zone.getSettings2(dbus_interface=self.CONFIG_ZONE_INTERFACE)
+        to_remove, to_add, rich_rules = self._plan(desired_rules, settings.get(self.RICH_RULES_SETTING, []), force)
+        if to_remove or to_add:
+            log.debug("Applying {} permanent rich rule changes into zone {}".format(
+                len(to_remove) + len(to_add), self._zone_name
+            ))
+            config_zone.update2(self._rich_rule_settings(rich_rules), dbus_interface=self.CONFIG_ZONE_INTERFACE)
+
+    def simulate(self, rules: List[UserRule], force=False) -> Union[bool, List[str]]:
+        """
+        Show what would happen if set rules to firewall
+        :param rules: List of firewall rules to simulate
+        :param force: Force simulate all rules ignoring any possible existing rules
+        :return: list of strings, what firewall would need to do to make rules effective
+        """
+        to_remove, to_add, _ = self._plan(self._desired_rich_rules(rules), self._read_runtime_rich_rules(), force)
+        log.debug("Firewalld simulate(), changes_needed = {}".format(bool(to_remove or to_add)))
+        if not to_remove and not to_add:
+            return False
+
+        commands = [self._rich_rule_command("--remove-rich-rule", rich_rule) for rich_rule in to_remove]
+        commands.extend([self._rich_rule_command("--add-rich-rule", rich_rule) for rich_rule in to_add])
+
+        return commands
+
+    def plan(self, rules: List[UserRule], force=False) -> EnforcementPlan:
+        """
+        Plan what needs to be done to make runtime rich rules effective.
+        No processes are run, the zone is updated over D-Bus. Firewalld will apply the update into kernel.
+        :param rules: List of firewall rules to plan for
+        :param force: Plan for forced update ignoring any possible existing rules
+        :return: plan of changes and their cost
+        """
+        rules_by_key = {}
+        for rule in rules:
+            for key in self._rule_keys(rule):
+                rules_by_key.setdefault(key, rule)
+
+        to_remove, to_add, _ = self._plan(self._desired_rich_rules(rules), self._read_runtime_rich_rules(), force)
+        plan = EnforcementPlan(self.__class__.__name__, force)
+        for action, rich_rules, option in ((PlannedChange.DELETE, to_remove, "--remove-rich-rule"),
+                                           (PlannedChange.APPEND, to_add, "--add-rich-rule")):
+            for rich_rule in rich_rules:
+                command = self._rich_rule_command(option, rich_rule)
+                ip_version, network, proto, port = self._parse_rich_rule(rich_rule)
+                rule = rules_by_key.get((ip_version, network, proto, port))
+                if action == PlannedChange.DELETE or not rule:
+                    # Rich rule has no owner nor comment
+                    source = network.network_address if network.prefixlen == network.max_prefixlen else network
+                    rule = FirewallRule(proto, port, FirewallRule.find_service(proto, port, self.services), source)
+                plan.add(PlannedChange.for_rule(action, ip_version, command, rule))
+
+        plan.kernel_operations = len(plan.changes)
+
+        return plan
+
+    def needs_update(self, rules: List[UserRule]) -> bool:
+        """
+        Query if any rules requested by users are not in effect
+        :param rules: list of user rules
+        :return: bool, True = changes needed, False = all rules effective
+        """
+        to_remove, to_add, _ = self._plan(self._desired_rich_rules(rules), self._read_runtime_rich_rules(), False)
+
+        return bool(to_remove or to_add)
+
+    #
+    # Firewalld internal implementation below
+    #
+
+    def _read_runtime_rich_rules(self) -> List[str]:
+        """
+        Read runtime rich rules of the zone with a single call
+        :return: list of rich rules
+        """
+        settings = self._firewalld.getZoneSettings2(self._zone_name, dbus_interface=self.ZONE_INTERFACE)
+
+        return [str(rich_rule) for rich_rule in settings.get(self.RICH_RULES_SETTING, [])]
+
+    def _config_zone(self):
+        config = self._bus.get_object(self.BUS_NAME, self.CONFIG_OBJECT_PATH)
+        zone_path = config.getZoneByName(self._zone_name, dbus_interface=self.CONFIG_INTERFACE)
+
+        return self._bus.get_object(self.BUS_NAME, zone_path)
+
+    def _rich_rule_settings(self, rich_rules: List[str]) -> dict:
+        # Signature is needed, an empty list cannot be guessed
+        return self._dbus_types.Dictionary({self.RICH_RULES_SETTING: self._dbus_types.Array(rich_rules, signature='s')},
+                                           signature='sv')
+
+    def _rich_rule_command(self, action: str, rich_rule: str) -> str:
+        return "{} --zone={} {}={}".format(self.FIREWALL_CMD, self._zone_name, action, shlex.quote(rich_rule))
+
+    def _rule_keys(self, rule: UserRule) -> List[RichRuleKey]:
+        return [(rule.source_address_family, rule.source_network, proto, port)
+                for proto, port in rule.service.enumerate()]
+
+    def _rich_rule(self, key: RichRuleKey) -> str:
+        """
+        Render a rich rule. Format is the one firewalld uses for listing rich rules.
+        """
+        ip_version, network, proto, port = key
+        if network.prefixlen == network.max_prefixlen:
+            source = network.network_address
+        else:
+            source = network
+
+        return 'rule priority="{}" family="{}" source address="{}" port port="{}" protocol="{}" accept'.format(
+            self.priority, self.FAMILIES[ip_version], source, port, proto
+        )
+
+    def _parse_rich_rule(self, rich_rule: str) -> Union[RichRuleKey, None]:
+        """
+        Parse a rich rule managed by us
+        :param rich_rule: rich rule as listed by firewalld
+        :return: key of the rule, None if rule isn't ours
+        """
+        try:
+            tokens = shlex.split(rich_rule)
+        except ValueError:
+            return None
+
+        elements = []
+        attributes = {}
+        for token in tokens:
+            if '=' in token:
+                name, value = token.split('=', 1)
+                attributes["{}.{}".format(elements[-1] if elements else "", name)] = value
+            else:
+                elements.append(token)
+
+        # Anything but our plain accept from a source to a port isn't ours
+        if elements != ["rule", "source", "port", "accept"]:
+            return None
+        if attributes.get("rule.priority") != str(self.priority):
+            return None
+
+        try:
+            ip_version = {family: ip_version for ip_version, family in self.FAMILIES.items()}[
+                attributes.get("rule.family")]
+            network = ipaddress.ip_network(attributes["source.address"], strict=False)
+            proto = attributes["port.protocol"]
+            port = Service.parse_port(attributes["port.port"])
+        except (KeyError, ValueError):
+            log.warning("Skipping unparseable rich rule: {}".format(rich_rule))
+            return None
+
+        return ip_version, network, proto, port
+
+    def _parse_rich_rules(self, rich_rules: List[str]) -> Dict[RichRuleKey, str]:
+        rules_out = {}
+        for rich_rule in rich_rules:
+            key = self._parse_rich_rule(rich_rule)
+            if key:
+                rules_out[key] = rich_rule
+
+        return rules_out
+
+    def _desired_rich_rules(self, rules: List[UserRule]) -> Dict[RichRuleKey, str]:
+        rules_out = {}
+        for rule in rules:
+            if rule.has_expired():
+                continue
+            if rule.network_size_valid(False) is False:
+                log.warning("Skipping IPv{} network {} of size /{}".format(
+                    rule.source_address_family, rule.source, rule.source_network.prefixlen
+                ))
+                continue
+            for key in self._rule_keys(rule):
+                rules_out[key] = self._rich_rule(key)
+
+        return rules_out
+
+    def _plan(self, desired_rules: Dict[RichRuleKey, str], current_rich_rules: List[str],
+              force: bool) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Plan changes into rich rules of a zone
+        :param desired_rules: rich rules wanted in effect
+        :param current_rich_rules: all rich rules of the zone
+        :param force: Replace all of our rich rules
+        :return: tuple: rich rules to remove, rich rules to add, all rich rules of the zone after changes
+        """
+        current_rules = self._parse_rich_rules(current_rich_rules)
+
+        to_remove = []
+        rich_rules_out = []
+        kept = set()
+        for rich_rule in current_rich_rules:
+            key = self._parse_rich_rule(rich_rule)
+            if key is None:
+                # Not ours, keep as-is
+                rich_rules_out.append(rich_rule)
+            elif force or key not in desired_rules or key in kept:
+                to_remove.append(rich_rule)
+            else:
+                kept.add(key)
+                rich_rules_out.append(rich_rule)
 
-    def __init(self, chain_name: str):
-        self._chain = chain_name
+        to_add = [rich_rule for key, rich_rule in desired_rules.items() if force or key not in current_rules]
+        rich_rules_out.extend(to_add)
 
-    def query(self) -> list:
-        raise NotImplementedError("Get Firewalld rules not implemented yet!")
+        return to_remove, to_add, rich_rules_out
 
-    def set(self) -> list:
-        raise NotImplementedError("Setting Firewalld rules not implemented yet!")
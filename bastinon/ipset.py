@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import io
+import shlex
+import ipaddress
+from hashlib import sha256
+from typing import Tuple, Union, List, Dict
+from .iptables import Iptables
+from .base import EnforcementPlan, PlannedChange
+from .executors import CommandExecutor
+from .stats import stats
+from .rules import UserRule, Service, PortRange
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class IpsetChainRule:
+
+    def __init__(self, rule_number_in_chain: int, set_name: Union[str, None], proto: Union[str, None],
+                 port: Union[int, PortRange, None], rule_spec: List[str] = None):
+        self.rule_number_in_chain = rule_number_in_chain
+        # Arguments after "-A <chain>" as read from the chain
+        self.rule_spec = rule_spec
+        self.set_name = set_name
+        self.proto = proto
+        self.port = port
+
+    def __str__(self) -> str:
+        return "Ipset chain rule {}: {}/{} allowed from set {}".format(
+            self.rule_number_in_chain, self.proto, self.port, self.set_name
+        )
+
+
+class Ipset(Iptables):
+    """
+    Linux IPtables firewall with source addresses kept in ipsets.
+    There is a hash:net -set per service and address family. Chain has a single rule per service port
+    matching the set. Changing the source addresses won't touch the chain.
+    """
+    DEFAULT_SET_PREFIX = r"bastinon"
+    MAX_SET_NAME_LENGTH = 31
+    SWAP_SUFFIX = r"-t"
+
+    def __init__(self, services: Dict[str, Service], chain_name: str, stateful: bool, batch: bool = True,
+                 concurrent: bool = True, set_prefix: str = DEFAULT_SET_PREFIX, delete_by_spec: bool = False,
+                 executor: CommandExecutor = None):
+        """
+        Initialize Linux IPtables firewall using ipsets
+        :param services: List of defined services
+        :param chain_name: Name of IPtables ipchain
+        :param stateful: TCP and UDP, True = -m state --state NEW, False = don't add
+        :param batch: True = apply all changes of an address family as single iptables-restore transaction,
+                      False = run iptables-command for each change
+        :param concurrent: True = read and apply address families in parallel, False = one after another
+        :param set_prefix: Prefix of ipset names managed by this firewall
+        :param delete_by_spec: True = delete chain rules by their specification, False = delete by rule number
+        :param executor: (optional) Runner of iptables- and ipset-commands, default: run commands as child processes
+        """
+        super().__init__(services, chain_name, stateful, batch=batch, concurrent=concurrent,
+                         delete_by_spec=delete_by_spec, executor=executor)
+
+        if not set_prefix:
+            raise ValueError("Need valid ipset name prefix!")
+        self._set_prefix = set_prefix
+        self._ipset_cmd = self.executor.which("ipset")
+        if not self._ipset_cmd:
+            raise ValueError("Cannot find exact location of ipset-command! Failing to continue.")
+
+    #
+    # Abstract implementation for ipset
+    #
+
+    def query(self, rules: List[UserRule]) -> List[Tuple[UserRule, bool]]:
+        """
+        Query for currently active firewall rules
+        :return: list of tuples, tuple: user rule object, rule in effect
+        """
+        current_sets = self._read_sets()
+        chain_rules = self._for_each_family(self._read_set_chain)
+
+        rules_out = []
+        for rule in rules:
+            if rule.has_expired():
+                rules_out.append((rule, False))
+                continue
+
+            set_name = self._set_name(rule.service, rule.source_address_family)
+            in_set = set_name in current_sets and rule.source_network in current_sets[set_name]
+            in_chain = all((set_name, proto, port) in chain_rules[rule.source_address_family]
+                           for proto, port in rule.service.enumerate())
+            rules_out.append((rule, in_set and in_chain))
+
+        return rules_out
+
+    def query_readable(self, rules: List[UserRule]) -> List[str]:
+        """
+        Query for currently active firewall rules.
+        Match the rules against all users' rules.
+        :param rules: Users' rules
+        :return: list of strings
+        """
+        rules_out = []
+        for rule in rules:
+            rule_str = ""
+            if rule.has_expired():
+                # Ah. Expired already.
+                rule_str = "# "
+            set_name = self._set_name(rule.service, rule.source_address_family)
+            rule_str += ' '.join([self._ipset_cmd] + self._set_entry_add(set_name, rule.source_network, rule.comment))
+            rules_out.append(rule_str)
+
+        for ip_version, command in ((4, self._iptables_cmd), (6, self._ip6tables_cmd)):
+            for set_name, (service, _) in sorted(self._desired_sets(rules, ip_version).items()):
+                for rule_out in self._set_rules_to_ipchain_append(set_name, service):
+                    rules_out.append(' '.join(str(r) for r in [command] + rule_out))
+
+        return rules_out
+
+    @stats.timed("Ipset.set")
+    def set(self, rules: List[UserRule], force=False) -> None:
+        """
+        Set rules to firewall
+        :param rules: List of firewall rules to set
+        :param force: Force set all rules ignoring any possible existing rules
+        :return:
+        """
+        set_changes, ipv4_changes, ipv6_changes, sets_to_destroy = self._plan(rules, force)
+        if not set_changes and not ipv4_changes and not ipv6_changes and not sets_to_destroy:
+            log.info("No changes needed")
+            return
+
+        # Sets need to exist before chain can refer to them
+        self._apply_set_changes(set_changes)
+
+        self._apply_changes({4: ipv4_changes, 6: ipv6_changes})
+
+        # Sets can be destroyed only after chain doesn't refer to them
+        self._apply_set_changes([["destroy", set_name] for set_name in sets_to_destroy])
+
+    def simulate(self, rules: List[UserRule], force=False) -> Union[bool, List[str]]:
+        """
+        Show what would happen if set rules to firewall
+        :param rules: List of firewall rules to simulate
+        :param force: Force simulate all rules ignoring any possible existing rules
+        :return: list of strings, what firewall would need to do to make rules effective
+        """
+        set_changes, ipv4_changes, ipv6_changes, sets_to_destroy = self._plan(rules, force)
+        changes_needed = bool(set_changes or ipv4_changes or ipv6_changes or sets_to_destroy)
+        log.debug("Ipset simulate(), changes_needed = {}".format(changes_needed))
+        if not changes_needed:
+            return False
+
+        rules_out = []
+        for change in set_changes:
+            rules_out.append(' '.join(str(r) for r in [self._ipset_cmd] + change))
+        for change in ipv4_changes:
+            rules_out.append(' '.join(str(r) for r in [self._iptables_cmd] + change))
+        for change in ipv6_changes:
+            rules_out.append(' '.join(str(r) for r in [self._ip6tables_cmd] + change))
+        for set_name in sets_to_destroy:
+            rules_out.append(' '.join([self._ipset_cmd, "destroy", set_name]))
+
+        return rules_out
+
+    def plan(self, rules: List[UserRule], force=False) -> EnforcementPlan:
+        """
+        Plan what needs to be done to make rules effective.
+        Set entries are sources of rules. Chain rules match sets, changing them is a chain operation.
+        Processes are reading sets and chains and a restore for set changes and for each address family.
+        :param rules: List of firewall rules to plan for
+        :param force: Plan for forced update ignoring any possible existing rules
+        :return: plan of changes and their cost
+        """
+        set_changes, ipv4_changes, ipv6_changes, sets_to_destroy = self._plan(rules, force)
+        plan = EnforcementPlan(self.__class__.__name__, force)
+        if not set_changes and not ipv4_changes and not ipv6_changes and not sets_to_destroy:
+            return plan
+
+        # Name of a set tells the service and address family of its entries
+        set_services = {}
+        for service in self.services.values():
+            for ip_version in self.IP_VERSIONS:
+                set_name = self._set_name(service, ip_version)
+                set_services[set_name] = (service, ip_version)
+                set_services[set_name + self.SWAP_SUFFIX] = (service, ip_version)
+        owners = {}
+        for rule in rules:
+            key = (rule.service.code, rule.source_address_family, rule.source_network)
+            owners.setdefault(key, set()).update(PlannedChange.rule_owners(rule))
+
+        actions = {"add": PlannedChange.APPEND, "del": PlannedChange.DELETE}
+        for change in set_changes:
+            command = ' '.join(str(r) for r in [self._ipset_cmd] + change)
+            service, ip_version = set_services.get(change[1], (None, None))
+            if change[0] not in actions or not service:
+                plan.add(PlannedChange(PlannedChange.CHAIN, ip_version, command))
+                continue
+
+            network = ipaddress.ip_network(change[2])
+            comment = change[change.index("comment", 3) + 1] if "comment" in change[3:] else None
+            plan.add(PlannedChange(actions[change[0]], ip_version, command, service_code=service.code,
+                                   source=str(network), comment=comment,
+                                   owners=sorted(owners.get((service.code, ip_version, network), []))))
+        for ip_version, changes in ((4, ipv4_changes), (6, ipv6_changes)):
+            for change in changes:
+                self._plan_change(plan, ip_version, PlannedChange.CHAIN, change)
+        for set_name in sets_to_destroy:
+            plan.add(PlannedChange(PlannedChange.CHAIN, set_services.get(set_name, (None, None))[1],
+                                   ' '.join([self._ipset_cmd, "destroy", set_name])))
+
+        plan.kernel_operations = len(plan.changes)
+        # Sets and both chains are read
+        plan.processes = 1 + len(self.IP_VERSIONS)
+        plan.processes += (1 if set_changes else 0) + (1 if sets_to_destroy else 0)
+        for changes in (ipv4_changes, ipv6_changes):
+            if changes:
+                plan.processes += 1 if self.batch else len(changes)
+
+        return plan
+
+    def remove_expired(self, rules: List[UserRule]) -> None:
+        """
+        Remove expired rules from firewall.
+        Expired sources are removed from sets by a regular update, chain won't need changes.
+        :param rules: list of user rules, both expired and non-expired
+        :return:
+        """
+        self.set(rules)
+
+    def query_counters(self, rules: List[UserRule]) -> List[Tuple[UserRule, int, int]]:
+        """
+        Query for packet and byte counters of rules in effect.
+        Chain rules match sets, not sources. Counters of a source cannot be told apart.
+        :param rules: Users' rules
+        :return:
+        """
+        raise NotImplementedError("Rule counters not supported by {}!".format(self.__class__.__name__))
+
+    def needs_update(self, rules: List[UserRule]) -> bool:
+        """
+        Query if any rules requested by users are not in effect
+        :param rules: list of user rules
+        :return: bool, True = changes needed, False = all rules effective
+        """
+        set_changes, ipv4_changes, ipv6_changes, sets_to_destroy = self._plan(rules, False)
+
+        return bool(set_changes or ipv4_changes or ipv6_changes or sets_to_destroy)
+
+    #
+    # ipset internal implementation below
+    #
+
+    def _set_name(self, service: Service, ip_version: int) -> str:
+        """
+        Name of the set for a service and address family.
+        Long names are shortened with a digest to fit into ipset name length limit.
+        """
+        set_name = "{}-{}-v{}".format(self._set_prefix, service.code, ip_version)
+        max_length = self.MAX_SET_NAME_LENGTH - len(self.SWAP_SUFFIX)
+        if len(set_name) > max_length:
+            digest = sha256(service.code.encode('UTF-8')).hexdigest()[:8]
+            set_name = "{}-{}-v{}".format(self._set_prefix, digest, ip_version)
+            if len(set_name) > max_length:
+                raise ValueError("Ipset prefix '{}' is too long!".format(self._set_prefix))
+
+        return set_name
+
+    def _desired_sets(self, rules: List[UserRule], ip_version: int) -> Dict[
+        str, Tuple[Service, Dict[Union[ipaddress.IPv4Network, ipaddress.IPv6Network], Union[str, None]]]
+    ]:
+        """
+        Group user rules into sets.
+        :return: dict, key: set name, value: tuple: service, dict of set entries and their comments
+        """
+        sets_out = {}
+        for rule in rules:
+            if rule.source_address_family != ip_version:
+                continue
+            if rule.comment and len(rule.comment) > 255:
+                raise ValueError("Ipset comment can only be 255 characters long. Got: {}".format(len(rule.comment)))
+            if rule.has_expired():
+                continue
+            if rule.network_size_valid(False) is False or rule.source_network.prefixlen == 0:
+                log.warning("Skipping IPv{} network {} of size /{}".format(
+                    rule.source_address_family, rule.source, rule.source_network.prefixlen
+                ))
+                continue
+
+            set_name = self._set_name(rule.service, ip_version)
+            if set_name not in sets_out:
+                sets_out[set_name] = (rule.service, {})
+            # First rule for a network will decide the comment
+            sets_out[set_name][1].setdefault(rule.source_network, rule.comment)
+
+        return sets_out
+
+    def _plan(self, rules: List[UserRule], force: bool) -> Tuple[List[list], List[list], List[list], List[str]]:
+        """
+        Plan the changes needed to make the rules effective.
+        :return: ipset restore commands, IPv4 chain changes, IPv6 chain changes, sets to destroy
+        """
+        current_sets = self._read_sets()
+        active_chains = self._for_each_family(self._read_set_chain)
+        set_changes = []
+        chain_changes = {}
+        sets_in_use = set()
+
+        for ip_version in self.IP_VERSIONS:
+            family = "inet" if ip_version == 4 else "inet6"
+            desired_sets = self._desired_sets(rules, ip_version)
+            sets_in_use.update(desired_sets.keys())
+
+            # Set contents
+            for set_name, (service, entries) in sorted(desired_sets.items()):
+                if force or set_name not in current_sets:
+                    # Fill a fresh set and swap it in place
+                    temp_set_name = set_name + self.SWAP_SUFFIX
+                    set_changes.append(["create", set_name, "hash:net", "family", family, "comment", "-exist"])
+                    set_changes.append(["create", temp_set_name, "hash:net", "family", family, "comment", "-exist"])
+                    set_changes.append(["flush", temp_set_name])
+                    for network, comment in entries.items():
+                        set_changes.append(self._set_entry_add(temp_set_name, network, comment))
+                    set_changes.append(["swap", temp_set_name, set_name])
+                    set_changes.append(["destroy", temp_set_name])
+                    continue
+
+                current_entries = current_sets[set_name]
+                for network in current_entries:
+                    if network not in entries:
+                        set_changes.append(["del", set_name, str(network), "-exist"])
+                for network, comment in entries.items():
+                    if network not in current_entries or current_entries[network] != comment:
+                        set_changes.append(self._set_entry_add(set_name, network, comment))
+
+            # Chain rules
+            chain_rules = active_chains[ip_version]
+            desired_chain_rules = []
+            for set_name, (service, _) in sorted(desired_sets.items()):
+                for proto, port in service.enumerate():
+                    desired_chain_rules.append((set_name, proto, port))
+
+            changes = []
+            if force:
+                changes.append(["-F", self._chain])
+                rules_to_add = desired_chain_rules
+            else:
+                # Any rule not matching a desired set rule will be removed. Duplicates too.
+                desired_keys = set(desired_chain_rules)
+                for chain_rule_key, chain_rule in sorted(chain_rules.items(),
+                                                         key=lambda x: x[1].rule_number_in_chain, reverse=True):
+                    if chain_rule_key not in desired_keys:
+                        if self.delete_by_spec:
+                            changes.append(["-D", self._chain] + chain_rule.rule_spec)
+                        else:
+                            changes.append(["-D", self._chain, chain_rule.rule_number_in_chain])
+                rules_to_add = [r for r in desired_chain_rules if r not in chain_rules]
+
+            for set_name, proto, port in rules_to_add:
+                service = desired_sets[set_name][0]
+                changes.extend(self._set_rules_to_ipchain_append(set_name, service, only=(proto, port)))
+            chain_changes[ip_version] = changes
+
+        # Sets ending with the swap suffix are left-overs of a failed swap
+        sets_to_destroy = sorted(set_name for set_name in current_sets if set_name not in sets_in_use)
+
+        return set_changes, chain_changes[4], chain_changes[6], sets_to_destroy
+
+    def _set_entry_add(self, set_name: str, network: Union[ipaddress.IPv4Network, ipaddress.IPv6Network],
+                       comment: Union[str, None]) -> list:
+        entry = ["add", set_name, str(network)]
+        if comment:
+            entry.extend(["comment", comment])
+        entry.append("-exist")
+
+        return entry
+
+    def _set_rules_to_ipchain_append(self, set_name: str, service: Service, only: Tuple[str, int] = None) -> List[list]:
+        ipchain_rules = []
+        for proto, port in service.enumerate():
+            if only and (proto, port) != only:
+                continue
+
+            ipchain_rule = [
+                "-A", self._chain, "-p", proto, "-m", proto, "--dport", self._dport(port),
+                "-m", "set", "--match-set", set_name, "src"
+            ]
+            if self.stateful:
+                # Docs: https://ipset.netfilter.org/iptables-extensions.man.html#lbCC
+                ipchain_rule.extend(["-m", "state", "--state", "NEW"])
+            ipchain_rule.extend(["-j", "ACCEPT"])
+            ipchain_rules.append(ipchain_rule)
+
+        return ipchain_rules
+
+    def _apply_set_changes(self, changes: List[list]) -> None:
+        """
+        Apply set changes in a single ipset restore run.
+        """
+        if not changes:
+            return
+
+        lines = [' '.join(self._restore_quote(str(arg)) for arg in change) for change in changes]
+        lines.append("COMMIT")
+        restore_input = ('\n'.join(lines) + '\n').encode('UTF-8')
+
+        log.debug("Applying {} ipset changes".format(len(changes)))
+        returncode, output, err = self._exec_command([self._ipset_cmd, "restore"], stdin=restore_input)
+        if returncode != 0:
+            raise RuntimeError("Failed to apply ipset changes. "
+                               "Exit code: {} Stderr: {}".format(returncode, err))
+
+    def _read_sets(self) -> Dict[str, Dict[Union[ipaddress.IPv4Network, ipaddress.IPv6Network], Union[str, None]]]:
+        """
+        Read all sets managed by us.
+        :return: dict, key: set name, value: dict of set entries and their comments
+        """
+        returncode, output, err = self._exec_command([self._ipset_cmd, "save"])
+        if returncode != 0:
+            raise RuntimeError("Failed to query for ipsets. "
+                               "Exit code: {} Command: {} Stdout: {} Stderr: {}".format(
+                returncode, self._ipset_cmd, output, err
+            ))
+
+        """
+create bastinon-ssh-v4 hash:net family inet hashsize 1024 maxelem 65536 comment
+add bastinon-ssh-v4 192.0.2.0/24 comment "Office"
+add bastinon-ssh-v4 203.0.113.15
+        """
+        set_prefix = "{}-".format(self._set_prefix)
+        sets_out = {}
+        for line in io.StringIO(output.decode('UTF-8')):
+            try:
+                args = shlex.split(line)
+            except ValueError:
+                raise ValueError("Ipset output error! Line cannot be parsed: '{}'".format(line.strip()))
+            if len(args) < 2 or not args[1].startswith(set_prefix):
+                continue
+
+            if args[0] == "create":
+                sets_out[args[1]] = {}
+            elif args[0] == "add":
+                if len(args) < 3:
+                    raise ValueError("Ipset output error! Entry cannot be parsed: '{}'".format(line.strip()))
+                comment = None
+                if "comment" in args[3:]:
+                    comment = args[args.index("comment", 3) + 1]
+                sets_out.setdefault(args[1], {})[ipaddress.ip_network(args[2])] = comment
+
+        return sets_out
+
+    def _read_set_chain(self, ip_version: int) -> Dict[Tuple[str, str, int], IpsetChainRule]:
+        """
+        Read rules of our chain.
+        :return: dict, key: tuple: set name, protocol, port, value: chain rule
+        """
+        snapshot = self._read_snapshot(ip_version)
+        rule_prefix = "-A {} ".format(self._chain)
+        rule_num = 0
+        rules_out = {}
+        for line in io.StringIO(snapshot):
+            if not line.startswith(rule_prefix):
+                continue
+
+            # Rule position in chain is the order of appearance
+            rule_num += 1
+            args = shlex.split(line)
+            set_name = self._arg_value(args, "--match-set")
+            proto = self._arg_value(args, "-p")
+            port = self._arg_value(args, "--dport")
+            if port is not None:
+                port = self._parse_dport(port)
+            if self._arg_value(args, "-j") != "ACCEPT" or "!" in args or "-s" in args:
+                set_name = None
+            chain_rule = IpsetChainRule(rule_num, set_name, proto, port, rule_spec=args[2:])
+            rules_out.setdefault((set_name, proto, port), chain_rule)
+            if rules_out[(set_name, proto, port)] is not chain_rule:
+                # Duplicate rule, key it by its number so it won't match anything
+                rules_out[(None, None, rule_num)] = chain_rule
+
+        return rules_out
+
+    @staticmethod
+    def _arg_value(args: List[str], option: str) -> Union[str, None]:
+        if option not in args:
+            return None
+        idx = args.index(option)
+        if idx + 1 >= len(args):
+            return None
+
+        return args[idx + 1]
@@ -18,14 +18,19 @@
 # Copyright (c) Jari Turkia
 
 import io
-import subprocess
-import shutil
-from typing import Tuple, Optional, Union, List, Any, Dict
+import copy
+from hashlib import sha256
+from typing import Tuple, Optional, Union, List, Any, Dict, Callable
+from concurrent.futures import ThreadPoolExecutor
 import re
+import shlex
 import ipaddress
+from datetime import datetime
 from abc import ABC, abstractmethod
-from .base import FirewallBase
-from .rules import Rule, UserRule, SharedRule, FirewallRule, Service
+from .base import FirewallBase, EnforcementPlan, PlannedChange
+from .executors import CommandExecutor
+from .stats import stats
+from .rules import Rule, UserRule, SharedRule, FirewallRule, Service, PortRange
 import logging
 
 log = logging.getLogger(__name__)
@@ -33,11 +38,17 @@ log = logging.getLogger(__name__)
 
 class IptablesRule(FirewallRule):
 
-    def __init__(self, rule_number_in_chain: int, proto: str, port: int, service: Service, source_address,
-                 comment: str = None):
+    def __init__(self, rule_number_in_chain: int, proto: str, port: Union[int, PortRange, Tuple], service: Service,
+                 source_address, comment: str = None, packet_count: int = None, byte_count: int = None,
+                 rule_spec: List[str] = None):
         super().__init__(proto, port, service, source_address, comment=comment)
         self.rule_number_in_chain = rule_number_in_chain
+        # Arguments after "-A <chain>" as read from the chain
+        self.rule_spec = rule_spec
         self.expiry = None
+        # Counters are known only if chain was read with them
+        self.packet_count = packet_count
+        self.byte_count = byte_count
 
 
 class MatchedIptablesRule(ABC):
@@ -85,27 +96,66 @@ class MatchedIptablesSharedRule(MatchedIptablesRule, SharedRule):
 
 
 class Iptables(FirewallBase):
-
-    def __init__(self, services: Dict[str, Service], chain_name: str, stateful: bool):
+    IP_VERSIONS = (4, 6)
+    # Docs: https://ipset.netfilter.org/iptables-extensions.man.html#lbBM
+    # A port range counts as two ports
+    MULTIPORT_MAX_PORTS = 15
+    SHADOW_CHAIN_SUFFIX = r"-B"
+    # iptables-save -c prefixes rules with their counters: [packets:bytes]
+    COUNTERS_RE = re.compile(r"^\[(\d+):(\d+)\] ")
+
+    def __init__(self, services: Dict[str, Service], chain_name: str, stateful: bool, batch: bool = True,
+                 concurrent: bool = True, multiport: bool = False, shadow_rebuild: bool = False,
+                 delete_by_spec: bool = False, executor: CommandExecutor = None):
         """
         Initialize Linux IPtables firewall
         :param services: List of defined services
         :param chain_name: Name of IPtables ipchain
         :param stateful: TCP and UDP, True = -m state --state NEW, False = don't add
+        :param batch: True = apply all changes of an address family as single iptables-restore transaction,
+                      False = run iptables-command for each change
+        :param concurrent: True = read and apply address families in parallel, False = one after another
+        :param multiport: True = single -m multiport rule per source and protocol, False = rule per port
+        :param shadow_rebuild: Forced update, True = fill a shadow chain and swap the jump into it,
+                               False = flush the chain and fill it
+        :param delete_by_spec: True = delete rules by their specification, False = delete by rule number
+        :param executor: (optional) Runner of iptables-commands, default: run commands as child processes
         """
-        super().__init__(services)
+        super().__init__(services, executor)
 
         if not chain_name:
             raise ValueError("Need valid IPtables chain name!")
         self._chain = chain_name
-        self._iptables_cmd = shutil.which("iptables")
+        self._shadow_chain = chain_name + self.SHADOW_CHAIN_SUFFIX
+        # Chain in effect per IP-version. Either the chain or its shadow, whichever is being jumped into.
+        self._active_chains = {}
+        self._iptables_cmd = self.executor.which("iptables")
         if not self._iptables_cmd:
             raise ValueError("Cannot find exact location of iptables-command! Failing to continue.")
-        self._ip6tables_cmd = shutil.which("ip6tables")
+        self._ip6tables_cmd = self.executor.which("ip6tables")
         if not self._ip6tables_cmd:
             raise ValueError("Cannot find exact location of ip6tables-command! Failing to continue.")
+        self._iptables_save_cmd = self.executor.which("iptables-save")
+        if not self._iptables_save_cmd:
+            raise ValueError("Cannot find exact location of iptables-save-command! Failing to continue.")
+        self._ip6tables_save_cmd = self.executor.which("ip6tables-save")
+        if not self._ip6tables_save_cmd:
+            raise ValueError("Cannot find exact location of ip6tables-save-command! Failing to continue.")
+        self._iptables_restore_cmd = self.executor.which("iptables-restore")
+        self._ip6tables_restore_cmd = self.executor.which("ip6tables-restore")
+        if batch and (not self._iptables_restore_cmd or not self._ip6tables_restore_cmd):
+            log.warning("Cannot find exact location of iptables-restore or ip6tables-restore -command! "
+                        "Falling back to running a command per rule.")
+            batch = False
 
         self.stateful = stateful
+        self.batch = batch
+        self.concurrent = concurrent
+        self.multiport = multiport
+        self.shadow_rebuild = shadow_rebuild
+        self.delete_by_spec = delete_by_spec
+        # Fingerprint of rules and chains known to be in sync, see _fingerprint()
+        self._in_sync_fingerprint = None
 
     #
     # Abstract implementation for IPtables
@@ -133,6 +183,10 @@ class Iptables(FirewallBase):
         if ipv6_rules_to_add:
             rules_out.extend([(r, False) for r in ipv6_rules_to_add])
 
+        # Expired rules are never in effect
+        now = datetime.utcnow()
+        rules_out.extend([(r, False) for r in rules if r.has_expired(now)])
+
         return rules_out
 
     def query_readable(self, rules: List[UserRule]) -> List[str]:
@@ -186,6 +240,7 @@ class Iptables(FirewallBase):
 
         return rules_out
 
+    @stats.timed("Iptables.set")
     def set(self, rules: List[UserRule], force=False) -> None:
         """
         Set rules to firewall
@@ -193,8 +248,9 @@ class Iptables(FirewallBase):
         :param force: Force set all rules ignoring any possible existing rules
         :return:
         """
-        _, ipv4_rules_to_remove, ipv4_rules_to_add, \
-        _, ipv6_rules_to_remove, ipv6_rules_to_add, \
+        self._in_sync_fingerprint = None
+        ipv4_rules_matched, ipv4_rules_to_remove, ipv4_rules_to_add, \
+        ipv6_rules_matched, ipv6_rules_to_remove, ipv6_rules_to_add, \
         changes_needed = \
             self._sync_rules(rules, force)
 
@@ -202,64 +258,17 @@ class Iptables(FirewallBase):
             log.info("No changes needed")
             return
 
-        def _exec_helper(rule_out: list) -> Tuple[subprocess.Popen, bytes, bytes]:
-            rule_out_str = [str(out) for out in rule_out]
-            # XXX Debug noise:
-            # log.debug("Executing: '{}'".format(' '.join(rule_out_str)))
-            p = subprocess.Popen(
-                rule_out_str,
-                stdout=subprocess.PIPE)
-            output, err = p.communicate()
-
-            return p, output, err
-
-        if force:
-            # Forced update
-            # Flush the chains first
-            rule_out = [self._iptables_cmd, "-F", self._chain]
-            p, output, err = _exec_helper(rule_out)
-            if p.returncode != 0:
-                raise RuntimeError("Failed to flush IPtables IPv4 chain {}".format(self._chain))
+        changes = {
+            4: self._rules_to_ipchain_changes(4, ipv4_rules_to_remove, ipv4_rules_to_add, force),
+            6: self._rules_to_ipchain_changes(6, ipv6_rules_to_remove, ipv6_rules_to_add, force)
+        }
+        self._apply_changes(changes)
 
-            rule_out = [self._ip6tables_cmd, "-F", self._chain]
-            p, output, err = _exec_helper(rule_out)
-            if p.returncode != 0:
-                raise RuntimeError("Failed to flush IPtables IPv6 chain {}".format(self._chain))
-
-        # IPv4:
-        # Apply deletion in reverse order. As we'll progress from highest number to lowest,
-        # IPtables rule order won't change in the process.
-        for rule in sorted(ipv4_rules_to_remove, key=lambda x: x.rule_number_in_chain, reverse=True):
-            rule_out = self._rule_to_ipchain_delete(4, rule, with_command=True)
-            if rule_out:
-                p, output, err = _exec_helper(rule_out)
-                if p.returncode != 0:
-                    raise RuntimeError("Failed to delete IPtables IPv4 rule #{}".format(rule.rule_number_in_chain))
-
-        # Rules will be appended to the end of the chain
-        for rule in ipv4_rules_to_add:
-            service_rules = self._rule_to_ipchain_append(4, rule, with_command=True)
-            for rule_out in service_rules:
-                p, output, err = _exec_helper(rule_out)
-                if p.returncode != 0:
-                    raise RuntimeError("Failed to add IPtables IPv4 rule: '{}'".format(str(rule)))
-
-        # IPv6:
-        # Exactly same processing as for IPv4-rules
-        for rule in sorted(ipv6_rules_to_remove, key=lambda x: x.rule_number_in_chain, reverse=True):
-            rule_out = self._rule_to_ipchain_delete(6, rule, with_command=True)
-            if rule_out:
-                p, output, err = _exec_helper(rule_out)
-                if p.returncode != 0:
-                    raise RuntimeError("Failed to delete IPtables IPv6 rule #{}".format(rule.rule_number_in_chain))
-
-        # Exactly same processing as for IPv4-rules
-        for rule in ipv6_rules_to_add:
-            service_rules = self._rule_to_ipchain_append(6, rule, with_command=True)
-            for rule_out in service_rules:
-                p, output, err = _exec_helper(rule_out)
-                if p.returncode != 0:
-                    raise RuntimeError("Failed to add IPtables IPv6 rule: '{}'".format(str(rule)))
+        # Chains should now be in sync with the rules. They aren't read again here, next needs_update()
+        # will match its snapshot once and remember the fingerprint.
+        for ip_version, family_matched, family_to_add in ((4, ipv4_rules_matched, ipv4_rules_to_add),
+                                                          (6, ipv6_rules_matched, ipv6_rules_to_add)):
+            stats.set_gauge("Iptables.effective_rules.v{}".format(ip_version), len(family_matched) + len(family_to_add))
 
     def simulate(self, rules: List[UserRule], force=False) -> Union[bool, List[str]]:
         """
@@ -280,38 +289,147 @@ class Iptables(FirewallBase):
         rules_out = []
 
         # IPv4:
-        for rule in sorted(ipv4_rules_to_remove, key=lambda x: x.rule_number_in_chain, reverse=True):
-            rule_out = self._rule_to_ipchain_delete(4, rule, with_command=True)
-            if rule_out:
-                rule_str = ' '.join(str(r) for r in rule_out)
-                rules_out.append(rule_str)
-        for rule in ipv4_rules_to_add:
-            service_rules = self._rule_to_ipchain_append(4, rule, with_command=True)
-            for rule_out in service_rules:
-                rule_str = ' '.join(str(r) for r in rule_out)
-                rules_out.append(rule_str)
+        for rule_out in self._rules_to_ipchain_changes(4, ipv4_rules_to_remove, ipv4_rules_to_add, force):
+            rule_str = ' '.join(str(r) for r in [self._iptables_cmd] + rule_out)
+            rules_out.append(rule_str)
 
         # IPv6:
-        for rule in sorted(ipv6_rules_to_remove, key=lambda x: x.rule_number_in_chain, reverse=True):
-            rule_out = self._rule_to_ipchain_delete(6, rule, with_command=True)
-            if rule_out:
-                rule_str = ' '.join(str(r) for r in rule_out)
-                rules_out.append(rule_str)
-        for rule in ipv6_rules_to_add:
-            service_rules = self._rule_to_ipchain_append(6, rule, with_command=True)
-            for rule_out in service_rules:
-                rule_str = ' '.join(str(r) for r in rule_out)
-                rules_out.append(rule_str)
+        for rule_out in self._rules_to_ipchain_changes(6, ipv6_rules_to_remove, ipv6_rules_to_add, force):
+            rule_str = ' '.join(str(r) for r in [self._ip6tables_cmd] + rule_out)
+            rules_out.append(rule_str)
 
         return rules_out
 
+    def plan(self, rules: List[UserRule], force=False) -> EnforcementPlan:
+        """
+        Plan what needs to be done to make rules effective.
+        Processes are the chain reads and the changes as done by set().
+        :param rules: List of firewall rules to plan for
+        :param force: Plan for forced update ignoring any possible existing rules
+        :return: plan of changes and their cost
+        """
+        _, ipv4_rules_to_remove, ipv4_rules_to_add, \
+        _, ipv6_rules_to_remove, ipv6_rules_to_add, \
+        changes_needed = \
+            self._sync_rules(rules, force)
+
+        plan = EnforcementPlan(self.__class__.__name__, force)
+        if not changes_needed:
+            return plan
+
+        # Chains are read once before the changes
+        plan.processes = len(self.IP_VERSIONS)
+        for ip_version, rules_to_remove, rules_to_add in ((4, ipv4_rules_to_remove, ipv4_rules_to_add),
+                                                          (6, ipv6_rules_to_remove, ipv6_rules_to_add)):
+            changes = self._rules_to_ipchain_changes(ip_version, rules_to_remove, rules_to_add, force, plan=plan)
+            plan.kernel_operations += len(changes)
+            if changes:
+                plan.processes += 1 if self.batch else len(changes)
+
+        return plan
+
+    @stats.timed("Iptables.remove_expired")
+    def remove_expired(self, rules: List[UserRule]) -> None:
+        """
+        Remove expired rules from firewall.
+        Only active rules of expired rules are deleted, no other changes are made.
+        :param rules: list of user rules, both expired and non-expired
+        :return:
+        """
+        now = datetime.utcnow()
+        live = set()
+        expired = set()
+        for rule in rules:
+            identity = rule.identity()
+            if rule.has_expired(now):
+                expired.add(identity)
+                expired.add(identity[:-1])
+            else:
+                live.add(identity)
+                live.add(identity[:-1])
+        if not expired:
+            return
+
+        self._in_sync_fingerprint = None
+
+        def _remove(ip_version: int) -> int:
+            rules_to_remove = []
+            for active_rule in self._read_chain(ip_version):
+                # Same matching as in sync: Active rule without a comment will match a rule with any comment.
+                identity = active_rule.identity()
+                if not active_rule.comment:
+                    identity = identity[:-1]
+                if identity in expired and identity not in live:
+                    rules_to_remove.append(active_rule)
+
+            changes = [self._rule_to_ipchain_delete(ip_version, rule)
+                       for rule in sorted(rules_to_remove, key=lambda x: x.rule_number_in_chain, reverse=True)]
+            if self.batch:
+                self._apply_batch(ip_version, changes)
+            else:
+                self._apply_one_by_one(ip_version, changes)
+
+            return len(changes)
+
+        removed = self._for_each_family(_remove)
+        log.info("Removed {} IPv4 and {} IPv6 rules of expired rules".format(removed[4], removed[6]))
+
+    @stats.timed("Iptables.query_counters")
+    def query_counters(self, rules: List[UserRule]) -> List[Tuple[UserRule, int, int]]:
+        """
+        Query for packet and byte counters of rules in effect.
+        Active rules are matched as in sync. Counters of all active rules of a rule are summed,
+        eg. a service having multiple ports has a rule per port.
+        Rules having the same identity, eg. same source and service allowed by two users, share a single active
+        rule. All of them are credited with its counters.
+        :param rules: Users' rules
+        :return: list of tuples, tuple: user rule object, packets, bytes. Only rules in effect are listed.
+        """
+        rule_index = {}
+        rule_index_without_comment = {}
+        now = datetime.utcnow()
+        for idx, rule in enumerate(rules):
+            if rule.has_expired(now):
+                continue
+            identity = rule.identity()
+            rule_index.setdefault(identity, []).append(idx)
+            rule_index_without_comment.setdefault(identity[:-1], []).append(idx)
+
+        counters = {}
+        snapshots = self._for_each_family(lambda ip_version: self._read_snapshot(ip_version, counters=True))
+        for ip_version in self.IP_VERSIONS:
+            for active_rule in self._parse_chain(ip_version, snapshots[ip_version]):
+                identity = active_rule.identity()
+                if active_rule.comment:
+                    matching_rules = rule_index.get(identity)
+                else:
+                    matching_rules = rule_index_without_comment.get(identity[:-1])
+                if not matching_rules or active_rule.packet_count is None:
+                    continue
+
+                for idx in matching_rules:
+                    packet_count, byte_count = counters.get(idx, (0, 0))
+                    counters[idx] = (packet_count + active_rule.packet_count, byte_count + active_rule.byte_count)
+
+        return [(rules[idx], packet_count, byte_count) for idx, (packet_count, byte_count) in sorted(counters.items())]
+
+    @stats.timed("Iptables.needs_update")
     def needs_update(self, rules: List[UserRule]) -> bool:
         """
         Query if any rules requested by users are not in effect
         :param rules: list of user rules
         :return: bool, True = changes needed, False = all rules effective
         """
-        _, _, _, _, _, _, changes_needed = self._sync_rules(rules, False)
+        # Compare fingerprints first. If neither rules nor chains have changed since they were last
+        # known to be in sync, there is no need to parse and match the chains.
+        snapshots = self._for_each_family(self._read_snapshot)
+        fingerprint = self._fingerprint(rules, snapshots)
+        if self._in_sync_fingerprint and fingerprint == self._in_sync_fingerprint:
+            log.debug("Rules and chains unchanged since last sync")
+            return False
+
+        _, _, _, _, _, _, changes_needed = self._do_sync_rules(rules, snapshots)
+        self._in_sync_fingerprint = None if changes_needed else fingerprint
 
         return changes_needed
 
@@ -334,7 +452,10 @@ class Iptables(FirewallBase):
         ipv6_rules_to_add = []
         ipv6_rules_to_remove = []
 
+        now = datetime.utcnow()
         for idx, rule in enumerate(user_rules):
+            if rule.has_expired(now):
+                continue
             if rule.network_size_valid(False) is False:
                 log.warning("Skipping IPv{} network {} of size /{}".format(
                     rule.source_address_family, rule.source, rule.source_address.prefixlen
@@ -356,110 +477,128 @@ class Iptables(FirewallBase):
                ipv6_rules_matched, ipv6_rules_to_remove, ipv6_rules_to_add, \
                True
 
-    def _do_sync_rules(self, user_rules: List[UserRule]) -> Tuple[
+    @stats.timed("Iptables.sync_rules")
+    def _do_sync_rules(self, user_rules: List[UserRule], snapshots: Dict[int, str] = None) -> Tuple[
         List[MatchedIptablesRule], list, List[UserRule],
         List[MatchedIptablesRule], list, List[UserRule], bool
     ]:
         """
         Match actual IPtables rules against a set of user's desired rules.
         :param user_rules:  List of user's rules
+        :param snapshots: (optional) iptables-save output per IP-version to use instead of reading new ones
         :return: (list) IPv4 rules matched, (list) IPv4 rules to remove, (list) IPv4 rules to add,
             (list) IPv6 rules matched, (list) IPv6 rules to remove, (list) IPv6 rules to add,
             (bool) changes needed
         """
         # Prep:
-        # Index for all of the rules
+        # Index for all of the rules.
+        # Active rule is matched into all user rules having the same identity: 1) Service 2) Source address
+        # 3) Comment, and the same protocol and port(s). An active rule without a comment will match a user rule
+        # with any comment. A service can contain multiple protocols and ports, each of them is matched separately.
+        # Rules having the same identity, eg. same source and service allowed by two users, share a single
+        # active rule.
         matched_rules = {}
+        expected_ports = {}
+        rule_index = {}
+        rule_index_without_comment = {}
+        now = datetime.utcnow()
         for idx, rule in enumerate(user_rules):
             if rule.comment and len(rule.comment) > 256:
                 raise ValueError("IPtables comment can only be 256 characters long. Got: {}".format(len(rule.comment)))
 
-            if rule.has_expired():
+            if rule.has_expired(now):
                 # Ah. Expired already. We won't be needing this rule in active ones.
+                # Any active rule for it will be removed.
                 continue
 
-            matched_rules[idx] = False
+            identity = rule.identity()
+            expected_ports[idx] = [self._port_key(proto, ports) for proto, ports in self._service_ports(rule.service)]
+            for port_key in expected_ports[idx]:
+                rule_index.setdefault((identity, port_key), []).append(idx)
+                rule_index_without_comment.setdefault((identity[:-1], port_key), []).append(idx)
 
-        # IPv4 matching:
-        active_ipv4_rules = self._read_chain(4)
-        ipv4_rules_matched = []
-        ipv4_rules_to_add = []
-        ipv4_rules_to_remove = []
-        for active_rule in active_ipv4_rules:
-            # Search for this active rule in set of user-rules
-            found_it = False
-            for idx, rule in enumerate(user_rules):
-                # Match: 1) Service 2) Source address 3) Comment
-                if rule == active_rule:
-                    # Found match!
-                    # Check if the rule hasn't expired and hasn't been matched already.
-                    if idx in matched_rules and not matched_rules[idx]:
-                        # A service can contain multiple protocols and ports.
-                        # Append to list only if user rule not matched already.
-                        if isinstance(rule, UserRule):
-                            matched_rule = MatchedIptablesUserRule(active_rule.rule_number_in_chain, rule)
-                        elif isinstance(rule, SharedRule):
-                            matched_rule = MatchedIptablesSharedRule(active_rule.rule_number_in_chain, rule)
-                        else:
-                            raise RuntimeError("Internal error! Don't know how to handle IPv4 rule class.")
-                        ipv4_rules_matched.append(matched_rule)
-                        # XXX Debug noise:
-                        # log.debug("Matched IPv4 rule: '{}'!".format(matched_rule))
-                        matched_rules[idx] = True
-                    found_it = True
-                    break
+            matched_rules[idx] = set()
 
-            if not found_it:
-                log.debug("Active IPv4 rule '{}' not found in user rules".format(active_rule))
-                ipv4_rules_to_remove.append(active_rule)
-
-        # IPv6 matching:
-        active_ipv6_rules = self._read_chain(6)
-        ipv6_rules_matched = []
-        ipv6_rules_to_add = []
-        ipv6_rules_to_remove = []
-        for active_rule in active_ipv6_rules:
-            # Search for this active rule in set of user-rules
-            found_it = False
-            for idx, rule in enumerate(user_rules):
-                # Match: 1) Service 2) Source address 3) Comment
-                if rule == active_rule:
-                    # Found match!
-                    # Check if the rule hasn't expired and hasn't been matched already.
-                    if idx in matched_rules and not matched_rules[idx]:
-                        # A service can contain multiple protocols and ports.
-                        # Append to list only if user rule not matched already.
-                        if isinstance(rule, UserRule):
-                            matched_rule = MatchedIptablesUserRule(active_rule.rule_number_in_chain, rule)
-                        elif isinstance(rule, SharedRule):
-                            matched_rule = MatchedIptablesSharedRule(active_rule.rule_number_in_chain, rule)
-                        else:
-                            raise RuntimeError("Internal error! Don't know how to handle IPv6 rule class.")
-                        ipv6_rules_matched.append(matched_rule)
-                        # XXX Debug noise:
-                        # log.debug("Matched IPv6 rule: '{}'!".format(matched_rule))
-                        matched_rules[idx] = True
-                    found_it = True
-                    break
-
-            if not found_it:
-                log.debug("Active IPv6 rule '{}' not found in user rules".format(active_rule))
-                ipv6_rules_to_remove.append(active_rule)
-
-        # Un-matched rules:
+        rules_matched = {}
+        rules_to_remove = {}
+        if snapshots:
+            active_chains = {ip_version: self._read_chain(ip_version, snapshots[ip_version])
+                             for ip_version in self.IP_VERSIONS}
+        else:
+            active_chains = self._for_each_family(self._read_chain)
+        first_match = {}
+        for ip_version in self.IP_VERSIONS:
+            active_rules = active_chains[ip_version]
+            rules_to_remove[ip_version] = []
+            for active_rule in active_rules:
+                # Search for this active rule in set of user-rules
+                identity = active_rule.identity()
+                port_key = self._port_key(active_rule.proto, active_rule.port)
+                if active_rule.comment:
+                    matching_rules = rule_index.get((identity, port_key))
+                else:
+                    matching_rules = rule_index_without_comment.get((identity[:-1], port_key))
+
+                if not matching_rules:
+                    log.debug("Active IPv{} rule '{}' not found in user rules".format(ip_version, active_rule))
+                    rules_to_remove[ip_version].append(active_rule)
+                    continue
+
+                if all(port_key in matched_rules[idx] for idx in matching_rules):
+                    log.debug("Active IPv{} rule '{}' is a duplicate".format(ip_version, active_rule))
+                    rules_to_remove[ip_version].append(active_rule)
+                    continue
+
+                # Found match!
+                # XXX Debug noise:
+                # log.debug("Matched IPv{} rule: '{}'!".format(ip_version, active_rule))
+                for idx in matching_rules:
+                    matched_rules[idx].add(port_key)
+                    first_match.setdefault(idx, active_rule.rule_number_in_chain)
+
+        # A user rule is matched when all of its protocols and ports are in effect.
+        # Missing ports of a partially matched rule need to be added.
+        rules_matched = {4: [], 6: []}
+        rules_to_add = {4: [], 6: []}
+        desired = {4: 0, 6: 0}
+        matches_found = 0
         for idx, rule in enumerate(user_rules):
-            # Check if the rule hasn't expired and hasn't been matched already.
-            if idx in matched_rules and matched_rules[idx]:
-                # This one is already matched
+            if idx not in matched_rules:
+                # This one is expired
                 continue
 
-            if rule.source_address_family == 4:
-                ipv4_rules_to_add.append(rule)
-            elif rule.source_address_family == 6:
-                ipv6_rules_to_add.append(rule)
+            ip_version = rule.source_address_family
+            desired[ip_version] += 1
+            missing = [port_key for port_key in expected_ports[idx] if port_key not in matched_rules[idx]]
+            if missing:
+                if len(missing) < len(expected_ports[idx]):
+                    log.debug("IPv{} rule '{}' is missing {} of its {} rules".format(
+                        ip_version, rule, len(missing), len(expected_ports[idx])
+                    ))
+                    rule = self._partial_rule(rule, missing)
+                rules_to_add[ip_version].append(rule)
+                continue
+
+            matches_found += 1
+            if isinstance(rule, UserRule):
+                matched_rule = MatchedIptablesUserRule(first_match[idx], rule)
+            elif isinstance(rule, SharedRule):
+                matched_rule = MatchedIptablesSharedRule(first_match[idx], rule)
+            else:
+                raise RuntimeError("Internal error! Don't know how to handle IPv{} rule class.".format(ip_version))
+            rules_matched[ip_version].append(matched_rule)
+
+        ipv4_rules_matched = rules_matched[4]
+        ipv4_rules_to_remove = rules_to_remove[4]
+        ipv4_rules_to_add = rules_to_add[4]
+        ipv6_rules_matched = rules_matched[6]
+        ipv6_rules_to_remove = rules_to_remove[6]
+        ipv6_rules_to_add = rules_to_add[6]
 
         # Stats matched rules
-        matches_found = len([True for match in matched_rules.values() if match is True])
+        for ip_version in self.IP_VERSIONS:
+            stats.set_gauge("Iptables.desired_rules.v{}".format(ip_version), desired[ip_version])
+            stats.set_gauge("Iptables.effective_rules.v{}".format(ip_version), len(rules_matched[ip_version]))
 
         # Any changes in rules?
         changes = matches_found != len(matched_rules)
@@ -477,166 +616,637 @@ class Iptables(FirewallBase):
                ipv6_rules_matched, ipv6_rules_to_remove, ipv6_rules_to_add, \
                changes
 
-    def _read_chain(self, ip_version: int) -> List[IptablesRule]:
+    def _for_each_family(self, operation: Callable[[int], Any]) -> Dict[int, Any]:
+        """
+        Run an operation for all address families.
+        Address families are independent of each other, operations are run in parallel unless disabled.
+        All families are run to completion, a failure in one won't cancel the other.
+        :param operation: callable taking the IP-version as an argument
+        :return: dict, key: IP-version, value: return value of the operation
+        """
+        results = {}
+        errors = {}
+        if self.concurrent and len(self.IP_VERSIONS) > 1:
+            with ThreadPoolExecutor(max_workers=len(self.IP_VERSIONS)) as executor:
+                futures = {ip_version: executor.submit(operation, ip_version) for ip_version in self.IP_VERSIONS}
+            for ip_version, future in futures.items():
+                exc = future.exception()
+                if exc:
+                    errors[ip_version] = exc
+                else:
+                    results[ip_version] = future.result()
+        else:
+            for ip_version in self.IP_VERSIONS:
+                try:
+                    results[ip_version] = operation(ip_version)
+                except Exception as exc:
+                    errors[ip_version] = exc
+
+        if not errors:
+            return results
+
+        for ip_version, exc in errors.items():
+            log.error("IPv{} operation failed: {}".format(ip_version, exc))
+        if len(errors) == 1:
+            raise next(iter(errors.values()))
+
+        raise RuntimeError("Multiple address families failed! {}".format(
+            ' '.join("IPv{}: {}".format(ip_version, exc) for ip_version, exc in errors.items())
+        )) from next(iter(errors.values()))
+
+    @stats.timed("Iptables.apply")
+    def _apply_changes(self, changes: Dict[int, List[list]]) -> None:
+        """
+        Apply changes of all address families.
+        :param changes: dict, key: IP-version, value: list of iptables-arguments, without the command
+        :return:
+        """
+        for ip_version, family_changes in changes.items():
+            stats.increment("Iptables.changes.v{}".format(ip_version), len(family_changes))
+        if self.batch:
+            # One iptables-restore transaction per address family.
+            # Either all of the changes of a family are in effect or none of them are.
+            self._for_each_family(lambda ip_version: self._apply_batch(ip_version, changes.get(ip_version, [])))
+        else:
+            # Fallback: One iptables-process per change.
+            self._for_each_family(lambda ip_version: self._apply_one_by_one(ip_version, changes.get(ip_version, [])))
+
+    def _read_chain(self, ip_version: int, snapshot: str = None) -> List[IptablesRule]:
+        """
+        Read active rules of our chain.
+        :param ip_version: IP-version, 4 or 6
+        :param snapshot: (optional) Output of iptables-save to use instead of reading a new one
+        :return: list of active rules in the chain, in chain order
+        """
+        if snapshot is None:
+            snapshot = self._read_snapshot(ip_version)
+
+        return self._parse_chain(ip_version, snapshot)
+
+    @stats.timed("Iptables.read_snapshot")
+    def _read_snapshot(self, ip_version: int, counters: bool = False) -> str:
+        """
+        Read state of filter-table with iptables-save.
+        :param ip_version: IP-version, 4 or 6
+        :param counters: Include packet and byte counters of rules
+        :return: iptables-save output
+        """
         if ip_version == 4:
-            command_to_run = self._iptables_cmd
+            command_to_run = self._iptables_save_cmd
         elif ip_version == 6:
-            command_to_run = self._ip6tables_cmd
+            command_to_run = self._ip6tables_save_cmd
         else:
             raise ValueError("IP-version needs to be 4 or 6!")
 
         # Note!
-        # iptables-command can be run only as root
-        p = subprocess.Popen(
-            [command_to_run, "-n", "--line-numbers", "-L", self._chain],
-            stdout=subprocess.PIPE)
-        output, err = p.communicate()
-        if p.returncode != 0:
+        # iptables-save can be run only as root
+        command = [command_to_run, "-t", "filter"]
+        if counters:
+            command.append("-c")
+        returncode, output, err = self._exec_command(command)
+        if returncode != 0:
             raise RuntimeError("Failed to query for IPtables rules. "
                                "Exit code: {} Command: {} Stdout: {} Stderr: {}".format(
-                p.returncode, command_to_run, output, err
+                returncode, command_to_run, output, err
             ))
 
+        return output.decode('UTF-8')
+
+    @stats.timed("Iptables.parse_chain")
+    def _parse_chain(self, ip_version: int, snapshot: str) -> List[IptablesRule]:
         """
-Chain Example-Chain-INPUT (1 references)
-num  target     prot opt source               destination
-1    ACCEPT     tcp  --  192.0.2.0/24         0.0.0.0/0            tcp dpt:22
-2    ACCEPT     tcp  --  198.51.100.0/24      0.0.0.0/0            tcp dpt:993
+        Parse rules of our chain out of iptables-save output.
+        :param ip_version: IP-version, 4 or 6
+        :param snapshot: iptables-save output
+        :return: list of active rules in the chain, in chain order
         """
-
-        line_nro = 0
+        """
+# Generated by iptables-save v1.8.7 on Sat Nov  5 12:00:00 2022
+*filter
+:INPUT ACCEPT [0:0]
+:Example-Chain-INPUT - [0:0]
+-A INPUT -j Example-Chain-INPUT
+-A Example-Chain-INPUT -s 192.0.2.0/24 -p tcp -m tcp --dport 22 -m state --state NEW -j ACCEPT
+-A Example-Chain-INPUT -s 198.51.100.0/24 -p tcp -m tcp --dport 993 -m comment --comment "IMAP users" -j ACCEPT
+COMMIT
+        """
+        chain_name = self._find_active_chain(snapshot)
+        self._active_chains[ip_version] = chain_name
+        chain_declaration = ":{} ".format(chain_name)
+        rule_prefix = "-A {} ".format(chain_name)
+        chain_found = False
+        rule_num = 0
         rules_out = []
-        for line in io.StringIO(output.decode('UTF-8')):
-            line_nro += 1
-            if line_nro == 1:
-                # First line contains chain name
-                match = re.search('^Chain\s+(\S+)\s+', line)
-                if not match:
-                    raise ValueError("IPchain output error! First line cannot be parsed: '{}'".format(line.strip()))
-
-                chain_name = match.group(1)
-                if chain_name != self._chain:
-                    raise ValueError("IPchain output error! Attempt to query for chain '{}' failed, "
-                                     "got: '{}'".format(self._chain, line.strip()))
-
+        for line in io.StringIO(snapshot):
+            if line.startswith(chain_declaration):
+                chain_found = True
                 continue
-            elif line_nro == 2:
-                # Skip header row
+            line, packet_count, byte_count = self._strip_counters(line)
+            if not line.startswith(rule_prefix):
                 continue
 
-            # Regular rows
-            if ip_version == 4:
-                #                     1:      2:      3:      4:      5:      6:      7:
-                match = re.search(r'^(\d+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(.+)', line.rstrip())
-                if not match:
-                    raise ValueError("IPchain output error! Rule cannot be parsed: '{}'".format(line.strip()))
-
-                rule_num = int(match.group(1))
-                destination_chain = match.group(2)
-                proto = match.group(3)
-                options = match.group(4)
-                address_in = match.group(5)
-                destination_addr = match.group(6)
-                destination = match.group(7)
-
-                if options != "--":
-                    raise ValueError("IPchain output error! Options is rules not supported, "
-                                     "rule: '{}'".format(line.strip()))
-
-                # Parse the source address
-                try:
-                    source_addr = ipaddress.ip_address(address_in)
-                except ValueError:
-                    try:
-                        source_addr = ipaddress.ip_network(address_in)
-                    except ValueError:
-                        raise ValueError("Really weird IP-address definition '{}'!".format(address_in))
-
-                if not isinstance(source_addr, ipaddress.IPv4Address) and not isinstance(source_addr,
-                                                                                         ipaddress.IPv4Network):
-                    raise ValueError("Really weird IPv4-address definition '{}'!".format(address_in))
-
-            elif ip_version == 6:
-                #                     1:      2:      3:      4:      5:      6:
-                match = re.search(r'^(\d+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(.+)', line.rstrip())
-                if not match:
-                    raise ValueError("IPchain output error! Rule cannot be parsed: '{}'".format(line.strip()))
-                rule_num = int(match.group(1))
-                destination_chain = match.group(2)
-                proto = match.group(3)
-                address_in = match.group(4)
-                destination_addr = match.group(5)
-                destination = match.group(6)
-
-                # Parse the source address
-                try:
-                    source_addr = ipaddress.ip_address(address_in)
-                except ValueError:
-                    try:
-                        source_addr = ipaddress.ip_network(address_in)
-                    except ValueError:
-                        raise ValueError("Really weird IP-address definition '{}'!".format(address_in))
+            # Rule position in chain is the order of appearance
+            rule_num += 1
+            try:
+                args = shlex.split(line)
+            except ValueError:
+                raise ValueError("IPchain output error! Rule cannot be parsed: '{}'".format(line.strip()))
 
-                if not isinstance(source_addr, ipaddress.IPv6Address) and not isinstance(source_addr,
-                                                                                         ipaddress.IPv6Network):
-                    raise ValueError("Really weird IPv6-address definition '{}'!".format(address_in))
+            rule_out = self._parse_rule(ip_version, rule_num, args[2:], line.strip())
+            if rule_out:
+                rule_out.packet_count = packet_count
+                rule_out.byte_count = byte_count
+                rule_out.rule_spec = args[2:]
+                rules_out.append(rule_out)
 
-            else:
-                raise RuntimeError("Internal: Don't know if IPv4 or IPv6!")
-
-            # Common part:
-            if destination_chain != "ACCEPT":
-                raise ValueError("IPchain output error! Rule isn't an ACCEPT-rule, "
-                                 "is a '{}', rule: '{}'".format(destination_chain, line.strip()))
-            if proto not in Service.PROTOCOLS:
-                raise ValueError("IPchain output error! Rule has unsupported proto '{}', "
-                                 "rule: '{}'".format(proto, line.strip()))
-            # Parse destination, it contains all possible options of iptables-rule
-            # We'll expect to see:
-            # 1: protocol
-            # 2: dpt:<port number>
-            # 3: [other options]
-            # 4: /* [optional comment] */
-            match = re.search(r'^(\w+)\s+dpt:(\d+)(\s+(.*))?$', destination)
-            if not match:
-                raise ValueError("IPchain output error! Rule destination failing to parse, "
-                                 "rule: '{}'".format(line.strip()))
-            port = int(match.group(2))
-            comment = None
-            if match.group(3):
-                # Parse options/comment further.
-                # Comment is always last
-                options = match.group(4)
-                match = re.search(r'/\*\s+(.+)\s+\*/', options)
-                if match:
-                    # Options do contain a comment
-                    comment = match.group(1)
-                # log.debug("Comment: '{}'".format(comment))
-
-            # XXX Debug noise:
-            # log.debug("Parsed rule {}: {}, {}, {}".format(rule_num, proto, port, source_addr))
+        if not chain_found:
+            raise ValueError("IPchain output error! Attempt to query for IPv{} chain '{}' failed, "
+                             "chain doesn't exist.".format(ip_version, chain_name))
+
+        return rules_out
+
+    def _parse_rule(self, ip_version: int, rule_num: int, args: List[str], line: str) -> Optional[IptablesRule]:
+        """
+        Parse arguments of a single iptables-save rule.
+        :param ip_version: IP-version, 4 or 6
+        :param rule_num: Rule number in chain
+        :param args: Rule arguments after "-A <chain>"
+        :param line: Full rule for error reporting
+        :return: IptablesRule or None if rule doesn't match any known service
+        """
+        address_in = None
+        proto = None
+        port = None
+        ports = None
+        destination_chain = None
+        comment = None
+
+        arg_iter = iter(args)
+        for arg in arg_iter:
+            if arg == "!":
+                raise ValueError("IPchain output error! Negation in rules not supported, rule: '{}'".format(line))
+            try:
+                if arg in ("-s", "--source"):
+                    address_in = next(arg_iter)
+                elif arg in ("-p", "--protocol"):
+                    proto = next(arg_iter)
+                elif arg in ("--dport", "--destination-port"):
+                    port = self._parse_dport(next(arg_iter))
+                elif arg in ("--dports", "--destination-ports"):
+                    ports = [self._parse_dport(port_in) for port_in in next(arg_iter).split(',')]
+                elif arg == "--comment":
+                    comment = next(arg_iter)
+                elif arg in ("-j", "--jump"):
+                    destination_chain = next(arg_iter)
+                elif arg in ("-m", "--match", "--state", "--ctstate"):
+                    # Matches are implied by the options, state is set by our configuration
+                    next(arg_iter)
+                else:
+                    raise ValueError("IPchain output error! Option '{}' in rules not supported, "
+                                     "rule: '{}'".format(arg, line))
+            except StopIteration:
+                raise ValueError("IPchain output error! Option '{}' is missing a value, rule: '{}'".format(arg, line))
+
+        # Parse the source address
+        if not address_in:
+            address_in = "0.0.0.0/0" if ip_version == 4 else "::/0"
+        try:
+            source_addr = ipaddress.ip_network(address_in)
+        except ValueError:
+            raise ValueError("Really weird IP-address definition '{}'!".format(address_in))
+        if source_addr.version != ip_version:
+            raise ValueError("Really weird IPv{}-address definition '{}'!".format(ip_version, address_in))
+
+        if destination_chain != "ACCEPT":
+            raise ValueError("IPchain output error! Rule isn't an ACCEPT-rule, "
+                             "is a '{}', rule: '{}'".format(destination_chain, line))
+        if proto not in Service.PROTOCOLS:
+            raise ValueError("IPchain output error! Rule has unsupported proto '{}', "
+                             "rule: '{}'".format(proto, line))
+        if port is None and not ports:
+            raise ValueError("IPchain output error! Rule has no destination port, "
+                             "rule: '{}'".format(line))
+
+        # XXX Debug noise:
+        # log.debug("Parsed rule {}: {}, {}, {}".format(rule_num, proto, port, source_addr))
+        if ports:
+            # Multiport rule belongs to a service only if all of its ports do
+            services = set(IptablesRule.find_service(proto, port_in, self.services) for port_in in ports)
+            service = services.pop() if len(services) == 1 else None
+            port = tuple(ports)
+        else:
             service = IptablesRule.find_service(proto, port, self.services)
-            if service:
-                rule_out = IptablesRule(rule_num, proto, port, service, source_addr, comment)
-                rules_out.append(rule_out)
+        if not service:
+            return None
+
+        return IptablesRule(rule_num, proto, port, service, source_addr, comment)
+
+    def _fingerprint(self, rules: List[UserRule], snapshots: Dict[int, str]) -> str:
+        """
+        Digest of desired rules and rules in chains in effect.
+        Any change in user rules, rule expiry, service definitions or chains will change the fingerprint.
+        :param rules: list of user rules
+        :param snapshots: iptables-save output per IP-version
+        :return: hex digest
+        """
+        digest = sha256()
+        for rule in rules:
+            digest.update(repr((rule.identity(), str(rule.service), rule.has_expired())).encode('UTF-8'))
+            digest.update(b'\n')
+
+        for ip_version in self.IP_VERSIONS:
+            # Normalized chain: only the rules of our chain, packet and byte counters excluded
+            chain_name = self._find_active_chain(snapshots[ip_version])
+            rule_prefix = "-A {} ".format(chain_name)
+            digest.update("IPv{} {}\n".format(ip_version, chain_name).encode('UTF-8'))
+            for line in io.StringIO(snapshots[ip_version]):
+                line, _, _ = self._strip_counters(line)
+                if line.startswith(rule_prefix):
+                    digest.update(line.rstrip().encode('UTF-8'))
+                    digest.update(b'\n')
+
+        return digest.hexdigest()
+
+    @classmethod
+    def _strip_counters(cls, line: str) -> Tuple[str, Optional[int], Optional[int]]:
+        """
+        Split packet and byte counters out of an iptables-save -c rule.
+        :param line: line of iptables-save output
+        :return: tuple: line without counters, packets, bytes. Counters are None if line has none.
+        """
+        if not line.startswith("["):
+            return line, None, None
+        match = cls.COUNTERS_RE.match(line)
+        if not match:
+            return line, None, None
+
+        return line[match.end():], int(match.group(1)), int(match.group(2))
+
+    def _chain_name(self, ip_version: int) -> str:
+        """
+        Name of the chain in effect. Known after the chain has been read.
+        """
+        return self._active_chains.get(ip_version, self._chain)
+
+    @staticmethod
+    def _chain_exists(snapshot: str, chain_name: str) -> bool:
+        """
+        Check if a chain is declared in the table.
+        :param snapshot: iptables-save output
+        :param chain_name: chain name
+        :return: True if chain exists
+        """
+        chain_declaration = ":{} ".format(chain_name)
+        for line in io.StringIO(snapshot):
+            if line.startswith(chain_declaration):
+                return True
+
+        return False
+
+    def _find_active_chain(self, snapshot: str) -> str:
+        """
+        Find out which one of the chain or its shadow is in effect.
+        :param snapshot: iptables-save output
+        :return: chain name
+        """
+        jumps = self._parse_jumps(snapshot)
+        if jumps and all(target == self._shadow_chain for _, _, _, target in jumps):
+            return self._shadow_chain
+
+        return self._chain
+
+    def _parse_jumps(self, snapshot: str) -> List[Tuple[str, int, List[str], str]]:
+        """
+        Find all rules of other chains jumping into the chain or its shadow.
+        :param snapshot: iptables-save output
+        :return: list of tuples, tuple: chain name, rule number, rule arguments after "-A <chain>", jump target
+        """
+        targets = (self._chain, self._shadow_chain)
+        rule_nums = {}
+        jumps_out = []
+        for line in io.StringIO(snapshot):
+            line, _, _ = self._strip_counters(line)
+            if not line.startswith("-A "):
+                continue
+            args = line.split()
+            if len(args) < 2 or args[1] in targets:
+                continue
+
+            # Rule position in chain is the order of appearance
+            rule_nums[args[1]] = rule_nums.get(args[1], 0) + 1
+            if not any(target in args for target in targets):
+                continue
+            try:
+                args = shlex.split(line)
+            except ValueError:
+                raise ValueError("IPchain output error! Rule cannot be parsed: '{}'".format(line.strip()))
+            for idx, arg in enumerate(args[:-1]):
+                if arg in ("-j", "--jump", "-g", "--goto") and args[idx + 1] in targets:
+                    jumps_out.append((args[1], rule_nums[args[1]], args[2:], args[idx + 1]))
+                    break
+
+        return jumps_out
+
+    def _shadow_rebuild_changes(self, proto_ver: int, snapshot: str, rules_to_add: List[UserRule],
+                                plan: EnforcementPlan = None) -> List[list]:
+        """
+        Forced update without flushing the chain in effect.
+        Fill the other chain of the chain/shadow-pair, replace all jumps into the new chain and drop the old one.
+        :param proto_ver: IP-version, 4 or 6
+        :param snapshot: iptables-save output
+        :param rules_to_add: User rules to add into the new chain
+        :param plan: (optional) Record the changes into plan
+        :return: list of iptables-arguments, without the command. Empty list if there are no jumps to replace.
+        """
+        old_chain = self._find_active_chain(snapshot)
+        new_chain = self._shadow_chain if old_chain == self._chain else self._chain
+        jumps = self._parse_jumps(snapshot)
+        if not jumps:
+            log.warning("No jumps into IPv{} chain {}. Cannot use shadow chain, flushing instead.".format(
+                proto_ver, old_chain
+            ))
+            return []
+
+        changes = []
+        if self._chain_exists(snapshot, new_chain):
+            changes.append(["-F", new_chain])
+        else:
+            changes.append(["-N", new_chain])
+        self._plan_change(plan, proto_ver, PlannedChange.CHAIN, changes[-1])
+
+        # Rules having the same identity share a single chain rule
+        appended = set()
+        for rule in rules_to_add:
+            for rule_out in self._rule_to_ipchain_append(proto_ver, rule, chain_name=new_chain):
+                if tuple(rule_out) in appended:
+                    continue
+                appended.add(tuple(rule_out))
+                changes.append(rule_out)
+                self._plan_change(plan, proto_ver, PlannedChange.APPEND, rule_out, rule)
+
+        # Swap all jumps. After this, the new chain is in effect.
+        for parent_chain, rule_num, args, target in jumps:
+            changes.append(["-R", parent_chain, rule_num] + [new_chain if arg == target else arg for arg in args])
+            self._plan_change(plan, proto_ver, PlannedChange.CHAIN, changes[-1])
+
+        # Old chain is not referenced anymore
+        for change in (["-F", old_chain], ["-X", old_chain]):
+            changes.append(change)
+            self._plan_change(plan, proto_ver, PlannedChange.CHAIN, change)
+
+        return changes
+
+    def _rules_to_ipchain_changes(self, proto_ver: int, rules_to_remove: List[IptablesRule],
+                                  rules_to_add: List[UserRule], force: bool,
+                                  plan: EnforcementPlan = None) -> List[list]:
+        """
+        Convert a set of rule changes into list of iptables-arguments in order of execution.
+        :param proto_ver: IP-version, 4 or 6
+        :param rules_to_remove: Active rules to delete from the chain
+        :param rules_to_add: User rules to append into the chain
+        :param force: Flush the chain before adding any rules
+        :param plan: (optional) Record the changes into plan
+        :return: list of iptables-arguments, without the command
+        """
+        if force:
+            # Chain in effect is needed. Forced sync didn't read it.
+            snapshot = self._read_snapshot(proto_ver)
+            if self.shadow_rebuild:
+                changes = self._shadow_rebuild_changes(proto_ver, snapshot, rules_to_add, plan=plan)
+                if changes:
+                    return changes
+            self._active_chains[proto_ver] = self._find_active_chain(snapshot)
+
+        changes = []
+        if force:
+            # Forced update
+            # Flush the chain first
+            changes.append(["-F", self._chain_name(proto_ver)])
+            self._plan_change(plan, proto_ver, PlannedChange.CHAIN, changes[-1])
+
+        # Pair rules to remove with rules to add having the same protocol and port.
+        # A pair is replaced in place. Rule numbers won't change and chain order is kept.
+        replaceable = {}
+        for rule in sorted(rules_to_remove, key=lambda x: x.rule_number_in_chain):
+            if rule.source_address_family == proto_ver:
+                replaceable.setdefault((rule.proto, rule.port), []).append(rule)
+
+        replaced = set()
+        rules_to_append = []
+        # Rules having the same identity share a single chain rule
+        appended = set()
+        for rule in rules_to_add:
+            # Appended rules are in the same order as their ports
+            port_rules = zip(self._service_ports(rule.service), self._rule_to_ipchain_append(proto_ver, rule))
+            for (proto, ports), rule_out in port_rules:
+                if tuple(rule_out) in appended:
+                    continue
+                appended.add(tuple(rule_out))
+                port_key = (proto, ports[0] if len(ports) == 1 else tuple(ports))
+                if replaceable.get(port_key):
+                    rule_to_replace = replaceable[port_key].pop(0)
+                    replaced.add(rule_to_replace.rule_number_in_chain)
+                    changes.append(["-R", rule_out[1], rule_to_replace.rule_number_in_chain] + rule_out[2:])
+                    self._plan_change(plan, proto_ver, PlannedChange.REPLACE, changes[-1], rule, rule_to_replace)
+                else:
+                    rules_to_append.append((rule, rule_out))
+
+        # Apply deletion in reverse order. As we'll progress from highest number to lowest,
+        # IPtables rule order won't change in the process.
+        # Deletion by specification won't depend on the order. Replaced rules keep their numbers either way.
+        for rule in sorted(rules_to_remove, key=lambda x: x.rule_number_in_chain, reverse=True):
+            if rule.rule_number_in_chain in replaced:
+                continue
+            rule_out = self._rule_to_ipchain_delete(proto_ver, rule)
+            if rule_out:
+                changes.append(rule_out)
+                self._plan_change(plan, proto_ver, PlannedChange.DELETE, rule_out, rule)
+
+        # Rules will be appended to the end of the chain
+        for rule, rule_out in rules_to_append:
+            changes.append(rule_out)
+            self._plan_change(plan, proto_ver, PlannedChange.APPEND, rule_out, rule)
+
+        return changes
+
+    def _plan_change(self, plan: Union[EnforcementPlan, None], proto_ver: int, action: str, change: list,
+                     rule: Rule = None, replaced_rule: Rule = None) -> None:
+        """
+        Record a change into plan, if planning.
+        """
+        if not plan:
+            return
+
+        command_to_run = self._iptables_cmd if proto_ver == 4 else self._ip6tables_cmd
+        command = ' '.join(str(r) for r in [command_to_run] + change)
+        if rule:
+            plan.add(PlannedChange.for_rule(action, proto_ver, command, rule, replaced_rule=replaced_rule))
+        else:
+            plan.add(PlannedChange(action, proto_ver, command))
+
+    def _apply_batch(self, proto_ver: int, changes: List[list]) -> None:
+        """
+        Apply all changes of an address family in a single iptables-restore transaction.
+        Note: --noflush will keep all other chains and rules intact.
+        :param proto_ver: IP-version, 4 or 6
+        :param changes: list of iptables-arguments, without the command
+        :return:
+        """
+        if not changes:
+            return
+
+        if proto_ver == 4:
+            command_to_run = self._iptables_restore_cmd
+        elif proto_ver == 6:
+            command_to_run = self._ip6tables_restore_cmd
+        else:
+            raise ValueError("IP-version needs to be 4 or 6! Has: '{}'".format(proto_ver))
+
+        lines = ["*filter"]
+        for change in changes:
+            lines.append(' '.join(self._restore_quote(str(arg)) for arg in change))
+        lines.append("COMMIT")
+        restore_input = ('\n'.join(lines) + '\n').encode('UTF-8')
+
+        log.debug("Applying {} IPv{} changes with {}".format(len(changes), proto_ver, command_to_run))
+        returncode, output, err = self._exec_command([command_to_run, "--noflush"], stdin=restore_input)
+        if returncode != 0:
+            raise RuntimeError("Failed to apply IPtables IPv{} changes into chain {}. "
+                               "Exit code: {} Stderr: {}".format(proto_ver, self._chain_name(proto_ver),
+                                                                 returncode, err))
+
+    def _apply_one_by_one(self, proto_ver: int, changes: List[list]) -> None:
+        """
+        Apply changes of an address family by running iptables-command for each change.
+        :param proto_ver: IP-version, 4 or 6
+        :param changes: list of iptables-arguments, without the command
+        :return:
+        """
+        if proto_ver == 4:
+            command_to_run = self._iptables_cmd
+        elif proto_ver == 6:
+            command_to_run = self._ip6tables_cmd
+        else:
+            raise ValueError("IP-version needs to be 4 or 6! Has: '{}'".format(proto_ver))
+
+        for change in changes:
+            returncode, output, err = self._exec_command([command_to_run] + change)
+            if returncode != 0:
+                raise RuntimeError("Failed to execute IPtables IPv{} change: '{}'".format(
+                    proto_ver, ' '.join(str(arg) for arg in change)
+                ))
+
+    @staticmethod
+    def _restore_quote(arg: str) -> str:
+        """
+        Quote an argument for iptables-restore input.
+        iptables-restore splits the line by whitespace, double quotes can be used to keep an argument together.
+        :param arg: argument
+        :return: argument, quoted if needed
+        """
+        if arg and not re.search(r'[\s"\'\\#]', arg):
+            return arg
+
+        return '"{}"'.format(arg.replace('\\', '\\\\').replace('"', '\\"'))
+
+    def _service_ports(self, service: Service) -> List[Tuple[str, List[Union[int, PortRange]]]]:
+        """
+        Split ports of a service into rules.
+        :param service: service
+        :return: list of tuples, tuple: protocol, list of ports in a single rule
+        """
+        if not self.multiport:
+            return [(proto, [port]) for proto, port in service.enumerate()]
+
+        rules_out = []
+        for proto, ports in service.protocol_definition.items():
+            chunk = []
+            chunk_size = 0
+            for port in ports:
+                port_size = 2 if isinstance(port, PortRange) else 1
+                if chunk_size + port_size > self.MULTIPORT_MAX_PORTS:
+                    rules_out.append((proto, chunk))
+                    chunk = []
+                    chunk_size = 0
+                chunk.append(port)
+                chunk_size += port_size
+            if chunk:
+                rules_out.append((proto, chunk))
 
         return rules_out
 
-    def _rule_to_ipchain_append(self, proto_ver: int, rule: Rule, with_command=False) -> List[list]:
+    @staticmethod
+    def _port_key(proto: str, port: Union[int, PortRange, Tuple, List]) -> Tuple[str, tuple]:
+        """
+        Protocol and port(s) of a chain rule as a dictionary key.
+        :param proto: protocol
+        :param port: port, port range, or a tuple or list of them for a multiport rule
+        :return: tuple: protocol, tuple of ports
+        """
+        if isinstance(port, PortRange) or not isinstance(port, (tuple, list)):
+            return proto, (port,)
+
+        return proto, tuple(port)
+
+    def _partial_rule(self, rule: Rule, port_keys: List[Tuple[str, tuple]]) -> Rule:
+        """
+        Copy of a rule having only some of the protocols and ports of its service.
+        :param rule: rule
+        :param port_keys: protocols and ports of the copy, see _port_key()
+        :return: rule, the rule itself if the copy wouldn't split into the same chain rules
+        """
+        definition = {}
+        for proto, ports in port_keys:
+            definition.setdefault(proto, []).extend(ports)
+        service = Service(rule.service.code, rule.service.name, definition)
+        if sorted(self._port_key(proto, ports) for proto, ports in self._service_ports(service)) != sorted(port_keys):
+            # Multiport would chunk the ports differently
+            return rule
+
+        partial_rule = copy.copy(rule)
+        partial_rule.service = service
+
+        return partial_rule
+
+    @staticmethod
+    def _dport(port: Union[int, PortRange]) -> str:
+        """
+        Destination port as iptables-argument. Port range is first:last.
+        """
+        if isinstance(port, PortRange):
+            return "{}:{}".format(port.first, port.last)
+
+        return str(port)
+
+    @staticmethod
+    def _parse_dport(port_in: str) -> Union[int, PortRange]:
+        """
+        Parse destination port from iptables-argument.
+        """
+        try:
+            return Service.parse_port(port_in, separator=':')
+        except ValueError:
+            raise ValueError("IPchain output error! Destination port '{}' cannot be parsed.".format(port_in))
+
+    def _rule_to_ipchain_append(self, proto_ver: int, rule: Rule, with_command=False,
+                                chain_name: str = None) -> List[list]:
         ipchain_rules = []
+        if not chain_name:
+            chain_name = self._chain_name(proto_ver)
 
         # Sanity: IPv4 or IPv6 address
         if rule.source_address_family != proto_ver:
             return ipchain_rules
 
         # Output
-        for service_def in rule.service.enumerate():
-            proto = service_def[0]
-            port = service_def[1]
+        for proto, ports in self._service_ports(rule.service):
+            if len(ports) == 1:
+                port_match = ["-m", proto, "--source", rule.source, "--dport", self._dport(ports[0])]
+            else:
+                port_match = ["-m", "multiport", "--source", rule.source,
+                              "--dports", ','.join(self._dport(port) for port in ports)]
 
-            ipchain_rule = [
-                "-A", self._chain, "-p", proto, "-m", proto, "--source", rule.source, "--dport", port
-            ]
+            ipchain_rule = ["-A", chain_name, "-p", proto] + port_match
             if self.stateful:
                 # Docs: https://ipset.netfilter.org/iptables-extensions.man.html#lbCC
                 ipchain_rule.extend(["-m", "state", "--state", "NEW"])
@@ -665,9 +1275,13 @@ num  target     prot opt source               destination
             return []
 
         # Output
-        ipchain_rule = [
-            "-D", self._chain, rule.rule_number_in_chain
-        ]
+        if self.delete_by_spec and rule.rule_spec:
+            # Rule to delete is matched by all of its arguments. A rule no longer there won't match any other rule.
+            ipchain_rule = ["-D", self._chain_name(proto_ver)] + rule.rule_spec
+        else:
+            ipchain_rule = [
+                "-D", self._chain_name(proto_ver), rule.rule_number_in_chain
+            ]
 
         if with_command:
             if rule.source_address_family == 4:
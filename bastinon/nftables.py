@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import re
+import json
+import ipaddress
+from typing import Tuple, Union, List, Dict
+from .base import FirewallBase, EnforcementPlan, PlannedChange
+from .executors import CommandExecutor
+from .stats import stats
+from .rules import UserRule, Service
+import logging
+
+log = logging.getLogger(__name__)
+
+IPNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+class NftablesRule:
+
+    def __init__(self, handle: int, comment: Union[str, None]):
+        self.handle = handle
+        self.comment = comment
+
+    def __str__(self) -> str:
+        return "Nftables rule handle {}: {}".format(self.handle, self.comment)
+
+
+class Nftables(FirewallBase):
+    """
+    Linux nftables firewall.
+    A dual-stack inet-table has a named interval set per service and address family.
+    Chain has a single rule per service protocol matching the set, eg. ip saddr @bastinon_ssh_v4 tcp dport 22 accept.
+    All changes are applied as a single atomic nft-transaction.
+    """
+    DEFAULT_TABLE_NAME = r"filter"
+    SET_PREFIX = r"bastinon"
+    TABLE_FAMILY = r"inet"
+    MAX_COMMENT_LENGTH = 128
+
+    def __init__(self, services: Dict[str, Service], chain_name: str, stateful: bool,
+                 table_name: str = DEFAULT_TABLE_NAME, executor: CommandExecutor = None):
+        """
+        Initialize Linux nftables firewall
+        :param services: List of defined services
+        :param chain_name: Name of nftables chain, regular chain to be jumped into from input hook chain
+        :param stateful: TCP and UDP, True = ct state new, False = don't add
+        :param table_name: Name of inet-family table containing the chain
+        :param executor: (optional) Runner of nft-command, default: run commands as child processes
+        """
+        super().__init__(services, executor)
+
+        if not chain_name:
+            raise ValueError("Need valid nftables chain name!")
+        if not table_name:
+            raise ValueError("Need valid nftables table name!")
+        self._chain = chain_name
+        self._table = table_name
+        self._nft_cmd = self.executor.which("nft")
+        if not self._nft_cmd:
+            raise ValueError("Cannot find exact location of nft-command! Failing to continue.")
+
+        self.stateful = stateful
+
+    #
+    # Abstract implementation for nftables
+    #
+
+    def query(self, rules: List[UserRule]) -> List[Tuple[UserRule, bool]]:
+        """
+        Query for currently active firewall rules
+        :return: list of tuples, tuple: user rule object, rule in effect
+        """
+        current_sets, chain_rules = self._read_table()
+        current_networks = {}
+        for set_name, elements in current_sets.items():
+            current_networks[set_name] = set()
+            for networks in elements.values():
+                current_networks[set_name].update(networks)
+        rule_comments = set(rule.comment for rule in chain_rules)
+
+        rules_out = []
+        for rule in rules:
+            if rule.has_expired():
+                rules_out.append((rule, False))
+                continue
+
+            set_name = self._set_name(rule.service, rule.source_address_family)
+            in_set = set_name in current_networks and \
+                self._network_in(rule.source_network, current_networks[set_name])
+            in_chain = all(self._rule_comment(rule.service, rule.source_address_family, proto) in rule_comments
+                           for proto in rule.service.protocol_definition.keys())
+            rules_out.append((rule, in_set and in_chain))
+
+        return rules_out
+
+    def query_readable(self, rules: List[UserRule]) -> List[str]:
+        """
+        Query for currently active firewall rules.
+        Match the rules against all users' rules.
+        :param rules: Users' rules
+        :return: list of strings
+        """
+        rules_out = []
+        for rule in rules:
+            rule_str = ""
+            if rule.has_expired():
+                # Ah. Expired already.
+                rule_str = "# "
+            set_name = self._set_name(rule.service, rule.source_address_family)
+            rule_str += "{} add element {} {} {} {{ {} }}".format(
+                self._nft_cmd, self.TABLE_FAMILY, self._table, set_name, self._element(rule.source_network)
+            )
+            rules_out.append(rule_str)
+
+        for ip_version in (4, 6):
+            for set_name, (service, _) in sorted(self._desired_sets(rules, ip_version).items()):
+                for _, rule_out in self._set_rules(set_name, service, ip_version):
+                    rules_out.append("{} {}".format(self._nft_cmd, rule_out))
+
+        return rules_out
+
+    @stats.timed("Nftables.set")
+    def set(self, rules: List[UserRule], force=False) -> None:
+        """
+        Set rules to firewall
+        :param rules: List of firewall rules to set
+        :param force: Force set all rules ignoring any possible existing rules
+        :return:
+        """
+        script = self._plan(rules, force)
+        if not script:
+            log.info("No changes needed")
+            return
+
+        nft_input = ('\n'.join(self._script_prologue() + script) + '\n').encode('UTF-8')
+        log.debug("Applying {} nftables changes".format(len(script)))
+        returncode, output, err = self._exec_command([self._nft_cmd, "-f", "-"], stdin=nft_input)
+        if returncode != 0:
+            raise RuntimeError("Failed to apply nftables changes into table {} {}. "
+                               "Exit code: {} Stderr: {}".format(self.TABLE_FAMILY, self._table, returncode, err))
+
+    def simulate(self, rules: List[UserRule], force=False) -> Union[bool, List[str]]:
+        """
+        Show what would happen if set rules to firewall
+        :param rules: List of firewall rules to simulate
+        :param force: Force simulate all rules ignoring any possible existing rules
+        :return: list of strings, what firewall would need to do to make rules effective
+        """
+        script = self._plan(rules, force)
+        log.debug("Nftables simulate(), changes_needed = {}".format(bool(script)))
+        if not script:
+            return False
+
+        return ["{} {}".format(self._nft_cmd, line) for line in script]
+
+    def plan(self, rules: List[UserRule], force=False) -> EnforcementPlan:
+        """
+        Plan what needs to be done to make rules effective.
+        Set elements are sources of rules, all other changes are chain operations. Elements are collapsed networks,
+        they cannot be told apart into rules or owners. Table is read once and all changes are applied
+        in a single transaction.
+        :param rules: List of firewall rules to plan for
+        :param force: Plan for forced update ignoring any possible existing rules
+        :return: plan of changes and their cost
+        """
+        script = self._plan(rules, force)
+        plan = EnforcementPlan(self.__class__.__name__, force)
+        if not script:
+            return plan
+
+        set_services = {}
+        for service in self.services.values():
+            for ip_version in (4, 6):
+                set_services[self._set_name(service, ip_version)] = (service, ip_version)
+
+        set_element_re = re.compile(r"^(add|delete) element \S+ \S+ (\S+) \{ (.*) \}$")
+        actions = {"add": PlannedChange.APPEND, "delete": PlannedChange.DELETE}
+        for line in script:
+            command = "{} {}".format(self._nft_cmd, line)
+            match = set_element_re.match(line)
+            service, ip_version = set_services.get(match.group(2), (None, None)) if match else (None, None)
+            if not service:
+                plan.add(PlannedChange(PlannedChange.CHAIN, ip_version, command))
+                continue
+            plan.add(PlannedChange(actions[match.group(1)], ip_version, command,
+                                   service_code=service.code, source=match.group(3)))
+
+        plan.kernel_operations = len(script)
+        plan.processes = 2
+
+        return plan
+
+    def needs_update(self, rules: List[UserRule]) -> bool:
+        """
+        Query if any rules requested by users are not in effect
+        :param rules: list of user rules
+        :return: bool, True = changes needed, False = all rules effective
+        """
+        script = self._plan(rules, False)
+
+        return bool(script)
+
+    #
+    # nftables internal implementation below
+    #
+
+    def _set_name(self, service: Service, ip_version: int) -> str:
+        code = re.sub(r'[^A-Za-z0-9_]', '_', service.code)
+
+        return "{}_{}_v{}".format(self.SET_PREFIX, code, ip_version)
+
+    def _rule_comment(self, service: Service, ip_version: int, proto: str) -> str:
+        """
+        Comment identifying a chain rule. Any change in rule content will change the comment.
+        """
+        comment = "{} {} v{} {} {}".format(
+            self.SET_PREFIX, service.code, ip_version, proto, self._ports(service, proto)
+        )
+        if self.stateful:
+            comment += " new"
+        if len(comment) > self.MAX_COMMENT_LENGTH:
+            raise ValueError("Nftables rule comment '{}' is too long!".format(comment))
+
+        return comment
+
+    @staticmethod
+    def _ports(service: Service, proto: str) -> str:
+        ports = [str(port) for port in service.protocol_definition[proto]]
+        if len(ports) == 1:
+            return ports[0]
+
+        return "{{ {} }}".format(', '.join(ports))
+
+    @staticmethod
+    def _element(network: IPNetwork) -> str:
+        if network.prefixlen == network.max_prefixlen:
+            return str(network.network_address)
+
+        return str(network)
+
+    @staticmethod
+    def _network_in(network: IPNetwork, networks: set) -> bool:
+        """
+        Check if network is inside any of the networks.
+        """
+        for prefixlen in range(network.prefixlen, -1, -1):
+            if network.supernet(new_prefix=prefixlen) in networks:
+                return True
+
+        return False
+
+    def _script_prologue(self) -> List[str]:
+        # Note: add is a no-op for existing table and chain
+        return [
+            "add table {} {}".format(self.TABLE_FAMILY, self._table),
+            "add chain {} {} {}".format(self.TABLE_FAMILY, self._table, self._chain),
+        ]
+
+    def _desired_sets(self, rules: List[UserRule], ip_version: int) -> Dict[str, Tuple[Service, List[IPNetwork]]]:
+        """
+        Group user rules into sets.
+        Interval sets cannot contain overlapping elements, networks are collapsed.
+        :return: dict, key: set name, value: tuple: service, list of set elements
+        """
+        networks = {}
+        services = {}
+        for rule in rules:
+            if rule.source_address_family != ip_version:
+                continue
+            if rule.has_expired():
+                continue
+            if rule.network_size_valid(False) is False:
+                log.warning("Skipping IPv{} network {} of size /{}".format(
+                    rule.source_address_family, rule.source, rule.source_network.prefixlen
+                ))
+                continue
+
+            set_name = self._set_name(rule.service, ip_version)
+            services[set_name] = rule.service
+            networks.setdefault(set_name, []).append(rule.source_network)
+
+        return {set_name: (services[set_name], list(ipaddress.collapse_addresses(set_networks)))
+                for set_name, set_networks in networks.items()}
+
+    def _set_rules(self, set_name: str, service: Service, ip_version: int) -> List[Tuple[str, str]]:
+        """
+        Chain rules for a set.
+        :return: list of tuples: rule comment, nft-command adding the rule
+        """
+        rules_out = []
+        address_match = "ip saddr" if ip_version == 4 else "ip6 saddr"
+        for proto in service.protocol_definition.keys():
+            rule = "add rule {} {} {} {} @{} {} dport {}".format(
+                self.TABLE_FAMILY, self._table, self._chain,
+                address_match, set_name, proto, self._ports(service, proto)
+            )
+            if self.stateful:
+                rule += " ct state new"
+            comment = self._rule_comment(service, ip_version, proto)
+            rule += " accept comment {}".format(json.dumps(comment))
+            rules_out.append((comment, rule))
+
+        return rules_out
+
+    def _plan(self, rules: List[UserRule], force: bool) -> List[str]:
+        """
+        Plan the changes needed to make the rules effective.
+        :return: list of nft-commands to run in single transaction
+        """
+        current_sets, chain_rules = self._read_table()
+        table_spec = "{} {}".format(self.TABLE_FAMILY, self._table)
+
+        script_rules = []
+        script_sets = []
+        script_elements = []
+        desired_rules = {}
+        sets_in_use = set()
+        for ip_version in (4, 6):
+            set_type = "ipv4_addr" if ip_version == 4 else "ipv6_addr"
+            for set_name, (service, networks) in sorted(self._desired_sets(rules, ip_version).items()):
+                sets_in_use.add(set_name)
+                for comment, rule in self._set_rules(set_name, service, ip_version):
+                    desired_rules[comment] = rule
+
+                if set_name not in current_sets:
+                    script_sets.append("add set {} {} {{ type {}; flags interval; }}".format(
+                        table_spec, set_name, set_type
+                    ))
+                    current_elements = {}
+                elif force:
+                    script_elements.append("flush set {} {}".format(table_spec, set_name))
+                    current_elements = {}
+                else:
+                    current_elements = current_sets[set_name]
+
+                # Keep elements having a single desired network, delete all others
+                kept_networks = set()
+                elements_to_delete = []
+                desired_networks = set(networks)
+                for element, element_networks in current_elements.items():
+                    if len(element_networks) == 1 and element_networks[0] in desired_networks:
+                        kept_networks.add(element_networks[0])
+                    else:
+                        elements_to_delete.append(element)
+                if elements_to_delete:
+                    script_elements.append("delete element {} {} {{ {} }}".format(
+                        table_spec, set_name, ', '.join(elements_to_delete)
+                    ))
+                elements_to_add = [self._element(network) for network in networks if network not in kept_networks]
+                if elements_to_add:
+                    script_elements.append("add element {} {} {{ {} }}".format(
+                        table_spec, set_name, ', '.join(elements_to_add)
+                    ))
+
+        # Chain rules, any rule not matching a desired rule will be removed. Duplicates too.
+        if force and chain_rules:
+            script_rules.append("flush chain {} {}".format(table_spec, self._chain))
+            existing_comments = set()
+        else:
+            existing_comments = set()
+            for chain_rule in chain_rules:
+                if chain_rule.comment in desired_rules and chain_rule.comment not in existing_comments:
+                    existing_comments.add(chain_rule.comment)
+                    continue
+                script_rules.append("delete rule {} {} handle {}".format(table_spec, self._chain, chain_rule.handle))
+        for comment, rule in desired_rules.items():
+            if comment not in existing_comments:
+                script_rules.append(rule)
+
+        # Sets can be deleted only after the rules referring to them are gone
+        script_set_deletes = ["delete set {} {}".format(table_spec, set_name)
+                              for set_name in sorted(current_sets.keys()) if set_name not in sets_in_use]
+
+        return script_sets + script_elements + script_rules + script_set_deletes
+
+    def _read_table(self) -> Tuple[Dict[str, Dict[str, List[IPNetwork]]], List[NftablesRule]]:
+        """
+        Read our sets and chain rules in the table.
+        :return: tuple: dict of sets, key: set name, value: dict key: element, value: networks in element,
+                        list of chain rules
+        """
+        returncode, output, err = self._exec_command(
+            [self._nft_cmd, "-j", "list", "table", self.TABLE_FAMILY, self._table]
+        )
+        if returncode != 0:
+            if b"No such file or directory" in err:
+                # Table doesn't exist yet. Will be created.
+                return {}, []
+            raise RuntimeError("Failed to query for nftables rules. "
+                               "Exit code: {} Command: {} Stdout: {} Stderr: {}".format(
+                returncode, self._nft_cmd, output, err
+            ))
+
+        try:
+            ruleset = json.loads(output.decode('UTF-8'))
+        except ValueError:
+            raise ValueError("Nftables output error! JSON cannot be parsed.")
+
+        set_prefix = "{}_".format(self.SET_PREFIX)
+        sets_out = {}
+        rules_out = []
+        for item in ruleset.get("nftables", []):
+            if "set" in item:
+                nft_set = item["set"]
+                if not nft_set.get("name", "").startswith(set_prefix):
+                    continue
+                elements = {}
+                for elem in nft_set.get("elem", []):
+                    element, networks = self._parse_element(elem)
+                    elements[element] = networks
+                sets_out[nft_set["name"]] = elements
+            elif "rule" in item:
+                nft_rule = item["rule"]
+                if nft_rule.get("chain") != self._chain:
+                    continue
+                rules_out.append(NftablesRule(nft_rule["handle"], nft_rule.get("comment")))
+
+        return sets_out, rules_out
+
+    @staticmethod
+    def _parse_element(elem) -> Tuple[str, List[IPNetwork]]:
+        """
+        Parse a JSON set element.
+        :return: tuple: element as nft-syntax, list of networks covered by the element
+        """
+        if isinstance(elem, dict) and "elem" in elem:
+            # Element with options, eg. comment or timeout
+            elem = elem["elem"]["val"]
+        if isinstance(elem, str):
+            network = ipaddress.ip_network(elem)
+            return elem, [network]
+        if isinstance(elem, dict) and "prefix" in elem:
+            network = ipaddress.ip_network("{}/{}".format(elem["prefix"]["addr"], elem["prefix"]["len"]))
+            return str(network), [network]
+        if isinstance(elem, dict) and "range" in elem:
+            first = ipaddress.ip_address(elem["range"][0])
+            last = ipaddress.ip_address(elem["range"][1])
+            return "{}-{}".format(first, last), list(ipaddress.summarize_address_range(first, last))
+
+        raise ValueError("Nftables output error! Set element cannot be parsed: '{}'".format(elem))
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import asyncio
+import calendar
+import tempfile
+from typing import List, Dict, Tuple
+from .base import FirewallBase
+from .expiry_scheduler import ExpiryScheduler
+from .rules import UserRule
+from .stats import stats
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class PrometheusExporter:
+    """
+    Write metrics into a file for node_exporter's textfile collector.
+    File is replaced atomically on an interval. Only in-memory state is exported, no firewall is queried.
+    """
+    DEFAULT_INTERVAL = 60
+    FAMILIES = {4: "ipv4", 6: "ipv6"}
+    PARSE_PHASES = {
+        "services": "ServiceReader.parse_xml",
+        "rules": "RuleReader.parse_xml",
+        "chain": "Iptables.parse_chain",
+    }
+
+    def __init__(self, filename: str, firewall: FirewallBase, expiry_scheduler: ExpiryScheduler,
+                 loop: asyncio.AbstractEventLoop, interval: int = DEFAULT_INTERVAL):
+        """
+        Initialize metrics exporter
+        :param filename: File to write, needs to end with .prom to be collected
+        :param firewall: Firewall in use
+        :param expiry_scheduler: Scheduler having the loaded rules
+        :param loop: Event loop to arm the timer into
+        :param interval: Seconds between writes
+        """
+        if not filename:
+            raise ValueError("Need valid metrics filename!")
+        if interval <= 0:
+            raise ValueError("Metrics interval {} not allowed! Must be positive.".format(interval))
+        if not filename.endswith(".prom"):
+            log.warning("Metrics file {} doesn't end with .prom, textfile collector will ignore it".format(filename))
+
+        self._filename = filename
+        self._firewall = firewall
+        self._expiry_scheduler = expiry_scheduler
+        self._loop = loop
+        self._interval = interval
+        self._timer = None
+
+    def start(self) -> None:
+        """
+        Write metrics now and on every interval.
+        :return:
+        """
+        self.cancel()
+        self._write_and_rearm()
+
+    def cancel(self) -> None:
+        """
+        Disarm the timer.
+        :return:
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def write(self) -> None:
+        """
+        Write metrics into a temporary file and replace the metrics file with it.
+        :return:
+        """
+        metrics = self.format()
+        directory = os.path.dirname(os.path.abspath(self._filename))
+        # Temporary file won't end with .prom, collector won't read a partial file
+        fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=".{}.".format(os.path.basename(self._filename)),
+                                             suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as metrics_file:
+                metrics_file.write(metrics)
+            os.chmod(temp_filename, 0o644)
+            os.replace(temp_filename, self._filename)
+        except Exception:
+            os.unlink(temp_filename)
+            raise
+
+    def format(self) -> str:
+        """
+        Metrics in Prometheus text format
+        """
+        current_stats = stats.snapshot()
+        lines = []
+        lines.extend(self._rule_metrics())
+        lines.extend(self._effective_rule_metrics(current_stats))
+        lines.extend(self._apply_metrics(current_stats))
+        lines.extend(self._operation_metrics(current_stats))
+        lines.extend(self._parse_metrics(current_stats))
+
+        next_expiry = self._expiry_scheduler.next_expiry
+        if next_expiry:
+            lines.extend(self._metric("bastinon_next_expiry_timestamp_seconds", "gauge",
+                                      "Unix time of the earliest upcoming rule expiry",
+                                      [({}, calendar.timegm(next_expiry.utctimetuple()))]))
+
+        return '\n'.join(lines) + '\n'
+
+    #
+    # Internal implementation below
+    #
+
+    def _write_and_rearm(self) -> None:
+        self._timer = None
+        try:
+            self.write()
+        except Exception as exc:
+            log.error("Failed to write metrics into {}: {}".format(self._filename, exc))
+        self._timer = self._loop.call_later(self._interval, self._write_and_rearm)
+
+    def _rule_metrics(self) -> List[str]:
+        user_rules = {}
+        shared_rules = {}
+        expired = 0
+        for rule in self._expiry_scheduler.rules:
+            if rule.has_expired():
+                expired += 1
+                continue
+            family = self.FAMILIES.get(rule.source_address_family)
+            if isinstance(rule, UserRule):
+                key = (rule.owner, rule.service.code, family)
+                user_rules[key] = user_rules.get(key, 0) + 1
+            else:
+                key = (rule.service.code, family)
+                shared_rules[key] = shared_rules.get(key, 0) + 1
+
+        lines = []
+        lines.extend(self._metric("bastinon_rules", "gauge", "Rules not expired per user, service and address family",
+                                  [({"user": user, "service": service, "family": family}, count)
+                                   for (user, service, family), count in sorted(user_rules.items())]))
+        lines.extend(self._metric("bastinon_shared_rules", "gauge",
+                                  "Shared rules not expired per service and address family",
+                                  [({"service": service, "family": family}, count)
+                                   for (service, family), count in sorted(shared_rules.items())]))
+        lines.extend(self._metric("bastinon_expired_rules", "gauge", "Expired rules still defined",
+                                  [({}, expired)]))
+
+        return lines
+
+    def _effective_rule_metrics(self, current_stats: Dict[str, Dict[str, float]]) -> List[str]:
+        desired = []
+        effective = []
+        for name, values in sorted(current_stats.items()):
+            if "value" not in values:
+                continue
+            kind, _, version = name.rpartition(".v")
+            if not version.isdigit() or int(version) not in self.FAMILIES:
+                continue
+            labels = {"family": self.FAMILIES[int(version)]}
+            if kind.endswith(".desired_rules"):
+                desired.append((labels, values["value"]))
+            elif kind.endswith(".effective_rules"):
+                effective.append((labels, values["value"]))
+
+        lines = []
+        lines.extend(self._metric("bastinon_desired_rules", "gauge",
+                                  "Rules wanted in effect as of last synchronization", desired))
+        lines.extend(self._metric("bastinon_effective_rules", "gauge",
+                                  "Rules in effect as of last synchronization", effective))
+
+        return lines
+
+    def _apply_metrics(self, current_stats: Dict[str, Dict[str, float]]) -> List[str]:
+        apply_stats = current_stats.get("{}.set".format(type(self._firewall).__name__))
+        if not apply_stats:
+            return []
+
+        lines = []
+        lines.extend(self._metric("bastinon_applies_total", "counter", "Rule applies into firewall",
+                                  [({}, apply_stats["count"])]))
+        lines.extend(self._metric("bastinon_apply_failures_total", "counter", "Failed rule applies into firewall",
+                                  [({}, apply_stats["errors"])]))
+        lines.extend(self._metric("bastinon_last_apply_duration_seconds", "gauge", "Duration of last rule apply",
+                                  [({}, apply_stats["last"])]))
+        lines.extend(self._metric("bastinon_last_apply_success", "gauge", "Last rule apply succeeded, 1 or 0",
+                                  [({}, apply_stats["last_ok"])]))
+        lines.extend(self._metric("bastinon_last_apply_timestamp_seconds", "gauge", "Unix time of last rule apply",
+                                  [({}, apply_stats["last_time"])]))
+
+        return lines
+
+    def _operation_metrics(self, current_stats: Dict[str, Dict[str, float]]) -> List[str]:
+        operations = []
+        commands = []
+        command_seconds = []
+        for name, values in sorted(current_stats.items()):
+            if name.startswith("Iptables.changes.v"):
+                version = name[len("Iptables.changes.v"):]
+                if version.isdigit() and int(version) in self.FAMILIES:
+                    operations.append(({"family": self.FAMILIES[int(version)]}, values["count"]))
+            elif name.startswith("exec."):
+                labels = {"command": name[len("exec."):]}
+                commands.append((labels, values["count"]))
+                command_seconds.append((labels, values["sum"]))
+
+        lines = []
+        lines.extend(self._metric("bastinon_kernel_operations_total", "counter",
+                                  "Chain operations applied into kernel", operations))
+        lines.extend(self._metric("bastinon_commands_total", "counter", "Firewall commands run", commands))
+        lines.extend(self._metric("bastinon_command_seconds_total", "counter",
+                                  "Time spent running firewall commands", command_seconds))
+
+        return lines
+
+    def _parse_metrics(self, current_stats: Dict[str, Dict[str, float]]) -> List[str]:
+        parses = []
+        parse_seconds = []
+        for phase, name in self.PARSE_PHASES.items():
+            if name not in current_stats:
+                continue
+            parses.append(({"phase": phase}, current_stats[name]["count"]))
+            parse_seconds.append(({"phase": phase}, current_stats[name]["sum"]))
+
+        lines = []
+        lines.extend(self._metric("bastinon_parses_total", "counter", "Files and chains parsed", parses))
+        lines.extend(self._metric("bastinon_parse_seconds_total", "counter", "Time spent parsing", parse_seconds))
+
+        return lines
+
+    def _metric(self, name: str, metric_type: str, help_text: str,
+                samples: List[Tuple[Dict[str, str], float]]) -> List[str]:
+        if not samples:
+            return []
+
+        lines = ["# HELP {} {}".format(name, help_text), "# TYPE {} {}".format(name, metric_type)]
+        for labels, value in samples:
+            if labels:
+                label_str = ','.join('{}="{}"'.format(label, self._escape(label_value))
+                                     for label, label_value in labels.items())
+                lines.append("{}{{{}}} {}".format(name, label_str, self._value(value)))
+            else:
+                lines.append("{} {}".format(name, self._value(value)))
+
+        return lines
+
+    @staticmethod
+    def _escape(label_value) -> str:
+        return str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def _value(value: float) -> str:
+        if isinstance(value, int) or float(value).is_integer():
+            return str(int(value))
+
+        return repr(float(value))
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import json
+import asyncio
+import tempfile
+from datetime import datetime, timedelta
+from typing import List, Tuple, Union, Dict
+from .base import FirewallBase
+from .expiry_scheduler import ExpiryScheduler
+from .rules import Rule, UserRule
+from .stats import stats
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class RuleCounters:
+    """
+    Cumulative usage of a rule since it was first seen in effect.
+    """
+
+    def __init__(self, first_seen: datetime, packet_count: int = 0, byte_count: int = 0,
+                 last_used: datetime = None, kernel_packet_count: int = 0, kernel_byte_count: int = 0):
+        self.first_seen = first_seen
+        self.packet_count = packet_count
+        self.byte_count = byte_count
+        self.last_used = last_used
+        # Last reading of kernel counters
+        self.kernel_packet_count = kernel_packet_count
+        self.kernel_byte_count = kernel_byte_count
+
+    def unused_since(self) -> datetime:
+        """
+        Time since when rule hasn't been used
+        :return: time of last use, or first seen if never used
+        """
+        return self.last_used if self.last_used else self.first_seen
+
+    def to_dict(self) -> dict:
+        return {
+            "first_seen": self.first_seen.isoformat(),
+            "last_used": self.last_used.isoformat() if self.last_used else None,
+            "packets": self.packet_count,
+            "bytes": self.byte_count,
+            "kernel_packets": self.kernel_packet_count,
+            "kernel_bytes": self.kernel_byte_count,
+        }
+
+    @staticmethod
+    def from_dict(counters_in: dict) -> 'RuleCounters':
+        last_used = counters_in.get("last_used")
+
+        return RuleCounters(datetime.fromisoformat(counters_in["first_seen"]),
+                            packet_count=int(counters_in.get("packets", 0)),
+                            byte_count=int(counters_in.get("bytes", 0)),
+                            last_used=datetime.fromisoformat(last_used) if last_used else None,
+                            kernel_packet_count=int(counters_in.get("kernel_packets", 0)),
+                            kernel_byte_count=int(counters_in.get("kernel_bytes", 0)))
+
+
+class RuleUsage:
+    """
+    Collect cumulative packet and byte counters of rules from firewall.
+    Kernel counters of a rule reset when the rule is re-created, eg. on a forced update. A counter being
+    smaller than its previous reading is taken as a reset, all of it is new traffic.
+    Counters are per rule in firewall. Rules having the same source and service share the counters.
+    Aggregated rules are not supported, traffic of an aggregate cannot be attributed to its members.
+    Optionally usage is kept in a JSON-file to survive restarts.
+    """
+    DEFAULT_INTERVAL = 300
+    STATE_VERSION = 1
+
+    def __init__(self, firewall: FirewallBase, state_file: str = None):
+        """
+        Initialize rule usage
+        :param firewall: Firewall to read counters from, rules must not be aggregated in it
+        :param state_file: (optional) JSON-file to load usage from and save into
+        """
+        self._firewall = firewall
+        self._state_file = state_file
+        self._counters = {}
+        self._timer = None
+
+        if state_file and os.path.exists(state_file):
+            self.load()
+
+    def start(self, loop: asyncio.AbstractEventLoop, expiry_scheduler: ExpiryScheduler,
+              interval: int = DEFAULT_INTERVAL) -> None:
+        """
+        Collect counters of loaded rules now and on every interval.
+        :param loop: Event loop to arm the timer into
+        :param expiry_scheduler: Scheduler having the loaded rules
+        :param interval: Seconds between collections
+        :return:
+        """
+        if interval <= 0:
+            raise ValueError("Rule usage interval {} not allowed! Must be positive.".format(interval))
+
+        def _collect_and_rearm() -> None:
+            self._timer = None
+            try:
+                self.update(expiry_scheduler.rules)
+                if self._state_file:
+                    self.save()
+            except Exception as exc:
+                log.error("Failed to collect rule usage: {}".format(exc))
+            self._timer = loop.call_later(interval, _collect_and_rearm)
+
+        self.cancel()
+        _collect_and_rearm()
+
+    def cancel(self) -> None:
+        """
+        Disarm the timer.
+        :return:
+        """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    @stats.timed("RuleUsage.update")
+    def update(self, rules: List[Rule], now: datetime = None) -> None:
+        """
+        Read counters of rules from firewall and accumulate them.
+        Usage of rules no longer existing is dropped.
+        :param rules: All rules
+        :param now: (optional) current time in UTC
+        :return:
+        """
+        if not now:
+            now = datetime.utcnow()
+        kernel_counters = {}
+        for rule, packet_count, byte_count in self._firewall.query_counters(rules):
+            kernel_counters[self._key(rule)] = (packet_count, byte_count)
+
+        counters_out = {}
+        for rule in rules:
+            key = self._key(rule)
+            if key in counters_out:
+                continue
+            counters = self._counters.get(key)
+            if key not in kernel_counters:
+                if counters:
+                    # Not in effect, counting will restart from zero once it is
+                    counters.kernel_packet_count = 0
+                    counters.kernel_byte_count = 0
+                    counters_out[key] = counters
+                continue
+
+            packet_count, byte_count = kernel_counters[key]
+            if not counters:
+                counters = RuleCounters(now)
+            if packet_count < counters.kernel_packet_count or byte_count < counters.kernel_byte_count:
+                # Counters have been reset
+                new_packets = packet_count
+                new_bytes = byte_count
+            else:
+                new_packets = packet_count - counters.kernel_packet_count
+                new_bytes = byte_count - counters.kernel_byte_count
+            counters.packet_count += new_packets
+            counters.byte_count += new_bytes
+            if new_packets:
+                counters.last_used = now
+            counters.kernel_packet_count = packet_count
+            counters.kernel_byte_count = byte_count
+            counters_out[key] = counters
+
+        self._counters = counters_out
+
+    def report(self, rules: List[Rule], unused_days: int = None,
+               now: datetime = None) -> List[Tuple[Rule, RuleCounters]]:
+        """
+        Usage of rules
+        :param rules: All rules
+        :param unused_days: (optional) Report only rules not used for this many days
+        :param now: (optional) current time in UTC
+        :return: list of tuples, tuple: rule object, counters. Rules never seen in effect are not listed.
+        """
+        if unused_days is not None and unused_days < 0:
+            raise ValueError("Days {} not allowed! Must not be negative.".format(unused_days))
+        if not now:
+            now = datetime.utcnow()
+
+        rules_out = []
+        for rule in rules:
+            counters = self._counters.get(self._key(rule))
+            if not counters:
+                continue
+            if unused_days is not None and counters.unused_since() > now - timedelta(days=unused_days):
+                continue
+            rules_out.append((rule, counters))
+
+        return rules_out
+
+    def load(self) -> None:
+        """
+        Load usage from state file.
+        :return:
+        """
+        with open(self._state_file, "r") as state_file:
+            state = json.load(state_file)
+        if state.get("version") != self.STATE_VERSION:
+            raise ValueError("Rule usage state file {} has unknown version {}!".format(
+                self._state_file, state.get("version")
+            ))
+
+        self._counters = {key: RuleCounters.from_dict(counters) for key, counters in state["rules"].items()}
+        log.debug("Loaded usage of {} rules from {}".format(len(self._counters), self._state_file))
+
+    def save(self) -> None:
+        """
+        Write usage into a temporary file and replace the state file with it.
+        :return:
+        """
+        state = {
+            "version": self.STATE_VERSION,
+            "rules": {key: counters.to_dict() for key, counters in self._counters.items()}
+        }
+        directory = os.path.dirname(os.path.abspath(self._state_file))
+        fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=".{}.".format(os.path.basename(self._state_file)),
+                                             suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as state_file:
+                json.dump(state, state_file)
+            os.replace(temp_filename, self._state_file)
+        except Exception:
+            os.unlink(temp_filename)
+            raise
+
+    @staticmethod
+    def _key(rule: Rule) -> str:
+        """
+        Key of a rule, stable over restarts. Expiry is not part of it, extending a rule will keep its usage.
+        """
+        owner = rule.owner if isinstance(rule, UserRule) else ""
+
+        return repr((owner,) + rule.identity())
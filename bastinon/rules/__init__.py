@@ -4,9 +4,15 @@ from .service_reader import ServiceReader
 from .rule import Rule
 from .user_rule import UserRule
 from .shared_rule import SharedRule
-from .service import Service
+from .service import Service, PortRange
+from .service_registry import ServiceRegistry
 from .firewall_rule import FirewallRule
+from .rule_aggregator import RuleAggregator, AggregatedRule
+from .schema_cache import SchemaCache, schema_cache
+from .file_cache import FileCache, file_cache
 
 __all__ = ['RuleReader', 'RuleWriter', 'ServiceReader',
            'Rule', 'UserRule', 'SharedRule',
-           'Service', 'FirewallRule']
+           'Service', 'PortRange', 'ServiceRegistry', 'FirewallRule',
+           'RuleAggregator', 'AggregatedRule', 'SchemaCache', 'schema_cache',
+           'FileCache', 'file_cache']
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import threading
+from typing import Any, Hashable, Iterable
+from ..stats import stats
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class FileCache:
+    """
+    Parsed files of the process, keyed by filename.
+    Cached value is valid as long as the file's version, its inode, modification time and size, stays the same.
+    A value can depend on an object, eg. rules on the services they were parsed with. A value parsed with
+    a different object isn't valid.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Key: filename, value: tuple: file version, depends on, parsed value
+        self._files = {}
+
+    @staticmethod
+    def version(stat_result: os.stat_result) -> tuple:
+        """
+        Version of a file
+        :param stat_result: result of stat() of the file
+        :return: tuple: inode, modification time in ns, size
+        """
+        return stat_result.st_ino, stat_result.st_mtime_ns, stat_result.st_size
+
+    def get(self, filename: str, version: Hashable, depends: Any = None) -> Any:
+        """
+        Get parsed value of a file
+        :param filename: parsed file
+        :param version: current version of the file
+        :param depends: (optional) object the value needs to have been parsed with
+        :return: parsed value, None if not cached or outdated
+        """
+        with self._lock:
+            cached = self._files.get(filename)
+        if not cached or cached[0] != version or cached[1] is not depends:
+            stats.increment("FileCache.miss")
+            return None
+
+        stats.increment("FileCache.hit")
+
+        return cached[2]
+
+    def set(self, filename: str, version: Hashable, value: Any, depends: Any = None) -> None:
+        """
+        Cache parsed value of a file
+        :param filename: parsed file
+        :param version: version of the file when it was parsed
+        :param value: parsed value
+        :param depends: (optional) object the value was parsed with
+        :return:
+        """
+        with self._lock:
+            self._files[filename] = (version, depends, value)
+
+    def forget(self, filename: str) -> None:
+        with self._lock:
+            self._files.pop(filename, None)
+
+    def prune(self, directory: str, filenames: Iterable[str]) -> None:
+        """
+        Forget files of a directory, which don't exist anymore
+        :param directory: directory of the files
+        :param filenames: files of the directory still existing
+        :return:
+        """
+        existing = set(filenames)
+        with self._lock:
+            removed = [filename for filename in self._files
+                       if os.path.dirname(filename) == directory and filename not in existing]
+            for filename in removed:
+                del self._files[filename]
+        if removed:
+            log.debug("Forgot {} removed files of {}".format(len(removed), directory))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._files = {}
+
+
+file_cache = FileCache()
@@ -1,17 +1,19 @@
 from typing import List, Union, Dict
 from .rule import Rule
-from .service import Service
+from .service import Service, PortRange
+from .service_registry import ServiceRegistry
 
 
 class FirewallRule(Rule):
 
-    def __init__(self, proto: str, port: int, service: Service, source_address, comment: str = None):
+    def __init__(self, proto: str, port: Union[int, PortRange], service: Service, source_address,
+                 comment: str = None):
         super().__init__(service, source_address, comment=comment)
         self.proto = proto
         self.port = port
         self.expiry = None
 
-    def has_expired(self) -> bool:
+    def has_expired(self, now=None) -> bool:
         raise RuntimeError("IptablesRule has no expiry!")
 
     def __str__(self) -> str:
@@ -21,7 +23,10 @@ class FirewallRule(Rule):
         )
 
     @staticmethod
-    def find_service(proto: str, port: int, services: Dict[str, Service]) -> Union[Service, None]:
+    def find_service(proto: str, port: Union[int, PortRange], services: Dict[str, Service]) -> Union[Service, None]:
+        if isinstance(services, ServiceRegistry):
+            return services.find(proto, port)
+
         for service_name, service in services.items():
             if service.matches(proto, port):
                 return service
@@ -33,6 +33,13 @@ class Rule:
         self.source_address = source
         self.source_is_network = is_network
 
+    @property
+    def source_network(self) -> Union[ipaddress.IPv4Network, ipaddress.IPv6Network]:
+        """
+        Source as a network. Single address is a host network, /32 for IPv4 and /128 for IPv6.
+        """
+        return ipaddress.ip_network(self.source_address)
+
     @property
     def max_ipv4_network_size(self) -> int:
         return self._max_ipv4_network_size
@@ -55,11 +62,17 @@ class Rule:
 
         self._max_ipv6_network_size = size
 
-    def has_expired(self) -> bool:
+    def has_expired(self, now: datetime = None) -> bool:
+        """
+        Check if rule has expired
+        :param now: (optional) current time in UTC, to avoid getting the time for every rule
+        :return: True = expired
+        """
         if not self.expiry:
             return False
 
-        now = datetime.utcnow()
+        if not now:
+            now = datetime.utcnow()
         if now > self.expiry:
             return True
 
@@ -73,7 +86,8 @@ class Rule:
         if self.source_address_family != address_family:
             return False
 
-        if self.source_address != source:
+        # Compare as networks: 192.0.2.1 and 192.0.2.1/32 are the same source
+        if self.source_network != ipaddress.ip_network(source):
             return False
 
         if comment:
@@ -83,6 +97,21 @@ class Rule:
 
         return True
 
+    def identity(self) -> tuple:
+        """
+        Normalized identity of the rule, usable as a dictionary key.
+        Rules having equal identity will match each other.
+        Identity covers all protocols and ports of the service, a firewall matches each of them separately.
+        :return: tuple: address family, service code, source network as (address, prefix length), comment
+        """
+        # Note: Avoid creating network objects, integers are much faster to produce and hash
+        if self.source_is_network:
+            source = (int(self.source_address.network_address), self.source_address.prefixlen)
+        else:
+            source = (int(self.source_address), self.source_address.max_prefixlen)
+
+        return self.source_address_family, self.service.code, source, self.comment
+
     def network_size_valid(self, raise_on_invalid: bool) -> Union[bool, None]:
         if not self.source_is_network:
             # Not applicable
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import bisect
+import ipaddress
+from typing import Tuple, List, Union
+from .rule import Rule
+from .shared_rule import SharedRule
+from .service import Service
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class AggregatedRule(SharedRule):
+    """
+    Rule covering sources of multiple user and shared rules.
+    """
+
+    def __init__(self, service: Service, source_address, members: List[Rule]):
+        # Aggregate expires with its first expiring member. Re-aggregation will leave the expired member out.
+        expiries = [rule.expiry for rule in members if rule.expiry]
+        super().__init__(service, source_address, expiry=min(expiries) if expiries else None)
+        self.members = members
+
+    def __str__(self) -> str:
+        return "Aggregated IPv{} rule of {} rules: {} allowed from {}, Expiry: {}".format(
+            self.source_address_family,
+            len(self.members),
+            self.service, self.source,
+            self.expiry
+        )
+
+
+class RuleAggregator:
+    """
+    Collapse overlapping and adjacent sources of rules into as few rules as possible.
+    Aggregation is done per service and address family, it won't create networks bigger than allowed by policy.
+    """
+
+    def __init__(self, max_ipv4_network_size: int = Rule.DEFAULT_MAX_IPV4_NETWORK_SIZE,
+                 max_ipv6_network_size: int = Rule.DEFAULT_MAX_IPV6_NETWORK_SIZE):
+        self.max_ipv4_network_size = max_ipv4_network_size
+        self.max_ipv6_network_size = max_ipv6_network_size
+        self._aggregates = {}
+
+    def aggregate(self, rules: List[Rule]) -> List[Rule]:
+        """
+        Aggregate rules.
+        Rules not aggregated with any other rule are returned as-is.
+        :param rules: list of user and shared rules
+        :return: list of rules, aggregated ones are AggregatedRule
+        """
+        self._aggregates = {}
+        rules_out = []
+        groups = {}
+        for rule in rules:
+            if rule.has_expired() or rule.network_size_valid(False) is False:
+                # Let firewall deal with these
+                rules_out.append(rule)
+                continue
+            groups.setdefault((rule.service.code, rule.source_address_family), []).append(rule)
+
+        for (_, ip_version), group in groups.items():
+            if len(group) == 1:
+                rules_out.extend(group)
+                continue
+
+            max_size = self.max_ipv4_network_size if ip_version == 4 else self.max_ipv6_network_size
+            networks = self._collapse([rule.source_network for rule in group], max_size)
+
+            # Networks are disjoint, find the one containing each rule by its address
+            network_starts = [int(network.network_address) for network in networks]
+            members = [[] for _ in networks]
+            for rule in group:
+                idx = bisect.bisect_right(network_starts, int(rule.source_network.network_address)) - 1
+                members[idx].append(rule)
+
+            for network, network_members in zip(networks, members):
+                if len(network_members) == 1:
+                    rules_out.append(network_members[0])
+                    continue
+                aggregated_rule = self._aggregated_rule(network_members[0].service, network, network_members)
+                self._aggregates[aggregated_rule.identity()] = aggregated_rule
+                rules_out.append(aggregated_rule)
+
+        log.debug("Aggregated {} rules into {} rules".format(len(rules), len(rules_out)))
+
+        return rules_out
+
+    def expand(self, rules: List[Tuple[Rule, bool]]) -> List[Tuple[Rule, bool]]:
+        """
+        Expand firewall query results of aggregated rules back to the rules they were aggregated from.
+        :param rules: list of tuples, tuple: rule object, rule in effect
+        :return: list of tuples, tuple: rule object, rule in effect
+        """
+        rules_out = []
+        for rule, in_effect in rules:
+            aggregated_rule = self._aggregates.get(rule.identity())
+            if aggregated_rule:
+                rules_out.extend([(member, in_effect) for member in aggregated_rule.members])
+            else:
+                rules_out.append((rule, in_effect))
+
+        return rules_out
+
+    def _aggregated_rule(self, service: Service, network: Union[ipaddress.IPv4Network, ipaddress.IPv6Network],
+                         members: List[Rule]) -> AggregatedRule:
+        if network.prefixlen == network.max_prefixlen:
+            source = network.network_address
+        else:
+            source = network
+        aggregated_rule = AggregatedRule(service, source, members)
+        aggregated_rule.max_ipv4_network_size = self.max_ipv4_network_size
+        aggregated_rule.max_ipv6_network_size = self.max_ipv6_network_size
+
+        return aggregated_rule
+
+    @staticmethod
+    def _collapse(networks: list, max_size: int) -> list:
+        """
+        Collapse networks, but not into networks bigger than allowed.
+        :param networks: list of networks of same address family
+        :param max_size: smallest allowed prefix length
+        :return: sorted list of disjoint networks
+        """
+        networks_out = []
+        for network in ipaddress.collapse_addresses(networks):
+            if network.prefixlen < max_size:
+                # All of the network is covered, split it into allowed size
+                networks_out.extend(network.subnets(new_prefix=max_size))
+            else:
+                networks_out.append(network)
+
+        return networks_out
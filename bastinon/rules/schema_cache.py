@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import io
+import os
+import threading
+from hashlib import sha256
+from lxml import etree
+from ..stats import stats
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SchemaCache:
+    """
+    Compiled XML schemas of the process. A schema is compiled again only if its file has changed.
+    With trust_validated, a document having the same content as one already valid against the same schema
+    won't be validated again.
+    """
+
+    def __init__(self, trust_validated: bool = False):
+        self.trust_validated = trust_validated
+        self._lock = threading.Lock()
+        # Key: schema filename, value: tuple: file version, compiled schema, digests of valid documents
+        self._schemas = {}
+
+    def parse(self, filename: str, schema_filename: str) -> etree._ElementTree:
+        """
+        Parse and validate an XML-file
+        :param filename: XML-file to parse
+        :param schema_filename: XSD-file to validate against
+        :return: parsed document
+        """
+        with open(filename, "rb") as xml_file:
+            content = xml_file.read()
+        doc = etree.parse(io.BytesIO(content), base_url=filename)
+
+        _, schema, valid_digests = self._schema(schema_filename)
+        digest = sha256(content).digest() if self.trust_validated else None
+        if digest and digest in valid_digests:
+            stats.increment("SchemaCache.trusted")
+            return doc
+
+        if not schema.validate(doc):
+            raise ValueError("XML {} is not valid according to XSD file {}! Error: {}".format(
+                filename, schema_filename, schema.error_log))
+        if digest:
+            valid_digests.add(digest)
+
+        return doc
+
+    def clear(self) -> None:
+        with self._lock:
+            self._schemas = {}
+
+    def _schema(self, schema_filename: str) -> tuple:
+        stat = os.stat(schema_filename)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._schemas.get(schema_filename)
+            if cached and cached[0] == version:
+                return cached
+
+        log.debug("Compiling XML schema {}".format(schema_filename))
+        with stats.timer("SchemaCache.compile"):
+            schema = etree.XMLSchema(etree.parse(schema_filename))
+        cached = (version, schema, set())
+        with self._lock:
+            self._schemas[schema_filename] = cached
+
+        return cached
+
+
+schema_cache = SchemaCache()
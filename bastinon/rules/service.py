@@ -1,4 +1,13 @@
-from typing import Tuple, Generator
+from typing import Tuple, Generator, NamedTuple, Union
+import bisect
+
+
+class PortRange(NamedTuple):
+    first: int
+    last: int
+
+    def __str__(self) -> str:
+        return "{}-{}".format(self.first, self.last)
 
 
 class Service:
@@ -14,39 +23,99 @@ class Service:
     def __init__(self, code: str, name: str, protocol_definition: dict):
         """
         Construct a firewall service
-        :param protocol_definition: dict of known protocols, key is protocol, value is list of ports
+        :param protocol_definition: dict of known protocols, key is protocol, value is list of ports.
+                                    A port is either a port number or a PortRange.
         """
         self.code = code
         self.name = name
         if not protocol_definition:
             raise ValueError("Need a protocol definition with ports!")
 
+        definition = {}
         for proto in protocol_definition.keys():
             if proto not in self.PROTOCOLS:
                 raise ValueError("Proto '{}' not allowed! Known are: {}".format(proto, ', '.join(self.PROTOCOLS)))
             if not isinstance(protocol_definition[proto], list):
                 raise ValueError("Proto '{}' definition invalid! Need to have a list of ports".format(proto))
+            definition[proto] = []
             for port in protocol_definition[proto]:
-                if port < self.PORTS[proto][0] or port > self.PORTS[proto][1]:
-                    raise ValueError("Port {} not allowed! Must be between {} and {}!".format(
-                        port, self.PORTS[proto][0], self.PORTS[proto][1]
-                    ))
+                if isinstance(port, tuple):
+                    first, last = port
+                else:
+                    first = last = port
+                for port_number in (first, last):
+                    if port_number < self.PORTS[proto][0] or port_number > self.PORTS[proto][1]:
+                        raise ValueError("Port {} not allowed! Must be between {} and {}!".format(
+                            port_number, self.PORTS[proto][0], self.PORTS[proto][1]
+                        ))
+                if first > last:
+                    raise ValueError("Port range {}-{} not allowed! Range must be ascending.".format(first, last))
+
+                # Single-port range is a port
+                definition[proto].append(first if first == last else PortRange(first, last))
+
+        self.protocol_definition = definition
 
-        self.protocol_definition = protocol_definition
+        # Merged and sorted intervals per protocol for matching
+        self._port_intervals = {}
+        for proto, ports in definition.items():
+            intervals = []
+            for first, last in sorted(self._port_interval(port) for port in ports):
+                if intervals and first <= intervals[-1][1] + 1:
+                    intervals[-1] = (intervals[-1][0], max(intervals[-1][1], last))
+                else:
+                    intervals.append((first, last))
+            self._port_intervals[proto] = intervals
 
-    def matches(self, proto: str, port: int) -> bool:
+    @staticmethod
+    def parse_port(port_in: str, separator: str = '-') -> Union[int, PortRange]:
+        """
+        Parse a port or a port range
+        :param port_in: port, eg. "22", or a port range, eg. "6000-6100"
+        :param separator: separator between first and last port of a range
+        :return: port number or PortRange
+        """
+        try:
+            if separator in port_in:
+                first, last = port_in.split(separator, 1)
+                return PortRange(int(first), int(last))
+
+            return int(port_in)
+        except ValueError:
+            raise ValueError("Port '{}' is not a port or a port range!".format(port_in))
+
+    def matches(self, proto: str, port: Union[int, PortRange]) -> bool:
         """
         Match protocol/port-pair into a service
         :param proto: protocol to match
-        :param port: port to match
+        :param port: port to match, a port range matches only if all of it is in the service
         :return: boolean value if given proto/port-pair matches this service
         """
-        if proto not in self.protocol_definition:
+        if proto not in self._port_intervals:
+            return False
+
+        first, last = self._port_interval(port)
+        intervals = self._port_intervals[proto]
+        idx = bisect.bisect_right(intervals, (first, self.PORTS[proto][1])) - 1
+        if idx < 0:
+            return False
+
+        return intervals[idx][0] <= first and last <= intervals[idx][1]
+
+    def overlaps(self, proto: str, port: Union[int, PortRange]) -> bool:
+        """
+        Check if any of the protocol/port-pair is in this service
+        :param proto: protocol to check
+        :param port: port or port range to check
+        :return: boolean value if any port is shared with this service
+        """
+        if proto not in self._port_intervals:
             return False
 
-        matched_proto_definition = self.protocol_definition[proto]
-        if port in matched_proto_definition:
-            return True
+        first, last = self._port_interval(port)
+        for interval_first, interval_last in self._port_intervals[proto]:
+            if interval_first <= last and first <= interval_last:
+                return True
 
         return False
 
@@ -62,7 +131,23 @@ class Service:
 
         return "{} [{}]".format(self.name, out)
 
-    def enumerate(self) -> Generator[Tuple[str, int], None, None]:
+    def enumerate(self) -> Generator[Tuple[str, Union[int, PortRange]], None, None]:
         for proto in self.protocol_definition.keys():
             for port in self.protocol_definition[proto]:
                 yield proto, port
+
+    def port_intervals(self) -> Generator[Tuple[str, int, int], None, None]:
+        """
+        Ports of the service as merged intervals, sorted per protocol
+        :return: generator of tuples, tuple: protocol, first port, last port
+        """
+        for proto, intervals in self._port_intervals.items():
+            for first, last in intervals:
+                yield proto, first, last
+
+    @staticmethod
+    def _port_interval(port: Union[int, PortRange]) -> Tuple[int, int]:
+        if isinstance(port, PortRange):
+            return port.first, port.last
+
+        return port, port
@@ -19,9 +19,12 @@
 
 import os
 import sys
-from typing import List, Dict
-from lxml import etree
+from typing import List
 from .service import Service
+from .service_registry import ServiceRegistry
+from .schema_cache import schema_cache
+from .file_cache import FileCache, file_cache
+from ..stats import stats
 import logging
 
 log = logging.getLogger(__name__)
@@ -39,29 +42,40 @@ class ServiceReader:
 
         self._path = rule_path
 
-    def read_all(self) -> Dict[str, Service]:
-        services_out = {}
+    @stats.timed("ServiceReader.read_all")
+    def read_all(self) -> ServiceRegistry:
         services_path = "{}/{}".format(self._path, self.SERVICES_PATH)
-        for item in os.listdir(services_path):
-            if not item.endswith('.xml'):
-                continue
-            xml_file = os.path.join(services_path, item)
-            if os.path.isfile(xml_file):
-                service_name = item.replace('.xml', '')
-                service_definition = self._read_service_definition(service_name, xml_file)
-                services_out[service_name] = service_definition
+        # Sorted for predictable resolving of any overlapping ports
+        service_files = []
+        with os.scandir(services_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.xml') and entry.is_file():
+                    service_files.append((entry.name, entry.path, FileCache.version(entry.stat())))
+        service_files.sort()
+
+        # Registry is read again only if any of the service files has changed
+        version = tuple((item, file_version) for item, _, file_version in service_files)
+        services_out = file_cache.get(services_path, version)
+        if services_out is not None:
+            # Cached registry is never handed out, callers are free to modify their copy
+            return services_out.copy()
+
+        services_out = ServiceRegistry()
+        for item, xml_file, _ in service_files:
+            service_name = item.replace('.xml', '')
+            service_definition = self._read_service_definition(service_name, xml_file)
+            services_out[service_name] = service_definition
+        services_out.check_overlaps()
+        file_cache.set(services_path, version, services_out)
 
-        return services_out
+        return services_out.copy()
 
     def _read_service_definition(self, service_code: str, filename: str) -> Service:
         # XXX Debug noise:
         # log.debug("Reading service file: {}".format(filename))
-        root = etree.parse(filename)
-        schema_filename = "{}/xml-schemas/service.xsd".format(sys.prefix)
-        schema_doc = etree.parse(schema_filename)
-        schema = etree.XMLSchema(schema_doc)
-        if not schema.validate(root):
-            raise ValueError("Service-XML {} is not valid! Error: {}".format(filename, schema.error_log))
+        with stats.timer("ServiceReader.parse_xml"):
+            schema_filename = "{}/xml-schemas/service.xsd".format(sys.prefix)
+            root = schema_cache.parse(filename, schema_filename)
 
         service_name = None
         service_definition = {}
@@ -82,7 +96,10 @@ class ServiceReader:
                 raise ValueError("Unknown protocol '{}'! Service file: {}".format(elem.attrib['protocol'], filename))
 
             ip_protocol = elem.attrib['protocol']
-            port = int(elem.attrib['port'])
+            try:
+                port = Service.parse_port(elem.attrib['port'])
+            except ValueError as exc:
+                raise ValueError("{} Service file: {}".format(exc, filename))
 
             if ip_protocol in service_definition:
                 service_definition[ip_protocol].append(port)
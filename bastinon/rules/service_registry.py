@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+from typing import Union, Iterable, List, Tuple
+from .service import Service, PortRange
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ServiceRegistry(dict):
+    """
+    All defined services, keyed by service code.
+    In addition to being a dict, keeps an index of protocol/port-pairs for finding a service in constant time.
+    Overlapping services are reported by check_overlaps(), once all services are in.
+    """
+
+    def __init__(self, services: Iterable[Service] = None):
+        super().__init__()
+        self._index = {}
+        if services:
+            for service in services:
+                self[service.code] = service
+            self.check_overlaps()
+
+    def __setitem__(self, service_code: str, service: Service) -> None:
+        if service_code in self:
+            super().__setitem__(service_code, service)
+            self._reindex()
+            return
+
+        super().__setitem__(service_code, service)
+        self._add_to_index(service)
+
+    def __delitem__(self, service_code: str) -> None:
+        super().__delitem__(service_code)
+        self._reindex()
+
+    def update(self, *args, **kwargs) -> None:
+        for service_code, service in dict(*args, **kwargs).items():
+            self[service_code] = service
+
+    def setdefault(self, service_code: str, service: Service = None) -> Service:
+        if service_code not in self:
+            self[service_code] = service
+
+        return self[service_code]
+
+    def pop(self, service_code: str, *default) -> Service:
+        if service_code not in self:
+            return super().pop(service_code, *default)
+
+        service = super().pop(service_code)
+        self._reindex()
+
+        return service
+
+    def popitem(self) -> Tuple[str, Service]:
+        item = super().popitem()
+        self._reindex()
+
+        return item
+
+    def clear(self) -> None:
+        super().clear()
+        self._index = {}
+
+    def copy(self) -> 'ServiceRegistry':
+        """
+        Shallow copy of the registry, services are shared
+        :return: registry
+        """
+        registry = ServiceRegistry()
+        super(ServiceRegistry, registry).update(self)
+        registry._index = dict(self._index)
+
+        return registry
+
+    __copy__ = copy
+
+    def find(self, proto: str, port: Union[int, PortRange]) -> Union[Service, None]:
+        """
+        Find the service having a protocol/port-pair
+        :param proto: protocol to match
+        :param port: port or port range to match, exactly as in the service definition
+        :return: service or None if no service has the pair
+        """
+        return self._index.get((proto, port))
+
+    def check_overlaps(self) -> List[Tuple[str, Service, Service]]:
+        """
+        Find services sharing any ports. Every overlapping pair is logged once.
+        Ports of all services are swept in a single sorted pass per protocol.
+        :return: list of tuples, tuple: protocol, first service, second service. First one was defined first.
+        """
+        order = {service.code: idx for idx, service in enumerate(self.values())}
+        intervals = sorted(
+            (proto, first, last, order[service.code], service)
+            for service in self.values()
+            for proto, first, last in service.port_intervals()
+        )
+
+        overlaps = []
+        seen = set()
+        active = []
+        active_proto = None
+        for proto, first, last, service_order, service in intervals:
+            if proto != active_proto:
+                active = []
+                active_proto = proto
+            # Intervals ending before this one starts won't overlap with any of the rest
+            active = [interval for interval in active if interval[0] >= first]
+            for _, other_order, other in active:
+                if other is service:
+                    continue
+                pair = (proto,) + tuple(sorted((other_order, service_order)))
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                first_service, second_service = (other, service) if other_order < service_order else (service, other)
+                overlaps.append((proto, first_service, second_service))
+            active.append((last, service_order, service))
+
+        for proto, first_service, second_service in overlaps:
+            log.warning("Services '{}' and '{}' have overlapping {}-ports!".format(
+                first_service.code, second_service.code, proto.upper()
+            ))
+
+        return overlaps
+
+    def _add_to_index(self, service: Service) -> None:
+        # First service defining a protocol/port-pair owns it
+        for proto_port in service.enumerate():
+            self._index.setdefault(proto_port, service)
+
+    def _reindex(self) -> None:
+        self._index = {}
+        for service in self.values():
+            self._add_to_index(service)
@@ -19,13 +19,17 @@
 
 import os
 import sys
-from typing import List, Tuple, Union, Dict
+import copy
+from typing import List, Tuple, Union, Dict, Callable
 from lxml import etree
 from pwd import getpwnam
 from datetime import datetime
 from .service_reader import ServiceReader
 from .user_rule import UserRule, Service
 from .shared_rule import SharedRule
+from .schema_cache import schema_cache
+from .file_cache import FileCache, file_cache
+from ..stats import stats
 import logging
 
 log = logging.getLogger(__name__)
@@ -59,6 +63,7 @@ class RuleReader:
 
         return os.path.exists(filename)
 
+    @stats.timed("RuleReader.read_all_users")
     def read_all_users(self, read_shared_rules: bool) -> List[UserRule]:
         if not self.all_services:
             reader = ServiceReader(self._path)
@@ -69,38 +74,43 @@ class RuleReader:
         shared_rules_path = "{}/{}".format(self._path, self.SHARED_RULE_PATH)
 
         # Iterate users
-        for item in os.listdir(user_rules_path):
-            if not item.endswith('.xml'):
-                continue
-            xml_file = os.path.join(user_rules_path, item)
-            if os.path.isfile(xml_file):
-                user_from_filename = item[:-4]
-                try:
-                    unix_user_passwd_record = getpwnam(user_from_filename)
-                except KeyError:
+        user_files = []
+        with os.scandir(user_rules_path) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.xml') or not entry.is_file():
+                    continue
+                user_files.append(entry.path)
+                user_from_filename = entry.name[:-4]
+                user = self._unix_user(user_from_filename)
+                if not user:
                     log.warning("User '{}' has firewall-rule file, but doesn't exist in this system! "
                                 "Ignoring.".format(user_from_filename))
                     continue
-                user = unix_user_passwd_record.pw_name
-                rules = self._user_rule_reader(user, xml_file, self.all_services)
+                rules = self._cached_rules(entry.path, entry.stat(),
+                                           lambda: self._user_rule_reader(user, entry.path, self.all_services))
                 all_rules.extend(rules)
+        file_cache.prune(user_rules_path, user_files)
 
         # Iterate shared files (if any)
         if read_shared_rules:
             log.debug("Shared rules path: {}".format(shared_rules_path))
             if os.path.exists(shared_rules_path):
-                for item in os.listdir(shared_rules_path):
-                    if not item.endswith('.xml'):
-                        continue
-                    xml_file = os.path.join(shared_rules_path, item)
-                    if os.path.isfile(xml_file):
-                        rules = self._shared_rule_reader(xml_file, self.all_services)
+                shared_files = []
+                with os.scandir(shared_rules_path) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith('.xml') or not entry.is_file():
+                            continue
+                        shared_files.append(entry.path)
+                        rules = self._cached_rules(entry.path, entry.stat(),
+                                                   lambda: self._shared_rule_reader(entry.path, self.all_services))
                         all_rules.extend(rules)
+                file_cache.prune(shared_rules_path, shared_files)
             else:
                 log.warning("Shared rules directory doesn't exist! Ignoring.")
 
         return all_rules
 
+    @stats.timed("RuleReader.read")
     def read(self, user: str) -> List[UserRule]:
         if not self.has_rules_for(user):
             raise ValueError("Cannot read rules for user {}! No rules found.".format(user))
@@ -110,7 +120,8 @@ class RuleReader:
             self.all_services = reader.read_all()
 
         filename = self._rule_filename(user)
-        rules = self._user_rule_reader(user, filename, self.all_services)
+        rules = self._cached_rules(filename, os.stat(filename),
+                                   lambda: self._user_rule_reader(user, filename, self.all_services))
         for rule in rules:
             if rule.source_address_family == 4 and self._max_ipv4_network_size:
                 rule.max_ipv4_network_size = self._max_ipv4_network_size
@@ -119,6 +130,39 @@ class RuleReader:
 
         return rules
 
+    def _cached_rules(self, rules_filename: str, stat_result: os.stat_result,
+                      reader: Callable[[], List[Union[UserRule, SharedRule]]]) -> List[Union[UserRule, SharedRule]]:
+        """
+        Get rules of a file, read the file only if it has changed since last read
+        :param rules_filename: rule file
+        :param stat_result: result of stat() of the file
+        :param reader: function to read rules of the file
+        :return: list of rules
+        """
+        version = FileCache.version(stat_result)
+        rules = file_cache.get(rules_filename, version, self.all_services)
+        if rules is None:
+            rules = reader()
+            file_cache.set(rules_filename, version, rules, self.all_services)
+
+        # Cached rules are never handed out, callers are free to modify the list and the rules
+        return [copy.copy(rule) for rule in rules]
+
+    @staticmethod
+    @stats.timed("RuleReader.nss_lookup")
+    def _unix_user(user: str) -> Union[str, None]:
+        """
+        Get login name of a Unix user
+        :param user: user name
+        :return: login name, None if user doesn't exist in this system
+        """
+        try:
+            unix_user_passwd_record = getpwnam(user)
+        except KeyError:
+            return None
+
+        return unix_user_passwd_record.pw_name
+
     @staticmethod
     def _user_rule_reader(user: str, user_rules_filename: str, services: Dict[str, Service]) -> List[UserRule]:
         log.debug("For user {}, reading rule file: {}".format(user, user_rules_filename))
@@ -134,13 +178,9 @@ class RuleReader:
     def _rule_reader(rules_filename: str, services: Dict[str, Service],
                      user: str = None, shared: str = None) -> List[Union[UserRule, SharedRule]]:
         # log.debug("Reading rule file: {}".format(rules_filename))
-        root = etree.parse(rules_filename)
-        schema_filename = "{}/xml-schemas/user_rule.xsd".format(sys.prefix)
-        schema_doc = etree.parse(schema_filename)
-        schema = etree.XMLSchema(schema_doc)
-        if not schema.validate(root):
-            raise ValueError("Rule-XML {} is not valid according to XSD file {}! Error: {}".format(
-                rules_filename, schema_filename, schema.error_log))
+        with stats.timer("RuleReader.parse_xml"):
+            schema_filename = "{}/xml-schemas/user_rule.xsd".format(sys.prefix)
+            root = schema_cache.parse(rules_filename, schema_filename)
 
         rules = []
         for zone_elem in root.iter(tag="zone"):
@@ -27,6 +27,8 @@ from .user_reader import RuleReader
 from .service_reader import ServiceReader
 from .user_rule import UserRule
 from .service import Service
+from .file_cache import file_cache
+from ..stats import stats
 import logging
 
 log = logging.getLogger(__name__)
@@ -35,6 +37,7 @@ log = logging.getLogger(__name__)
 class RuleWriter(RuleReader):
     XML_NS = r"https://raw.githubusercontent.com/HQJaTu/firewall-updater/master/xml/user_rule.xsd"
 
+    @stats.timed("RuleWriter.write")
     def write(self, user: str, rules: List[UserRule]) -> List[UserRule]:
         """
         Write a set of user's rules into XML
@@ -65,6 +68,8 @@ class RuleWriter(RuleReader):
         filename = self._rule_filename(user)
 
         rules = self._user_rule_writer(user, filename, self.all_services, rules)
+        # Rewritten file may look unchanged, if done within timestamp granularity
+        file_cache.forget(filename)
 
         return rules
 
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Dict, Callable, Iterator
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+    Percentiles are estimated by interpolating within the bucket having the requested rank.
+    """
+    # Upper bounds of buckets in seconds, last bucket is unbounded
+    BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> float:
+        """
+        Estimate a percentile
+        :param percent: percentile, 0 - 100
+        :return: estimated value, 0.0 if nothing has been observed
+        """
+        if not self.count:
+            return 0.0
+
+        rank = self.count * percent / 100.0
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.counts):
+            if not bucket_count or cumulative + bucket_count < rank:
+                cumulative += bucket_count
+                continue
+            if idx == len(self.BUCKETS):
+                # Unbounded bucket, best guess is the biggest value seen
+                return self.max
+            lower = self.BUCKETS[idx - 1] if idx > 0 else 0.0
+            upper = min(self.BUCKETS[idx], self.max)
+
+            return lower + (upper - lower) * max(0.0, rank - cumulative) / bucket_count
+
+        return self.max
+
+
+class Stats:
+    """
+    Counters, gauges and latency histograms of processing phases.
+    For every histogram, the last observation and number of failures are kept too.
+    Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._last = {}
+        self._errors = {}
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, seconds: float, ok: bool = True) -> None:
+        """
+        Add an observation into a histogram
+        :param name: name of histogram
+        :param seconds: duration
+        :param ok: False = the timed operation failed
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if not histogram:
+                histogram = Histogram()
+                self._histograms[name] = histogram
+                self._errors[name] = 0
+            histogram.observe(seconds)
+            self._last[name] = (seconds, ok, time.time())
+            if not ok:
+                self._errors[name] += 1
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Time a block of code into a histogram
+        :param name: name of histogram
+        """
+        start = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.observe(name, time.perf_counter() - start, ok)
+
+    def timed(self, name: str) -> Callable:
+        """
+        Decorator for timing a function into a histogram.
+        Attributes of the function are kept, eg. a D-Bus method definition.
+        :param name: name of histogram
+        """
+
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get current values
+        :return: dict, key: name, value: dict. Counters have count, gauges have value.
+                 Histograms have count, sum, max, p50, p95, p99, errors and of the last observation
+                 last (duration), last_ok (1 or 0) and last_time (Unix time).
+        """
+        with self._lock:
+            stats_out = {name: {"count": value} for name, value in self._counters.items()}
+            stats_out.update({name: {"value": value} for name, value in self._gauges.items()})
+            for name, histogram in self._histograms.items():
+                last, last_ok, last_time = self._last[name]
+                stats_out[name] = {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "max": histogram.max,
+                    "p50": histogram.percentile(50),
+                    "p95": histogram.percentile(95),
+                    "p99": histogram.percentile(99),
+                    "errors": self._errors[name],
+                    "last": last,
+                    "last_ok": 1 if last_ok else 0,
+                    "last_time": last_time,
+                }
+
+        return stats_out
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+            self._last = {}
+            self._errors = {}
+
+    def format(self, snapshot: Dict[str, Dict[str, float]] = None) -> str:
+        """
+        Current values as a human-readable table
+        :param snapshot: (optional) Values to format instead of current ones, eg. as returned by GetStats
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = ["{:40}  {:>8}  {:>10}  {:>10}  {:>10}  {:>10}".format("name", "count", "sum (s)", "p50 (s)",
+                                                                      "p95 (s)", "p99 (s)")]
+        for name, values in sorted(snapshot.items()):
+            if "value" in values:
+                lines.append("{:40}  {:>8}  {:10}".format(name, "-", values["value"]))
+                continue
+            if "sum" not in values:
+                lines.append("{:40}  {:8d}".format(name, int(values["count"])))
+                continue
+            lines.append("{:40}  {:8d}  {:10.4f}  {:10.4f}  {:10.4f}  {:10.4f}".format(
+                name, int(values["count"]), values["sum"], values["p50"], values["p95"], values["p99"]
+            ))
+
+        return '\n'.join(lines)
+
+
+# Process-wide statistics
+stats = Stats()
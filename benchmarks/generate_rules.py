@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import random
+import string
+import ipaddress
+import argparse
+from datetime import datetime, timedelta
+from typing import List, Tuple
+from lxml import etree
+
+SERVICE_XML_NS = r"https://raw.githubusercontent.com/HQJaTu/firewall-updater/master/xml/service.xsd"
+RULE_XML_NS = r"https://raw.githubusercontent.com/HQJaTu/firewall-updater/master/xml/user_rule.xsd"
+XML_SCHEMA_URL = r"http://www.w3.org/2001/XMLSchema-instance"
+
+DEFAULT_SERVICES = 20
+DEFAULT_USERS = 500
+DEFAULT_RULES_PER_USER = 20
+DEFAULT_SHARED_FILES = 5
+DEFAULT_IPV6_RATIO = 0.2
+DEFAULT_EXPIRY_RATIO = 0.1
+DEFAULT_COMMENT_RATIO = 0.5
+DEFAULT_COMMENT_LENGTH = 20
+USER_NAME_FORMAT = "bench{:05d}"
+
+
+class RuleTreeGenerator:
+    """
+    Generate a synthetic firewall rule directory with services/, users/ and shared/ trees.
+    Same parameters and seed will always generate the same tree.
+    """
+
+    def __init__(self, services: int = DEFAULT_SERVICES, users: int = DEFAULT_USERS,
+                 rules_per_user: int = DEFAULT_RULES_PER_USER, shared_files: int = DEFAULT_SHARED_FILES,
+                 ipv6_ratio: float = DEFAULT_IPV6_RATIO, expiry_ratio: float = DEFAULT_EXPIRY_RATIO,
+                 comment_ratio: float = DEFAULT_COMMENT_RATIO, comment_length: int = DEFAULT_COMMENT_LENGTH,
+                 seed: int = 1):
+        """
+        Initialize generator
+        :param services: Number of services
+        :param users: Number of users having rules
+        :param rules_per_user: Number of rules per user and shared file
+        :param shared_files: Number of shared rule files
+        :param ipv6_ratio: Ratio of rules having IPv6 source, 0.0 - 1.0
+        :param expiry_ratio: Ratio of rules having an expiry, 0.0 - 1.0. About half of them have expired already.
+        :param comment_ratio: Ratio of rules having a comment, 0.0 - 1.0
+        :param comment_length: Length of comments
+        :param seed: Random seed
+        """
+        if services < 1:
+            raise ValueError("Need at least one service!")
+        for name, ratio in (("IPv6", ipv6_ratio), ("Expiry", expiry_ratio), ("Comment", comment_ratio)):
+            if ratio < 0.0 or ratio > 1.0:
+                raise ValueError("{} ratio {} not allowed! Must be between 0.0 and 1.0".format(name, ratio))
+
+        self.services = services
+        self.users = users
+        self.rules_per_user = rules_per_user
+        self.shared_files = shared_files
+        self.ipv6_ratio = ipv6_ratio
+        self.expiry_ratio = expiry_ratio
+        self.comment_ratio = comment_ratio
+        self.comment_length = comment_length
+        self.seed = seed
+
+        self._rnd = None
+        self._now = None
+
+    @property
+    def parameters(self) -> dict:
+        return {
+            "services": self.services,
+            "users": self.users,
+            "rules_per_user": self.rules_per_user,
+            "shared_files": self.shared_files,
+            "ipv6_ratio": self.ipv6_ratio,
+            "expiry_ratio": self.expiry_ratio,
+            "comment_ratio": self.comment_ratio,
+            "comment_length": self.comment_length,
+            "seed": self.seed,
+        }
+
+    def generate(self, rule_path: str) -> List[str]:
+        """
+        Write the rule directory
+        :param rule_path: Base directory, will be created if needed
+        :return: list of generated user names
+        """
+        self._rnd = random.Random(self.seed)
+        self._now = datetime.utcnow().replace(microsecond=0)
+        etree.register_namespace("xsi", XML_SCHEMA_URL)
+
+        for sub_path in ("services", "users", "shared"):
+            os.makedirs(os.path.join(rule_path, sub_path), exist_ok=True)
+
+        service_codes = []
+        for idx in range(self.services):
+            code = "svc{:03d}".format(idx)
+            self._write_service(os.path.join(rule_path, "services", "{}.xml".format(code)), code, idx)
+            service_codes.append(code)
+
+        users = []
+        for idx in range(self.users):
+            user = USER_NAME_FORMAT.format(idx)
+            self._write_rules(os.path.join(rule_path, "users", "{}.xml".format(user)), service_codes)
+            users.append(user)
+
+        for idx in range(self.shared_files):
+            self._write_rules(os.path.join(rule_path, "shared", "shared{:03d}.xml".format(idx)), service_codes)
+
+        return users
+
+    def _write_service(self, filename: str, code: str, idx: int) -> None:
+        location_attribute = '{{{}}}noNamespaceSchemaLocation'.format(XML_SCHEMA_URL)
+        service_elem = etree.Element('service', attrib={location_attribute: SERVICE_XML_NS})
+        etree.SubElement(service_elem, 'short').text = code.upper()
+        etree.SubElement(service_elem, 'description').text = "Benchmark service {}".format(idx)
+
+        # Distinct ports per service, every fourth service has a range and every third has UDP too
+        base_port = 10000 + idx * 10
+        etree.SubElement(service_elem, 'port', protocol="tcp", port=str(base_port))
+        if idx % 4 == 3:
+            etree.SubElement(service_elem, 'port', protocol="tcp", port="{}-{}".format(base_port + 1, base_port + 5))
+        if idx % 3 == 2:
+            etree.SubElement(service_elem, 'port', protocol="udp", port=str(base_port))
+
+        etree.ElementTree(service_elem).write(filename, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+
+    def _write_rules(self, filename: str, service_codes: List[str]) -> None:
+        rules = {}
+        for _ in range(self.rules_per_user):
+            service_code = self._rnd.choice(service_codes)
+            rules.setdefault(service_code, []).append(self._source())
+
+        location_attribute = '{{{}}}noNamespaceSchemaLocation'.format(XML_SCHEMA_URL)
+        user_elem = etree.Element('user', attrib={location_attribute: RULE_XML_NS})
+        for service_code, sources in rules.items():
+            zone_elem = etree.SubElement(user_elem, 'zone')
+            for address, comment, expiry in sources:
+                source_elem = etree.SubElement(zone_elem, 'source', address=address)
+                if comment:
+                    source_elem.attrib['comment'] = comment
+                if expiry:
+                    source_elem.attrib['expires'] = expiry.isoformat()
+            etree.SubElement(zone_elem, 'service', name=service_code)
+
+        etree.ElementTree(user_elem).write(filename, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+
+    def _source(self) -> Tuple[str, str, datetime]:
+        rnd = self._rnd
+        if rnd.random() < self.ipv6_ratio:
+            # Documentation prefix 2001:db8::/32, /64 networks and /128 hosts
+            prefix_len = rnd.choice((64, 128))
+            address = ipaddress.IPv6Network(
+                ((0x20010db8 << 96) | (rnd.getrandbits(96) >> (128 - prefix_len) << (128 - prefix_len)), prefix_len)
+            )
+        else:
+            # Mostly hosts, some /24 networks
+            prefix_len = rnd.choice((32, 32, 32, 24))
+            address = ipaddress.IPv4Network(
+                (rnd.randrange(0x01000000, 0xdf000000) >> (32 - prefix_len) << (32 - prefix_len), prefix_len)
+            )
+        if address.prefixlen == address.max_prefixlen:
+            address = address.network_address
+
+        comment = None
+        if rnd.random() < self.comment_ratio:
+            comment = ''.join(rnd.choice(string.ascii_letters + ' ') for _ in range(self.comment_length)).strip()
+
+        expiry = None
+        if rnd.random() < self.expiry_ratio:
+            expiry = self._now + timedelta(seconds=rnd.randint(-30 * 86400, 30 * 86400))
+
+        return str(address), comment, expiry
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Generate a synthetic firewall rule directory for benchmarking')
+    parser.add_argument("rule_path", metavar="RULE-PATH",
+                        help="Rule base directory to generate into")
+    parser.add_argument('--services', type=int, default=DEFAULT_SERVICES,
+                        help="Number of services. Default: {}".format(DEFAULT_SERVICES))
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                        help="Number of users. Default: {}".format(DEFAULT_USERS))
+    parser.add_argument('--rules-per-user', type=int, default=DEFAULT_RULES_PER_USER,
+                        help="Number of rules per user and shared file. Default: {}".format(DEFAULT_RULES_PER_USER))
+    parser.add_argument('--shared-files', type=int, default=DEFAULT_SHARED_FILES,
+                        help="Number of shared rule files. Default: {}".format(DEFAULT_SHARED_FILES))
+    parser.add_argument('--ipv6-ratio', type=float, default=DEFAULT_IPV6_RATIO,
+                        help="Ratio of IPv6 rules. Default: {}".format(DEFAULT_IPV6_RATIO))
+    parser.add_argument('--expiry-ratio', type=float, default=DEFAULT_EXPIRY_RATIO,
+                        help="Ratio of rules having an expiry. Default: {}".format(DEFAULT_EXPIRY_RATIO))
+    parser.add_argument('--comment-ratio', type=float, default=DEFAULT_COMMENT_RATIO,
+                        help="Ratio of rules having a comment. Default: {}".format(DEFAULT_COMMENT_RATIO))
+    parser.add_argument('--comment-length', type=int, default=DEFAULT_COMMENT_LENGTH,
+                        help="Length of comments. Default: {}".format(DEFAULT_COMMENT_LENGTH))
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Random seed for rule generation. Default: 1")
+    args = parser.parse_args()
+
+    generator = RuleTreeGenerator(services=args.services, users=args.users, rules_per_user=args.rules_per_user,
+                                  shared_files=args.shared_files, ipv6_ratio=args.ipv6_ratio,
+                                  expiry_ratio=args.expiry_ratio, comment_ratio=args.comment_ratio,
+                                  comment_length=args.comment_length, seed=args.seed)
+    users = generator.generate(args.rule_path)
+    print("Generated {} services, {} users and {} shared files into {}".format(
+        args.services, len(users), args.shared_files, args.rule_path
+    ))
+
+
+if __name__ == "__main__":
+    main()
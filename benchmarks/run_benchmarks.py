@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+from datetime import datetime
+from typing import Callable, Dict, List, Union
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bastinon import Iptables
+from bastinon.executors import MemoryIptablesExecutor
+from bastinon.rules import ServiceReader, RuleReader, RuleWriter, UserRule, file_cache
+from generate_rules import RuleTreeGenerator, DEFAULT_USERS, DEFAULT_RULES_PER_USER
+
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.2
+DEFAULT_MIN_DIFFERENCE = 0.001
+DEFAULT_CHANGE_RATIO = 0.05
+CHAIN_NAME = "Benchmark-INPUT"
+
+
+class BenchmarkRuleReader(RuleReader):
+    """
+    Rule reader accepting generated users. They don't exist in this system.
+    """
+
+    @staticmethod
+    def _unix_user(user: str) -> Union[str, None]:
+        return user
+
+
+class BenchmarkRuleWriter(RuleWriter, BenchmarkRuleReader):
+    pass
+
+
+def _time(function: Callable, repeat: int, setup: Callable = None) -> Dict[str, float]:
+    """
+    Time a function
+    :param function: function to time
+    :param repeat: number of runs
+    :param setup: (optional) function to run untimed before every run
+    :return: dict: fastest and mean run in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {"min": min(times), "mean": sum(times) / len(times), "repeat": repeat}
+
+
+def _dbus_service(firewall: Iptables, rule_path: str):
+    """
+    D-Bus service object not connected to any bus, for calling the handlers directly.
+    :return: service object, None if D-Bus isn't available
+    """
+    try:
+        from bastinon.dbus import FirewallUpdaterService
+    except ImportError:
+        return None
+
+    class BenchmarkService(FirewallUpdaterService):
+
+        def __init__(self):
+            # Skip connecting to bus
+            self._use_system_bus = False
+            self._loop = None
+            self._firewall = firewall
+            self._firewall_rules_path = rule_path
+            self._aggregator = None
+            self._expiry_scheduler = None
+            self._max_ipv4_network_size = None
+            self._max_ipv6_network_size = None
+
+        def _rule_reader(self) -> RuleReader:
+            return BenchmarkRuleReader(self._firewall_rules_path)
+
+    return BenchmarkService()
+
+
+def run_benchmarks(rule_path: str, repeat: int, change_ratio: float) -> Dict[str, Dict[str, float]]:
+    """
+    Time rule reading, writing, rendering and synchronizing with an in-memory IPtables.
+    :param rule_path: Rule base directory
+    :param repeat: number of runs per benchmark
+    :param change_ratio: Ratio of rules changed before synchronizing
+    :return: dict, key: benchmark name, value: timings
+    """
+    results = {}
+
+    results["ServiceReader.read_all"] = _time(lambda: ServiceReader(rule_path).read_all(), repeat,
+                                              setup=file_cache.clear)
+    services = ServiceReader(rule_path).read_all()
+
+    results["RuleReader.read_all_users"] = _time(
+        lambda: BenchmarkRuleReader(rule_path).read_all_users(read_shared_rules=True), repeat,
+        setup=file_cache.clear
+    )
+    results["RuleReader.read_all_users (cached)"] = _time(
+        lambda: BenchmarkRuleReader(rule_path).read_all_users(read_shared_rules=True), repeat
+    )
+    rules = BenchmarkRuleReader(rule_path).read_all_users(read_shared_rules=True)
+    user_rules = {}
+    for rule in rules:
+        if isinstance(rule, UserRule):
+            user_rules.setdefault(rule.owner, []).append(rule)
+
+    def _write_all():
+        writer = BenchmarkRuleWriter(rule_path)
+        for user, rules_of_user in user_rules.items():
+            writer.write(user, rules_of_user)
+
+    results["RuleWriter.write"] = _time(_write_all, repeat)
+
+    executor = MemoryIptablesExecutor(chains=[CHAIN_NAME])
+    for command in ("iptables", "ip6tables"):
+        executor.run([command, "-A", "INPUT", "-j", CHAIN_NAME])
+    firewall = Iptables(services, CHAIN_NAME, True, concurrent=False, executor=executor)
+
+    def _render():
+        for ip_version in Iptables.IP_VERSIONS:
+            for rule in rules:
+                firewall._rule_to_ipchain_append(ip_version, rule)
+
+    results["Iptables._rule_to_ipchain_append"] = _time(_render, repeat)
+
+    def _flush():
+        for command in ("iptables", "ip6tables"):
+            executor.run([command, "-F", CHAIN_NAME])
+
+    results["Iptables.set"] = _time(lambda: firewall.set(rules), repeat, setup=_flush)
+
+    # Chain has all of the rules, change some of them
+    changed_count = int(len(rules) * change_ratio)
+    changed_rules = rules[changed_count:] + [
+        UserRule(rule.owner if isinstance(rule, UserRule) else "shared", rule.service,
+                 str(rule.source_network.network_address + 1), rule.expiry, rule.comment)
+        for rule in rules[:changed_count] if rule.source_network.num_addresses > 2
+    ]
+    results["Iptables._do_sync_rules"] = _time(lambda: firewall._do_sync_rules(changed_rules), repeat)
+
+    service = _dbus_service(firewall, rule_path)
+    if service:
+        results["FirewallUpdaterService.GetServices"] = _time(lambda: service.GetServices(), repeat)
+        results["FirewallUpdaterService.GetRules"] = _time(lambda: service.GetRules(""), repeat)
+    else:
+        print("D-Bus not available, skipping D-Bus handlers")
+
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float, min_difference: float) -> bool:
+    """
+    Compare results against baseline
+    :param baseline: baseline results
+    :param current: current results
+    :param threshold: Allowed slowdown ratio, eg. 0.2 = 20% slower
+    :param min_difference: Differences smaller than this many seconds are never a regression
+    :return: True = no regressions
+    """
+    if baseline.get("parameters") != current.get("parameters"):
+        print("Warning: Results were generated with different parameters!")
+
+    ok = True
+    print("{:40}  {:>12}  {:>12}  {:>8}".format("benchmark", "baseline (s)", "current (s)", "change"))
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            print("{:40}  {:>12}  {:12.4f}  {:>8}".format(name, "-", result["min"], "new"))
+            continue
+
+        baseline_time = baseline["results"][name]["min"]
+        current_time = result["min"]
+        change = (current_time - baseline_time) / baseline_time if baseline_time else 0.0
+        regression = change > threshold and current_time - baseline_time > min_difference
+        print("{:40}  {:12.4f}  {:12.4f}  {:+7.1%}{}".format(
+            name, baseline_time, current_time, change, "  REGRESSION" if regression else ""
+        ))
+        if regression:
+            ok = False
+
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark Bastinon')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help="Run benchmarks and write results as JSON")
+    run_parser.add_argument('--rule-path',
+                            help="(optional) Rule base directory, default: generate one into a temporary directory")
+    run_parser.add_argument('--users', type=int, default=DEFAULT_USERS,
+                            help="Generated rules, number of users. Default: {}".format(DEFAULT_USERS))
+    run_parser.add_argument('--rules-per-user', type=int, default=DEFAULT_RULES_PER_USER,
+                            help="Generated rules, number of rules per user. Default: {}".format(
+                                DEFAULT_RULES_PER_USER))
+    run_parser.add_argument('--seed', type=int, default=1,
+                            help="Generated rules, random seed. Default: 1")
+    run_parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                            help="Number of runs per benchmark. Default: {}".format(DEFAULT_REPEAT))
+    run_parser.add_argument('--change-ratio', type=float, default=DEFAULT_CHANGE_RATIO,
+                            help="Ratio of rules changed before synchronizing. Default: {}".format(
+                                DEFAULT_CHANGE_RATIO))
+    run_parser.add_argument('--output', '-o',
+                            help="(optional) JSON-file to write results into")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare results against a baseline")
+    compare_parser.add_argument('baseline', metavar='BASELINE',
+                                help="JSON-file having the baseline results")
+    compare_parser.add_argument('current', metavar='CURRENT',
+                                help="JSON-file having the results to compare")
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help="Allowed slowdown before flagging a regression. Default: {}".format(
+                                    DEFAULT_THRESHOLD))
+    compare_parser.add_argument('--min-difference', type=float, default=DEFAULT_MIN_DIFFERENCE,
+                                help="Slowdowns smaller than this many seconds are noise. Default: {}".format(
+                                    DEFAULT_MIN_DIFFERENCE))
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.current) as current_file:
+            current = json.load(current_file)
+        if not compare(baseline, current, args.threshold, args.min_difference):
+            exit(1)
+        exit(0)
+
+    if args.command != 'run':
+        parser.print_help()
+        exit(2)
+
+    temp_path = None
+    rule_path = args.rule_path
+    if rule_path:
+        parameters = {"rule_path": os.path.abspath(rule_path)}
+    else:
+        generator = RuleTreeGenerator(users=args.users, rules_per_user=args.rules_per_user, seed=args.seed)
+        temp_path = tempfile.mkdtemp(prefix="bastinon-benchmark-")
+        rule_path = temp_path
+        generator.generate(rule_path)
+        parameters = generator.parameters
+
+    parameters["change_ratio"] = args.change_ratio
+    try:
+        results = run_benchmarks(rule_path, args.repeat, args.change_ratio)
+    finally:
+        if temp_path:
+            shutil.rmtree(temp_path)
+
+    output = {
+        "created": datetime.utcnow().replace(microsecond=0).isoformat(),
+        "python": platform.python_version(),
+        "parameters": parameters,
+        "results": results,
+    }
+    for name, result in results.items():
+        print("{:40}  {:10.4f} s".format(name, result["min"]))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+            output_file.write("\n")
+
+
+if __name__ == "__main__":
+    main()
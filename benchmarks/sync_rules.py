@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import os
+import sys
+import time
+import random
+import ipaddress
+import argparse
+from typing import List, Dict, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bastinon.base import FirewallBase
+from bastinon.iptables import Iptables, IptablesRule
+from bastinon.rules import Service, ServiceRegistry, UserRule
+
+DEFAULT_RULE_COUNTS = [10000, 50000]
+DEFAULT_NAIVE_SAMPLE = 200
+
+
+class BenchmarkIptables(Iptables):
+    """
+    IPtables engine with a pre-set chain. Doesn't need iptables-commands nor root.
+    """
+
+    def __init__(self, services: Dict[str, Service], active_rules: Dict[int, List[IptablesRule]]):
+        FirewallBase.__init__(self, services)
+        self._chain = "Benchmark-INPUT"
+        self._shadow_chain = self._chain + self.SHADOW_CHAIN_SUFFIX
+        self._active_chains = {}
+        self._in_sync_fingerprint = None
+        self.stateful = True
+        self.batch = True
+        self.concurrent = False
+        self.multiport = False
+        self.shadow_rebuild = False
+        self._active_rules = active_rules
+
+    def _read_snapshot(self, ip_version: int) -> str:
+        return ""
+
+    def _read_chain(self, ip_version: int, snapshot: str = None) -> List[IptablesRule]:
+        return self._active_rules[ip_version]
+
+
+def generate(rule_count: int, seed: int) -> Tuple[Dict[str, Service], List[UserRule], Dict[int, List[IptablesRule]],
+                                                  int]:
+    """
+    Generate user rules and a chain having 90% of them active and 5% of stale rules.
+    Every fourth service has multiple ports. 2% of active rules of them are missing one of their ports.
+    :return: tuple: services, user rules, active rules per IP-version, number of user rules not fully active
+    """
+    rnd = random.Random(seed)
+    services = ServiceRegistry()
+    for idx in range(20):
+        code = "svc{}".format(idx)
+        if idx % 4:
+            definition = {Service.PROTOCOL_TCP: [1000 + idx]}
+        else:
+            definition = {Service.PROTOCOL_TCP: [2000 + idx, 3000 + idx], Service.PROTOCOL_UDP: [2000 + idx]}
+        services[code] = Service(code, code.upper(), definition)
+    service_list = list(services.values())
+
+    user_rules = []
+    active_rules = {4: [], 6: []}
+    incomplete = 0
+    for idx in range(rule_count):
+        service = rnd.choice(service_list)
+        if rnd.random() < 0.8:
+            source = str(ipaddress.IPv4Address(rnd.getrandbits(32)))
+        else:
+            source = str(ipaddress.IPv6Network((rnd.getrandbits(128), 64), strict=False))
+        comment = "Rule {}".format(idx) if rnd.random() < 0.5 else None
+        rule = UserRule("user{}".format(idx % 500), service, source, comment=comment)
+        user_rules.append(rule)
+
+        if rnd.random() >= 0.9:
+            incomplete += 1
+            continue
+        ports = list(service.enumerate())
+        if len(ports) > 1 and rnd.random() < 0.02:
+            # One of the ports is missing
+            ports.pop(rnd.randrange(len(ports)))
+            incomplete += 1
+        active = active_rules[rule.source_address_family]
+        for proto, port in ports:
+            active.append(IptablesRule(len(active) + 1, proto, port, service, rule.source_network, comment))
+
+    for idx in range(rule_count // 20):
+        service = rnd.choice(service_list)
+        proto, port = next(service.enumerate())
+        source = ipaddress.ip_network(ipaddress.IPv4Address(rnd.getrandbits(32)))
+        active = active_rules[4]
+        active.append(IptablesRule(len(active) + 1, proto, port, service, source, None))
+
+    return services, user_rules, active_rules, incomplete
+
+
+def naive_match(user_rules: List[UserRule], active_rules: List[IptablesRule]) -> int:
+    """
+    Reference implementation: scan all user rules for every active rule.
+    """
+    matches = 0
+    for active_rule in active_rules:
+        for rule in user_rules:
+            if rule == active_rule:
+                matches += 1
+                break
+
+    return matches
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark IPtables rule synchronization')
+    parser.add_argument('rule_counts', metavar='RULE-COUNT', type=int, nargs='*', default=DEFAULT_RULE_COUNTS,
+                        help="Number of user rules. Default: {}".format(
+                            ', '.join([str(count) for count in DEFAULT_RULE_COUNTS])))
+    parser.add_argument('--naive-sample', type=int, default=DEFAULT_NAIVE_SAMPLE,
+                        help="Number of active rules to time with reference implementation, "
+                             "0 = skip. Default: {}".format(DEFAULT_NAIVE_SAMPLE))
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Random seed for rule generation. Default: 1")
+    args = parser.parse_args()
+
+    print("{:>8}  {:>12}  {:>16}  {:>8}".format("rules", "indexed (s)", "scan, est. (s)", "speedup"))
+    for rule_count in args.rule_counts:
+        services, user_rules, active_rules, incomplete = generate(rule_count, args.seed)
+        firewall = BenchmarkIptables(services, active_rules)
+
+        start = time.perf_counter()
+        firewall.needs_update(user_rules)
+        indexed_time = time.perf_counter() - start
+
+        # Sanity: Every rule not fully active needs to be added
+        _, _, ipv4_rules_to_add, _, _, ipv6_rules_to_add, _ = firewall._do_sync_rules(user_rules)
+        if len(ipv4_rules_to_add) + len(ipv6_rules_to_add) != incomplete:
+            print("Warning: {} rules to add, expected {}".format(
+                len(ipv4_rules_to_add) + len(ipv6_rules_to_add), incomplete
+            ))
+
+        if args.naive_sample:
+            # Scanning is linear per active rule. Time a sample and extrapolate into full chain.
+            all_active = active_rules[4] + active_rules[6]
+            step = max(1, len(all_active) // args.naive_sample)
+            sample = all_active[::step]
+            start = time.perf_counter()
+            naive_match(user_rules, sample)
+            naive_time = (time.perf_counter() - start) * len(all_active) / len(sample)
+            print("{:8d}  {:12.3f}  {:16.1f}  {:7.0f}x".format(
+                rule_count, indexed_time, naive_time, naive_time / indexed_time
+            ))
+        else:
+            print("{:8d}  {:12.3f}  {:>16}  {:>8}".format(rule_count, indexed_time, "-", "-"))
+
+
+if __name__ == "__main__":
+    main()
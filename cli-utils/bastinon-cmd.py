@@ -23,8 +23,9 @@ import os
 import sys
 from typing import Optional, Tuple
 import argparse
-from bastinon.rules import RuleReader, RuleWriter, ServiceReader, UserRule
-from bastinon import FirewallBase, Iptables
+from bastinon.rules import RuleReader, RuleWriter, ServiceReader, UserRule, RuleAggregator
+from bastinon import FirewallBase, Iptables, Ipset, Nftables, Firewalld, RuleUsage
+from bastinon.stats import stats
 import logging
 
 log = logging.getLogger(__name__)
@@ -91,27 +92,39 @@ def rules_need_update(rule_engine: FirewallBase, rules_path: str) -> None:
         log.info("All ok")
 
 
-def rules_enforcement(rule_engine: FirewallBase, rules_path: str, simulation: bool, forced: bool) -> None:
+def rules_enforcement(rule_engine: FirewallBase, rules_path: str, simulation: bool, forced: bool,
+                      aggregate: bool = False, json_output: bool = False) -> None:
     """
     Enforce firewall rules
     :param rule_engine: object, The chosen firewall engine to be used for rule enforcement
     :param rules_path: string, Path to Bastinon rules directory
     :param simulation: bool, True = don't actually enforce but display what needs to be done, False = do it!
     :param forced: bool, True = don't try to synchronize nor deduce minimal effort, drop all and recreate
+    :param aggregate: bool, True = collapse overlapping and adjacent sources of a service into single rules
+    :param json_output: bool, True = print the enforcement plan as JSON, nothing else
     :return: None
     """
     reader = RuleReader(rules_path)
     rules = reader.read_all_users(read_shared_rules=True)
+    if aggregate:
+        rules = RuleAggregator().aggregate(rules)
 
     # Test the newly read rules
-    changes = rule_engine.simulate(rules, forced)
+    plan = rule_engine.plan(rules, forced)
+    if json_output:
+        print(plan.to_json(indent=2))
 
-    if not changes:
+    if not plan.changes_needed:
         log.info("All ok, no changes")
-        print("All ok, no changes")
+        if not json_output:
+            print("All ok, no changes")
     else:
+        changes = plan.commands()
         log.info("Enforcement: {} changes in rules".format(len(changes)))
-        print("Enforcement: {} changes in rules".format(len(changes)))
+        if not json_output:
+            print("Enforcement: {} changes in rules, estimated {} kernel operations in {} processes".format(
+                len(changes), plan.kernel_operations, plan.processes
+            ))
         for idx, rule in enumerate(changes):
             log.info("{0:3d}) {1}".format(idx + 1, rule))
 
@@ -119,10 +132,40 @@ def rules_enforcement(rule_engine: FirewallBase, rules_path: str, simulation: bo
             log.warning("Proceed with changes:")
             rule_engine.set(rules, forced)
             log.info("Changes done!")
-            print("Changes done!")
+            if not json_output:
+                print("Changes done!")
         else:
             log.info("Simulation. Won't proceed with changes.")
-            print("Simulation. Won't proceed with changes.")
+            if not json_output:
+                print("Simulation. Won't proceed with changes.")
+
+
+def rule_usage_report(rule_engine: FirewallBase, rules_path: str, usage_file: Optional[str],
+                      unused_days: Optional[int]) -> None:
+    """
+    Print packet and byte counters of rules
+    :param rule_engine: object, The chosen firewall engine to read counters from
+    :param rules_path: string, Path to Bastinon rules directory
+    :param usage_file: string, (optional) Rule usage collected by the daemon, won't be written into
+    :param unused_days: int, (optional) Print only rules not used for this many days
+    :return: None
+    """
+    reader = RuleReader(rules_path)
+    rules = reader.read_all_users(read_shared_rules=True)
+    usage = RuleUsage(rule_engine, state_file=usage_file)
+    usage.update(rules)
+
+    report = usage.report(rules, unused_days)
+    if unused_days is not None:
+        print("{} rules not used for {} days".format(len(report), unused_days))
+    for rule, counters in report:
+        owner = rule.owner if isinstance(rule, UserRule) else "(shared)"
+        print("{} {} {}: {} packets, {} bytes, first seen: {}, last used: {}".format(
+            owner, rule.service.code, rule.source,
+            counters.packet_count, counters.byte_count,
+            counters.first_seen.strftime("%Y-%m-%d %H:%M"),
+            counters.last_used.strftime("%Y-%m-%d %H:%M") if counters.last_used else "never"
+        ))
 
 
 def add_rule(user: str, service_code: str, source: str, comment: str, rules_path: str) -> None:
@@ -143,6 +186,24 @@ def add_rule(user: str, service_code: str, source: str, comment: str, rules_path
     writer.write(user, rules)
 
 
+def service_stats(use_system_bus: bool) -> None:
+    """
+    Print counters and latencies of a running bastinon-service
+    :param use_system_bus: bool, True = service is in system bus, False = in session bus
+    :return: None
+    """
+    import dbus
+    from bastinon.dbus.service import FIREWALL_UPDATER_SERVICE_BUS_NAME, FirewallUpdaterService
+
+    bus = dbus.SystemBus() if use_system_bus else dbus.SessionBus()
+    service = bus.get_object(FIREWALL_UPDATER_SERVICE_BUS_NAME, FirewallUpdaterService.OPATH)
+    service_stats_out = service.GetStats(dbus_interface=FIREWALL_UPDATER_SERVICE_BUS_NAME)
+
+    print("Statistics of bastinon-service:")
+    print(stats.format({str(name): {str(key): float(value) for key, value in values.items()}
+                        for name, values in service_stats_out.items()}))
+
+
 class NegateAction(argparse.Action):
     """
     Argparse helper to enable --toggle / --no-toggle
@@ -155,9 +216,22 @@ class NegateAction(argparse.Action):
 def main() -> None:
     RULE_COMMAND_PRINT_ALL = "print-all"
     RULE_COMMAND_ENFORCE = "enforce"
-    RULE_COMMANDS = [RULE_COMMAND_PRINT_ALL, RULE_COMMAND_ENFORCE]
+    RULE_COMMAND_USAGE = "usage"
+    RULE_COMMAND_STATS = "stats"
+    RULE_COMMANDS = [RULE_COMMAND_PRINT_ALL, RULE_COMMAND_ENFORCE, RULE_COMMAND_USAGE, RULE_COMMAND_STATS]
+
+    BUS_SYSTEM = "system"
+    BUS_SESSION = "session"
+
+    FIREWALL_IPTABLES = "iptables"
+    FIREWALL_IPSET = "ipset"
+    FIREWALL_NFTABLES = "nftables"
+    FIREWALL_FIREWALLD = "firewalld"
+    FIREWALLS = [FIREWALL_IPTABLES, FIREWALL_IPSET, FIREWALL_NFTABLES, FIREWALL_FIREWALLD]
 
     DEFAULT_IPTABLES_CHAIN_NAME = "Friends-Firewall-INPUT"
+    DEFAULT_NFTABLES_TABLE_NAME = Nftables.DEFAULT_TABLE_NAME
+    DEFAULT_FIREWALLD_ZONE = Firewalld.DEFAULT_ZONE
 
     parser = argparse.ArgumentParser(description='Firewall Updates daemon')
     parser.add_argument("rule_path", metavar="RULE-PATH",
@@ -168,16 +242,65 @@ def main() -> None:
                         help="(optional) Update rules for single user")
     parser.add_argument('--log-level', default="WARNING",
                         help='Set logging level. Python default is: WARNING')
+    parser.add_argument('--firewall', default=FIREWALL_IPTABLES, choices=FIREWALLS,
+                        help="Firewall to use. Choices: {}. Default: {}".format(', '.join(FIREWALLS),
+                                                                               FIREWALL_IPTABLES))
     parser.add_argument('--iptables-chain', default=DEFAULT_IPTABLES_CHAIN_NAME,
                         help="IPtables-mode. Chain name. Default: {}".format(DEFAULT_IPTABLES_CHAIN_NAME))
+    parser.add_argument('--nftables-table', default=DEFAULT_NFTABLES_TABLE_NAME,
+                        help="Nftables-mode. Name of inet-table having the chain. "
+                             "Default: {}".format(DEFAULT_NFTABLES_TABLE_NAME))
+    parser.add_argument('--firewalld-zone', default=DEFAULT_FIREWALLD_ZONE,
+                        help="Firewalld-mode. Zone to have the rich rules in. "
+                             "Default: {}".format(DEFAULT_FIREWALLD_ZONE))
     parser.add_argument('--stateful', '--non-stateful', dest='stateful',
                         action=NegateAction, nargs=0,
                         default=True,
                         help="Do not use stateful TCP firewall. Default: use stateful")
+    parser.add_argument('--batch', '--non-batch', dest='batch',
+                        action=NegateAction, nargs=0,
+                        default=True,
+                        help="Do not apply changes as single iptables-restore transaction. Default: use batch")
+    parser.add_argument('--concurrent', '--non-concurrent', dest='concurrent',
+                        action=NegateAction, nargs=0,
+                        default=True,
+                        help="Do not process IPv4 and IPv6 in parallel. Default: use concurrent")
+    parser.add_argument('--multiport', '--non-multiport', dest='multiport',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Single multiport rule per source and protocol. Default: rule per port")
+    parser.add_argument('--shadow-rebuild', '--non-shadow-rebuild', dest='shadow_rebuild',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Forced update fills a shadow chain and swaps the jump into it. "
+                             "Default: flush the chain")
+    parser.add_argument('--delete-by-spec', '--non-delete-by-spec', dest='delete_by_spec',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Delete rules by their specification, not by rule number. "
+                             "Default: by number")
+    parser.add_argument('--aggregate', '--non-aggregate', dest='aggregate',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="Collapse overlapping and adjacent sources of a service into single rules. "
+                             "Default: rule per source")
     parser.add_argument('--simulate', '--no-simulate', dest='simulate',
                         action=NegateAction, nargs=0,
                         default=False,
                         help="Simulate what needs to be done to enforce rules. Default: Not simulated.")
+    parser.add_argument('--json', action='store_true',
+                        default=False,
+                        help="Enforce-mode. Print enforcement plan as JSON")
+    parser.add_argument('--rule-usage-file',
+                        help="(optional) Usage-mode. Rule usage collected by bastinon-service")
+    parser.add_argument('--unused-days', type=int,
+                        help="(optional) Usage-mode. List only rules not used for this many days")
+    parser.add_argument('--bus', default=BUS_SYSTEM, choices=[BUS_SYSTEM, BUS_SESSION],
+                        help="Stats-mode. D-bus type of bastinon-service. Choices: {}. Default: {}".format(
+                            ', '.join([BUS_SYSTEM, BUS_SESSION]), BUS_SYSTEM))
+    parser.add_argument('--stats', action='store_true',
+                        default=False,
+                        help="Print counters and latencies of processing phases of this command when done")
     parser.add_argument('--force', action='store_true',
                         default=False,
                         help="Force firewall update")
@@ -200,19 +323,47 @@ def main() -> None:
                  args.rule_path)
         exit(0)
 
+    if args.rule_command.lower() == RULE_COMMAND_STATS:
+        # Statistics of the service, no firewall needed
+        service_stats(args.bus == BUS_SYSTEM)
+        exit(0)
+
+    if args.rule_command.lower() == RULE_COMMAND_USAGE:
+        if args.aggregate:
+            parser.error("Rule usage cannot be reported of aggregated rules")
+        if args.firewall != FIREWALL_IPTABLES:
+            parser.error("Rule usage can be reported only with {} firewall".format(FIREWALL_IPTABLES))
+
     reader = ServiceReader(args.rule_path)
-    iptables_firewall = Iptables(reader.read_all(), args.iptables_chain, args.stateful)
+    if args.firewall == FIREWALL_IPSET:
+        firewall = Ipset(reader.read_all(), args.iptables_chain, args.stateful, batch=args.batch,
+                         concurrent=args.concurrent, delete_by_spec=args.delete_by_spec)
+    elif args.firewall == FIREWALL_NFTABLES:
+        firewall = Nftables(reader.read_all(), args.iptables_chain, args.stateful, table_name=args.nftables_table)
+    elif args.firewall == FIREWALL_FIREWALLD:
+        firewall = Firewalld(reader.read_all(), zone=args.firewalld_zone)
+    else:
+        firewall = Iptables(reader.read_all(), args.iptables_chain, args.stateful, batch=args.batch,
+                            concurrent=args.concurrent, multiport=args.multiport,
+                            shadow_rebuild=args.shadow_rebuild, delete_by_spec=args.delete_by_spec)
 
     command = args.rule_command.lower()
     if command == RULE_COMMAND_PRINT_ALL:
-        read_rules_for_all_users(iptables_firewall, args.rule_path)
+        read_rules_for_all_users(firewall, args.rule_path)
     elif command == RULE_COMMAND_ENFORCE:
-        # read_active_rules_from_firewall(iptables_firewall, args.rule_path)
-        # rules_need_update(iptables_firewall, args.rule_path)
-        rules_enforcement(iptables_firewall, args.rule_path, simulation=args.simulate, forced=args.force)
+        # read_active_rules_from_firewall(firewall, args.rule_path)
+        # rules_need_update(firewall, args.rule_path)
+        rules_enforcement(firewall, args.rule_path, simulation=args.simulate, forced=args.force,
+                          aggregate=args.aggregate, json_output=args.json)
+    elif command == RULE_COMMAND_USAGE:
+        rule_usage_report(firewall, args.rule_path, args.rule_usage_file, args.unused_days)
     else:
         log.error("Unknown rule-command '{}'!".format(args.rule_command))
 
+    if args.stats:
+        print("Local timings of this command:")
+        print(stats.format())
+
 
 if __name__ == "__main__":
     main()
@@ -29,8 +29,10 @@ from gi.repository import GObject  # PyGObject
 from typing import Optional, Tuple
 from periodic import Periodic  # asyncio-periodic
 import signal
-from bastinon.rules import ServiceReader
-from bastinon import FirewallBase, Iptables, dbus
+from bastinon.rules import ServiceReader, RuleAggregator, schema_cache
+from bastinon import FirewallBase, Iptables, Ipset, Nftables, Firewalld, ExpiryScheduler, PrometheusExporter, dbus
+from bastinon import RuleUsage
+from bastinon.executors import PersistentRestoreExecutor
 import argparse
 import logging
 
@@ -42,6 +44,14 @@ DEFAULT_SYSTEMD_WATCHDOG_TIME = 5
 BUS_SYSTEM = "system"
 BUS_SESSION = "session"
 
+FIREWALL_IPTABLES = "iptables"
+FIREWALL_IPSET = "ipset"
+FIREWALL_NFTABLES = "nftables"
+FIREWALL_FIREWALLD = "firewalld"
+FIREWALLS = [FIREWALL_IPTABLES, FIREWALL_IPSET, FIREWALL_NFTABLES, FIREWALL_FIREWALLD]
+
+IPTABLES_CHAIN_NAME = "Friends-Firewall-INPUT"
+
 
 def _setup_logger(log_level_in: str) -> None:
     log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
@@ -72,17 +82,42 @@ async def _systemd_mock_watchdog() -> None:
     log.debug("(mock) Systemd watchdog tick/tock")
 
 
-def daemon(use_system_bus: bool, firewall: FirewallBase, firewall_rules_path: str, watchdog_time: int) -> None:
+def daemon(use_system_bus: bool, firewall: FirewallBase, firewall_rules_path: str, watchdog_time: int,
+           aggregate: bool, prometheus_file: str = None, prometheus_interval: int = None,
+           rule_usage: bool = False, rule_usage_file: str = None, rule_usage_interval: int = None) -> None:
     dbus_loop = DBusGMainLoop(set_as_default=True)
     asyncio.set_event_loop_policy(asyncio_glib.GLibEventLoopPolicy())
     asyncio_loop = asyncio.get_event_loop()
 
+    # Drop expired rules from firewall as they expire
+    aggregator = RuleAggregator() if aggregate else None
+    expiry_scheduler = ExpiryScheduler(firewall, firewall_rules_path, asyncio_loop, aggregator=aggregator)
+    expiry_scheduler.reschedule()
+
+    # Export metrics for node_exporter
+    if prometheus_file:
+        prometheus_exporter = PrometheusExporter(prometheus_file, firewall, expiry_scheduler, asyncio_loop,
+                                                 interval=prometheus_interval)
+        prometheus_exporter.start()
+    else:
+        prometheus_exporter = None
+
+    # Collect packet and byte counters of rules
+    if rule_usage:
+        usage = RuleUsage(firewall, state_file=rule_usage_file)
+        usage.start(asyncio_loop, expiry_scheduler, interval=rule_usage_interval)
+    else:
+        usage = None
+
     # Publish the interactive service into D-Bus
     dbus.FirewallUpdaterService(
         use_system_bus,
         dbus_loop,
         firewall,
-        firewall_rules_path
+        firewall_rules_path,
+        aggregator=aggregator,
+        expiry_scheduler=expiry_scheduler,
+        rule_usage=usage
     )
 
     # Go loop until forever.
@@ -151,6 +186,11 @@ def daemon(use_system_bus: bool, firewall: FirewallBase, firewall_rules_path: st
     # Go for Glib event loop, runs also asyncio
     log.debug("Enter loop")
     asyncio_loop.run_until_complete(_daemon_main(cancel_event))
+    expiry_scheduler.cancel()
+    if prometheus_exporter:
+        prometheus_exporter.cancel()
+    if usage:
+        usage.cancel()
     log.debug("Exit loop")
     log.info("Done monitoring for firewall changes.")
 
@@ -173,15 +213,78 @@ def main() -> None:
                         default=DEFAULT_SYSTEMD_WATCHDOG_TIME,
                         help="How often systemd watchdog is notified. "
                              "Default: {} seconds".format(DEFAULT_SYSTEMD_WATCHDOG_TIME))
+    parser.add_argument('--firewall', default=FIREWALL_IPTABLES, choices=FIREWALLS,
+                        help="Firewall to use. Choices: {}. Default: {}".format(', '.join(FIREWALLS),
+                                                                               FIREWALL_IPTABLES))
+    parser.add_argument('--nftables-table', default=Nftables.DEFAULT_TABLE_NAME,
+                        help="Nftables-mode. Name of inet-table having the chain. "
+                             "Default: {}".format(Nftables.DEFAULT_TABLE_NAME))
+    parser.add_argument('--firewalld-zone', default=Firewalld.DEFAULT_ZONE,
+                        help="Firewalld-mode. Zone to have the rich rules in. "
+                             "Default: {}".format(Firewalld.DEFAULT_ZONE))
     parser.add_argument('--stateful', '--non-stateful', dest='stateful',
                         action=NegateAction, nargs=0,
                         help="Do not use stateful TCP firewall. Default: use stateful")
+    parser.add_argument('--batch', '--non-batch', dest='batch',
+                        action=NegateAction, nargs=0,
+                        default=True,
+                        help="Do not apply changes as single iptables-restore transaction. Default: use batch")
+    parser.add_argument('--concurrent', '--non-concurrent', dest='concurrent',
+                        action=NegateAction, nargs=0,
+                        default=True,
+                        help="Do not process IPv4 and IPv6 in parallel. Default: use concurrent")
+    parser.add_argument('--multiport', '--non-multiport', dest='multiport',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Single multiport rule per source and protocol. Default: rule per port")
+    parser.add_argument('--shadow-rebuild', '--non-shadow-rebuild', dest='shadow_rebuild',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Forced update fills a shadow chain and swaps the jump into it. "
+                             "Default: flush the chain")
+    parser.add_argument('--delete-by-spec', '--non-delete-by-spec', dest='delete_by_spec',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Delete rules by their specification, not by rule number. "
+                             "Default: by number")
+    parser.add_argument('--aggregate', '--non-aggregate', dest='aggregate',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="Collapse overlapping and adjacent sources of a service into single rules. "
+                             "Default: rule per source")
+    parser.add_argument('--persistent-restore', '--non-persistent-restore', dest='persistent_restore',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Keep iptables-restore running and stream batches into it. "
+                             "Default: process per batch")
+    parser.add_argument('--trust-validated', '--non-trust-validated', dest='trust_validated',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="Don't validate a rule file again, if its content was valid earlier. "
+                             "Default: validate on every read")
+    parser.add_argument('--rule-usage', '--non-rule-usage', dest='rule_usage',
+                        action=NegateAction, nargs=0,
+                        default=False,
+                        help="IPtables-mode. Collect packet and byte counters of rules. Default: don't collect")
+    parser.add_argument('--rule-usage-file',
+                        help="(optional) JSON-file to keep collected rule usage in over restarts")
+    parser.add_argument('--rule-usage-interval', type=int, default=RuleUsage.DEFAULT_INTERVAL,
+                        help="Seconds between collecting rule counters. Default: {}".format(RuleUsage.DEFAULT_INTERVAL))
+    parser.add_argument('--prometheus-file',
+                        help="(optional) Write metrics into a .prom-file for node_exporter's textfile collector")
+    parser.add_argument('--prometheus-interval', type=int, default=PrometheusExporter.DEFAULT_INTERVAL,
+                        help="Seconds between writing metrics. Default: {}".format(PrometheusExporter.DEFAULT_INTERVAL))
     parser.add_argument('--log-level', default="WARNING",
                         help='Set logging level. Python default is: WARNING')
     args = parser.parse_args()
 
     _setup_logger(args.log_level)
 
+    if args.rule_usage and args.aggregate:
+        parser.error("Rule usage cannot be collected of aggregated rules")
+    if args.rule_usage and args.firewall != FIREWALL_IPTABLES:
+        parser.error("Rule usage can be collected only with {} firewall".format(FIREWALL_IPTABLES))
+
     if args.bus_type == BUS_SYSTEM:
         using_system_bus = True
     elif args.bus_type == BUS_SESSION:
@@ -193,16 +296,37 @@ def main() -> None:
     global wd
     wd = watchdog()
 
+    schema_cache.trust_validated = args.trust_validated
+    executor = PersistentRestoreExecutor() if args.persistent_restore else None
     reader = ServiceReader(args.rule_path)
-    iptables_firewall = Iptables(reader.read_all(), "Friends-Firewall-INPUT", args.stateful)
+    if args.firewall == FIREWALL_IPSET:
+        firewall = Ipset(reader.read_all(), IPTABLES_CHAIN_NAME, args.stateful, batch=args.batch,
+                         concurrent=args.concurrent, delete_by_spec=args.delete_by_spec, executor=executor)
+    elif args.firewall == FIREWALL_NFTABLES:
+        firewall = Nftables(reader.read_all(), IPTABLES_CHAIN_NAME, args.stateful, table_name=args.nftables_table)
+    elif args.firewall == FIREWALL_FIREWALLD:
+        firewall = Firewalld(reader.read_all(), zone=args.firewalld_zone)
+    else:
+        firewall = Iptables(reader.read_all(), IPTABLES_CHAIN_NAME, args.stateful, batch=args.batch,
+                            concurrent=args.concurrent, multiport=args.multiport,
+                            shadow_rebuild=args.shadow_rebuild, delete_by_spec=args.delete_by_spec,
+                            executor=executor)
 
     log.info('Starting up ...')
     daemon(
         using_system_bus,
-        iptables_firewall,
+        firewall,
         args.rule_path,
-        args.watchdog_time
+        args.watchdog_time,
+        args.aggregate,
+        prometheus_file=args.prometheus_file,
+        prometheus_interval=args.prometheus_interval,
+        rule_usage=args.rule_usage,
+        rule_usage_file=args.rule_usage_file,
+        rule_usage_interval=args.rule_usage_interval
     )
+    if executor:
+        executor.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import subprocess
+import pytest
+from bastinon import Firewalld
+from bastinon.rules import Service, ServiceRegistry, UserRule, SharedRule
+
+ZONE_PATH = "/org/fedoraproject/FirewallD1/config/zone/0"
+
+
+class StandInDBusTypes:
+    """
+    Stand-in for D-Bus types of python-dbus. Checks the signatures and returns plain Python containers.
+    """
+
+    @staticmethod
+    def Dictionary(mapping: dict, signature: str) -> dict:
+        assert signature == 'sv'
+        return dict(mapping)
+
+    @staticmethod
+    def Array(items: list, signature: str) -> list:
+        assert signature == 's'
+        return list(items)
+
+
+class StandInFirewalld:
+    """
+    Stand-in for firewalld's D-Bus API, as seen through python-dbus proxy objects.
+    Keeps runtime and permanent rich rules of a single zone and records the calls made.
+    Doesn't need python-dbus nor a bus.
+    """
+
+    def __init__(self, zone: str, runtime_rules: list, permanent_rules: list):
+        self.zone = zone
+        self.runtime_rules = list(runtime_rules)
+        self.permanent_rules = list(permanent_rules)
+        self.calls = []
+
+    def get_object(self, bus_name: str, object_path: str):
+        assert bus_name == Firewalld.BUS_NAME
+        if object_path == Firewalld.OBJECT_PATH:
+            return StandInFirewalldObject(self)
+        if object_path == Firewalld.CONFIG_OBJECT_PATH:
+            return StandInConfigObject(self)
+        if object_path == ZONE_PATH:
+            return StandInConfigZoneObject(self)
+        raise AssertionError("Unknown object path {}".format(object_path))
+
+
+class StandInFirewalldObject:
+    """
+    /org/fedoraproject/FirewallD1, interface org.fedoraproject.FirewallD1.zone
+    """
+
+    def __init__(self, firewalld: StandInFirewalld):
+        self._firewalld = firewalld
+
+    def getZoneSettings2(self, zone: str, dbus_interface: str) -> dict:
+        assert dbus_interface == Firewalld.ZONE_INTERFACE
+        assert zone == self._firewalld.zone
+        self._firewalld.calls.append("getZoneSettings2")
+        return {"rules_str": list(self._firewalld.runtime_rules), "target": "default"}
+
+    def setZoneSettings2(self, zone: str, settings: dict, dbus_interface: str) -> None:
+        assert dbus_interface == Firewalld.ZONE_INTERFACE
+        assert zone == self._firewalld.zone
+        self._firewalld.calls.append("setZoneSettings2")
+        self._firewalld.runtime_rules = [str(rich_rule) for rich_rule in settings["rules_str"]]
+
+
+class StandInConfigObject:
+    """
+    /org/fedoraproject/FirewallD1/config, interface org.fedoraproject.FirewallD1.config
+    """
+
+    def __init__(self, firewalld: StandInFirewalld):
+        self._firewalld = firewalld
+
+    def getZoneByName(self, zone: str, dbus_interface: str) -> str:
+        assert dbus_interface == Firewalld.CONFIG_INTERFACE
+        assert zone == self._firewalld.zone
+        return ZONE_PATH
+
+
+class StandInConfigZoneObject:
+    """
+    Permanent zone, interface org.fedoraproject.FirewallD1.config.zone
+    """
+
+    def __init__(self, firewalld: StandInFirewalld):
+        self._firewalld = firewalld
+
+    def getSettings2(self, dbus_interface: str) -> dict:
+        assert dbus_interface == Firewalld.CONFIG_ZONE_INTERFACE
+        self._firewalld.calls.append("getSettings2")
+        return {"rules_str": list(self._firewalld.permanent_rules), "target": "default"}
+
+    def update2(self, settings: dict, dbus_interface: str) -> None:
+        assert dbus_interface == Firewalld.CONFIG_ZONE_INTERFACE
+        self._firewalld.calls.append("update2")
+        self._firewalld.permanent_rules = [str(rich_rule) for rich_rule in settings["rules_str"]]
+
+
+class MockFirewalld:
+    """
+    Stand-in firewalld service on a private session bus, made with python-dbusmock.
+    Exports firewalld's zone, config and permanent zone objects. Rich rules of a single zone are kept.
+    """
+    ZONE_CHECK = ("if args[0] != '{}':\n"
+                  "    raise dbus.exceptions.DBusException('INVALID_ZONE: ' + args[0], "
+                  "name='org.fedoraproject.FirewallD1.Exception')\n")
+    GET_SETTINGS = "ret = {'rules_str': dbus.Array(getattr(self, 'rules_str', []), signature='s'), 'target': 'default'}"
+
+    def __init__(self, dbusmock, zone: str, runtime_rules: list, permanent_rules: list):
+        import dbus
+
+        self._dbusmock = dbusmock
+        self._zone = zone
+        self.bus = dbusmock.DBusTestCase.get_dbus(system_bus=False)
+        self._process = dbusmock.DBusTestCase.spawn_server(Firewalld.BUS_NAME, Firewalld.OBJECT_PATH,
+                                                           Firewalld.ZONE_INTERFACE, system_bus=False,
+                                                           stdout=subprocess.DEVNULL)
+        self._firewalld = self.bus.get_object(Firewalld.BUS_NAME, Firewalld.OBJECT_PATH)
+        firewalld_mock = dbus.Interface(self._firewalld, dbusmock.MOCK_IFACE)
+        zone_check = self.ZONE_CHECK.format(zone)
+        firewalld_mock.AddMethods(Firewalld.ZONE_INTERFACE, [
+            ("getZoneSettings2", "s", "a{sv}", zone_check + self.GET_SETTINGS),
+            ("setZoneSettings2", "sa{sv}", "", zone_check + "self.rules_str = [str(r) for r in args[1]['rules_str']]"),
+        ])
+        firewalld_mock.AddObject(Firewalld.CONFIG_OBJECT_PATH, Firewalld.CONFIG_INTERFACE, {}, [
+            ("getZoneByName", "s", "o", zone_check + "ret = dbus.ObjectPath('{}')".format(ZONE_PATH)),
+        ])
+        firewalld_mock.AddObject(ZONE_PATH, Firewalld.CONFIG_ZONE_INTERFACE, {}, [
+            ("getSettings2", "", "a{sv}", self.GET_SETTINGS),
+            ("update2", "a{sv}", "", "self.rules_str = [str(r) for r in args[0]['rules_str']]"),
+        ])
+        self._zone_config = self.bus.get_object(Firewalld.BUS_NAME, ZONE_PATH)
+
+        # Initial rich rules are set through firewalld's own API
+        settings = {"rules_str": dbus.Array(runtime_rules, signature='s')}
+        self._firewalld.setZoneSettings2(zone, settings, dbus_interface=Firewalld.ZONE_INTERFACE)
+        settings = {"rules_str": dbus.Array(permanent_rules, signature='s')}
+        self._zone_config.update2(settings, dbus_interface=Firewalld.CONFIG_ZONE_INTERFACE)
+        self.clear_calls()
+
+    @property
+    def runtime_rules(self) -> list:
+        settings = self._firewalld.getZoneSettings2(self._zone, dbus_interface=Firewalld.ZONE_INTERFACE)
+        return [str(rich_rule) for rich_rule in settings["rules_str"]]
+
+    @property
+    def permanent_rules(self) -> list:
+        settings = self._zone_config.getSettings2(dbus_interface=Firewalld.CONFIG_ZONE_INTERFACE)
+        return [str(rich_rule) for rich_rule in settings["rules_str"]]
+
+    def calls(self, method: str) -> int:
+        """
+        Number of calls made into a method since last clear
+        """
+        count = 0
+        for dbus_object in (self._firewalld, self._zone_config):
+            count += len(dbus_object.GetMethodCalls(method, dbus_interface=self._dbusmock.MOCK_IFACE))
+
+        return count
+
+    def clear_calls(self) -> None:
+        for dbus_object in (self._firewalld, self._zone_config):
+            dbus_object.ClearCalls(dbus_interface=self._dbusmock.MOCK_IFACE)
+
+    def stop(self) -> None:
+        self._process.terminate()
+        self._process.wait()
+
+
+FOREIGN_RULES = [
+    'rule family="ipv4" source address="10.0.0.0/8" reject',
+    'rule family="ipv4" source address="192.0.2.1" port port="22" protocol="tcp" accept',
+    'rule priority="100" family="ipv4" source address="192.0.2.1" port port="22" protocol="tcp" accept',
+]
+OWN_STALE_RULE = 'rule priority="1000" family="ipv4" source address="198.51.100.9" port port="22" protocol="tcp" accept'
+# Rich rules of the rules-fixture
+OWN_RULES = sorted([
+    'rule priority="1000" family="ipv4" source address="192.0.2.1" port port="22" protocol="tcp" accept',
+    'rule priority="1000" family="ipv6" source address="2001:db8::/64" port port="53" protocol="tcp" accept',
+    'rule priority="1000" family="ipv6" source address="2001:db8::/64" port port="53" protocol="udp" accept',
+    'rule priority="1000" family="ipv4" source address="203.0.113.0/24" port port="22" protocol="tcp" accept',
+])
+
+
+@pytest.fixture
+def services() -> ServiceRegistry:
+    return ServiceRegistry([
+        Service("SSH", "SSH", {Service.PROTOCOL_TCP: [22]}),
+        Service("DNS", "DNS", {Service.PROTOCOL_TCP: [53], Service.PROTOCOL_UDP: [53]}),
+    ])
+
+
+@pytest.fixture
+def rules(services: ServiceRegistry) -> list:
+    return [
+        UserRule("alice", services["SSH"], "192.0.2.1"),
+        UserRule("bob", services["DNS"], "2001:db8::/64", comment="Resolvers"),
+        SharedRule(services["SSH"], "203.0.113.0/24"),
+    ]
+
+
+@pytest.fixture(scope="module")
+def dbusmock():
+    """
+    Private dbus-daemon session bus. Needs python-dbus and python-dbusmock.
+    """
+    pytest.importorskip("dbus")
+    dbusmock = pytest.importorskip("dbusmock")
+    dbusmock.DBusTestCase.start_session_bus()
+    yield dbusmock
+    dbusmock.DBusTestCase.tearDownClass()
+
+
+@pytest.fixture
+def mock_firewalld(dbusmock):
+    started = []
+
+    def _start(runtime_rules: list, permanent_rules: list) -> MockFirewalld:
+        started.append(MockFirewalld(dbusmock, "public", runtime_rules, permanent_rules))
+        return started[-1]
+
+    yield _start
+    for firewalld in started:
+        firewalld.stop()
+
+
+def _own_rich_rules(rich_rules: list) -> list:
+    return sorted(rich_rule for rich_rule in rich_rules if 'priority="1000"' in rich_rule)
+
+
+def test_read(services: ServiceRegistry, rules: list):
+    bus = StandInFirewalld("public", FOREIGN_RULES + [
+        'rule priority="1000" family="ipv4" source address="192.0.2.1" port port="22" protocol="tcp" accept',
+        'rule priority="1000" family="ipv6" source address="2001:db8::/64" port port="53" protocol="tcp" accept',
+    ], [])
+    firewall = Firewalld(services, bus=bus, dbus_types=StandInDBusTypes)
+
+    in_effect = [effective for _, effective in firewall.query(rules)]
+    # DNS is missing its UDP-port, foreign rule for the shared one's source won't count
+    assert in_effect == [True, False, False]
+    assert firewall.needs_update(rules)
+    # Reading won't change anything
+    assert "setZoneSettings2" not in bus.calls
+    assert "update2" not in bus.calls
+
+
+def test_apply(services: ServiceRegistry, rules: list):
+    bus = StandInFirewalld("public", [OWN_STALE_RULE], [OWN_STALE_RULE])
+    firewall = Firewalld(services, bus=bus, dbus_types=StandInDBusTypes)
+
+    firewall.set(rules)
+
+    # Single update of runtime and of permanent settings
+    assert bus.calls.count("setZoneSettings2") == 1
+    assert bus.calls.count("update2") == 1
+    assert _own_rich_rules(bus.runtime_rules) == OWN_RULES
+    assert _own_rich_rules(bus.permanent_rules) == OWN_RULES
+    assert all(effective for _, effective in firewall.query(rules))
+    assert not firewall.needs_update(rules)
+
+    # Rules in effect, no more updates
+    bus.calls = []
+    firewall.set(rules)
+    assert "setZoneSettings2" not in bus.calls
+    assert "update2" not in bus.calls
+
+
+def test_apply_runtime_only(services: ServiceRegistry, rules: list):
+    bus = StandInFirewalld("public", [], [])
+    firewall = Firewalld(services, permanent=False, bus=bus, dbus_types=StandInDBusTypes)
+
+    firewall.set(rules)
+
+    assert bus.calls.count("setZoneSettings2") == 1
+    assert "getSettings2" not in bus.calls
+    assert bus.permanent_rules == []
+
+
+def test_foreign_rules_preserved(services: ServiceRegistry, rules: list):
+    bus = StandInFirewalld("public", FOREIGN_RULES + [OWN_STALE_RULE], FOREIGN_RULES + [OWN_STALE_RULE])
+    firewall = Firewalld(services, bus=bus, dbus_types=StandInDBusTypes)
+
+    firewall.set(rules, force=True)
+    firewall.set(rules[:1])
+
+    # Rules without our priority are kept as-is and in order, our stale rule is gone
+    for rich_rules in (bus.runtime_rules, bus.permanent_rules):
+        assert rich_rules[:len(FOREIGN_RULES)] == FOREIGN_RULES
+        assert OWN_STALE_RULE not in rich_rules
+        assert _own_rich_rules(rich_rules) == [
+            'rule priority="1000" family="ipv4" source address="192.0.2.1" port port="22" protocol="tcp" accept'
+        ]
+
+
+def test_bus_read(services: ServiceRegistry, rules: list, mock_firewalld):
+    firewalld = mock_firewalld(FOREIGN_RULES + [
+        'rule priority="1000" family="ipv4" source address="192.0.2.1" port port="22" protocol="tcp" accept',
+        'rule priority="1000" family="ipv6" source address="2001:db8::/64" port port="53" protocol="tcp" accept',
+    ], [])
+    firewall = Firewalld(services, bus=firewalld.bus)
+
+    in_effect = [effective for _, effective in firewall.query(rules)]
+    assert in_effect == [True, False, False]
+    assert firewall.needs_update(rules)
+    assert firewalld.calls("setZoneSettings2") == 0
+    assert firewalld.calls("update2") == 0
+
+
+def test_bus_apply(services: ServiceRegistry, rules: list, mock_firewalld):
+    initial_rules = FOREIGN_RULES + [OWN_STALE_RULE]
+    firewalld = mock_firewalld(initial_rules, initial_rules)
+    firewall = Firewalld(services, bus=firewalld.bus)
+
+    firewall.set(rules)
+
+    # Single update of runtime and of permanent settings, foreign rules are kept as-is and in order
+    assert firewalld.calls("setZoneSettings2") == 1
+    assert firewalld.calls("update2") == 1
+    for rich_rules in (firewalld.runtime_rules, firewalld.permanent_rules):
+        assert rich_rules[:len(FOREIGN_RULES)] == FOREIGN_RULES
+        assert _own_rich_rules(rich_rules) == OWN_RULES
+    assert all(effective for _, effective in firewall.query(rules))
+    assert not firewall.needs_update(rules)
+
+    # Rules in effect, no more updates
+    firewalld.clear_calls()
+    firewall.set(rules)
+    assert firewalld.calls("setZoneSettings2") == 0
+    assert firewalld.calls("update2") == 0
+
+
+def test_bus_unknown_zone(services: ServiceRegistry, rules: list, mock_firewalld):
+    import dbus
+
+    firewalld = mock_firewalld([], [])
+    firewall = Firewalld(services, zone="nonexistent", bus=firewalld.bus)
+
+    with pytest.raises(dbus.exceptions.DBusException):
+        firewall.set(rules)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+# This file is part of Firewall Updater library and tool.
+# Firewall Updater is free software: you can
+# redistribute it and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright (c) Jari Turkia
+
+import pytest
+from datetime import datetime, timedelta
+from bastinon import Iptables
+from bastinon.executors import MemoryIptablesExecutor
+from bastinon.rules import Service, ServiceRegistry, UserRule, SharedRule, RuleAggregator
+
+CHAIN = "Friends"
+SHADOW_CHAIN = CHAIN + Iptables.SHADOW_CHAIN_SUFFIX
+
+
+@pytest.fixture
+def services() -> ServiceRegistry:
+    return ServiceRegistry([
+        Service("SSH", "SSH", {Service.PROTOCOL_TCP: [22]}),
+        Service("DNS", "DNS", {Service.PROTOCOL_TCP: [53], Service.PROTOCOL_UDP: [53]}),
+        Service("WEB", "Web", {Service.PROTOCOL_TCP: [80, 443, 8080]}),
+    ])
+
+
+@pytest.fixture
+def executor() -> MemoryIptablesExecutor:
+    executor = MemoryIptablesExecutor(chains=[CHAIN])
+    for command in ("iptables", "ip6tables"):
+        executor.run([command, "-A", "INPUT", "-j", CHAIN])
+
+    return executor
+
+
+def _firewall(services: ServiceRegistry, executor: MemoryIptablesExecutor, **kwargs) -> Iptables:
+    return Iptables(services, CHAIN, True, concurrent=False, executor=executor, **kwargs)
+
+
+def _sources(executor: MemoryIptablesExecutor, ip_version: int = 4, chain_name: str = CHAIN) -> list:
+    return [rule[rule.index("-s") + 1] for rule in executor.chain(ip_version, chain_name)]
+
+
+@pytest.mark.parametrize("batch", [True, False])
+def test_set(services: ServiceRegistry, executor: MemoryIptablesExecutor, batch: bool):
+    firewall = _firewall(services, executor, batch=batch)
+    rules = [
+        UserRule("alice", services["SSH"], "192.0.2.1"),
+        UserRule("bob", services["DNS"], "2001:db8::/64", comment="Resolvers"),
+        SharedRule(services["SSH"], "203.0.113.0/24"),
+    ]
+    assert firewall.needs_update(rules)
+
+    firewall.set(rules)
+
+    assert _sources(executor, 4) == ["192.0.2.1/32", "203.0.113.0/24"]
+    assert _sources(executor, 6) == ["2001:db8::/64", "2001:db8::/64"]
+    assert not firewall.needs_update(rules)
+    assert all(effective for _, effective in firewall.query(rules))
+
+    # Rules in effect, nothing to do
+    executor.reset_stats()
+    firewall.set(rules)
+    assert not executor.operations
+
+
+def test_shared_identity(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor)
+    # Same source, service and comment allowed by two users
+    rules = [
+        UserRule("alice", services["SSH"], "192.0.2.1", comment="Office"),
+        UserRule("bob", services["SSH"], "192.0.2.1", comment="Office"),
+    ]
+
+    for _ in range(3):
+        firewall.set(rules)
+        assert len(executor.chain(4, CHAIN)) == 1
+        assert not firewall.needs_update(rules)
+    assert all(effective for _, effective in firewall.query(rules))
+
+    # Duplicate of an active rule is removed
+    executor.run(["iptables", "-A", CHAIN] + executor.chain(4, CHAIN)[0])
+    assert firewall.needs_update(rules)
+    firewall.set(rules)
+    assert len(executor.chain(4, CHAIN)) == 1
+
+    # Other user's rule keeps the active rule
+    firewall.set(rules[1:])
+    assert len(executor.chain(4, CHAIN)) == 1
+    assert not firewall.needs_update(rules[1:])
+
+
+def test_missing_port(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor)
+    rules = [UserRule("alice", services["DNS"], "192.0.2.1")]
+    firewall.set(rules)
+    udp_rule = executor.chain(4, CHAIN)[1]
+    assert "udp" in udp_rule
+    executor.run(["iptables", "-D", CHAIN, "2"])
+    assert firewall.needs_update(rules)
+    assert not any(effective for _, effective in firewall.query(rules))
+
+    executor.reset_stats()
+    firewall.set(rules)
+
+    # Only the missing port is added
+    assert executor.operations == {"-A": 1}
+    assert executor.chain(4, CHAIN)[1] == udp_rule
+    assert not firewall.needs_update(rules)
+
+
+def test_replace(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor)
+    rules = [
+        UserRule("alice", services["SSH"], "192.0.2.1"),
+        UserRule("bob", services["SSH"], "192.0.2.2"),
+        UserRule("carol", services["SSH"], "192.0.2.3"),
+    ]
+    firewall.set(rules)
+
+    executor.reset_stats()
+    rules[1] = UserRule("bob", services["SSH"], "198.51.100.2")
+    firewall.set(rules)
+
+    # Changed source is replaced in place, chain order is kept
+    assert executor.operations == {"-R": 1}
+    assert _sources(executor) == ["192.0.2.1/32", "198.51.100.2/32", "192.0.2.3/32"]
+    assert not firewall.needs_update(rules)
+
+
+def test_shadow_rebuild(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor, shadow_rebuild=True)
+    rules = [UserRule("alice", services["SSH"], "192.0.2.1")]
+    firewall.set(rules)
+
+    for active_chain, inactive_chain in ((SHADOW_CHAIN, CHAIN), (CHAIN, SHADOW_CHAIN)):
+        firewall.set(rules, force=True)
+
+        # Jump is swapped into the other chain, which has all of the rules
+        for ip_version in (4, 6):
+            assert executor.chain(ip_version, "INPUT") == [["-j", active_chain]]
+            with pytest.raises(ValueError):
+                executor.chain(ip_version, inactive_chain)
+        assert _sources(executor, chain_name=active_chain) == ["192.0.2.1/32"]
+        assert not firewall.needs_update(rules)
+
+
+@pytest.mark.parametrize("delete_by_spec", [True, False])
+def test_delete(services: ServiceRegistry, executor: MemoryIptablesExecutor, delete_by_spec: bool):
+    firewall = _firewall(services, executor, delete_by_spec=delete_by_spec)
+    rules = [
+        UserRule("alice", services["SSH"], "192.0.2.1"),
+        UserRule("bob", services["DNS"], "192.0.2.2"),
+    ]
+    firewall.set(rules)
+
+    firewall.set(rules[1:])
+
+    assert _sources(executor) == ["192.0.2.2/32", "192.0.2.2/32"]
+    assert not firewall.needs_update(rules[1:])
+    if delete_by_spec:
+        assert executor.operations["-D"] == 1
+        assert executor.operations["-R"] == 0
+
+
+def test_remove_expired(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor)
+    expiry = datetime.utcnow() + timedelta(hours=1)
+    rules = [
+        UserRule("alice", services["SSH"], "192.0.2.1", expiry=expiry),
+        UserRule("bob", services["SSH"], "192.0.2.2", expiry=expiry),
+        UserRule("carol", services["SSH"], "192.0.2.2"),
+        UserRule("dave", services["SSH"], "192.0.2.3"),
+    ]
+    firewall.set(rules)
+    assert len(executor.chain(4, CHAIN)) == 3
+
+    for rule in rules[:2]:
+        rule.expiry = datetime.utcnow() - timedelta(seconds=1)
+    executor.reset_stats()
+    firewall.remove_expired(rules)
+
+    # Source still allowed by another user is kept
+    assert executor.operations == {"-D": 1}
+    assert _sources(executor) == ["192.0.2.2/32", "192.0.2.3/32"]
+    assert not firewall.needs_update(rules)
+
+
+def test_multiport(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor, multiport=True)
+    rules = [
+        UserRule("alice", services["WEB"], "192.0.2.1"),
+        UserRule("bob", services["DNS"], "192.0.2.2"),
+    ]
+
+    firewall.set(rules)
+
+    chain = executor.chain(4, CHAIN)
+    assert len(chain) == 3
+    assert chain[0][chain[0].index("--dports") + 1] == "80,443,8080"
+    assert not firewall.needs_update(rules)
+
+    # Rules per port won't match multiport rules
+    assert _firewall(services, executor).needs_update(rules)
+
+
+def test_aggregate(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor)
+    aggregator = RuleAggregator()
+    rules = [
+        UserRule("alice", services["SSH"], "192.0.2.0/25"),
+        UserRule("bob", services["SSH"], "192.0.2.128/25", comment="Office"),
+        UserRule("carol", services["SSH"], "198.51.100.1"),
+    ]
+
+    firewall.set(aggregator.aggregate(rules))
+
+    assert _sources(executor) == ["192.0.2.0/24", "198.51.100.1/32"]
+    assert not firewall.needs_update(aggregator.aggregate(rules))
+    in_effect = aggregator.expand(firewall.query(aggregator.aggregate(rules)))
+    assert sorted(rule.owner for rule, effective in in_effect if effective) == ["alice", "bob", "carol"]
+
+
+def test_query_counters(services: ServiceRegistry, executor: MemoryIptablesExecutor):
+    firewall = _firewall(services, executor)
+    rules = [
+        UserRule("alice", services["DNS"], "192.0.2.1"),
+        UserRule("bob", services["DNS"], "192.0.2.1"),
+        UserRule("carol", services["SSH"], "192.0.2.3"),
+    ]
+    firewall.set(rules[:2])
+
+    # Rule not in effect has no counters, rules sharing an active rule are both credited
+    assert [(rule.owner, packets, octets) for rule, packets, octets in firewall.query_counters(rules)] == [
+        ("alice", 0, 0), ("bob", 0, 0)
+    ]